@@ -0,0 +1,284 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.uploadedfile import InMemoryUploadedFile
+from PIL import Image as PILImage
+from rest_framework import status
+from rest_framework.response import Response
+
+from . import metrics
+
+# Leading bytes of the image formats the decoders downstream can handle
+MAGIC_BYTES = {
+    'JPEG': (b'\xff\xd8\xff',),
+    'PNG': (b'\x89PNG\r\n\x1a\n',),
+}
+# Formats Pillow may report for each signature. Phone cameras often add an MPF
+# segment to ordinary JPEGs, which Pillow opens as MPO.
+PIL_FORMATS = {
+    'JPEG': ('JPEG', 'MPO'),
+    'PNG': ('PNG',),
+}
+
+
+class UploadRejected(Exception):
+    def __init__(self, message, status_code=status.HTTP_400_BAD_REQUEST):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def get_limits():
+    return {
+        'max_upload_bytes': getattr(settings, 'AIPOSE_MAX_UPLOAD_BYTES', 10 * 1024 * 1024),
+        'max_image_pixels': getattr(settings, 'AIPOSE_MAX_IMAGE_PIXELS', 40_000_000),
+        'max_image_dimension': getattr(settings, 'AIPOSE_MAX_IMAGE_DIMENSION', 2048),
+        'downscale_oversized': getattr(settings, 'AIPOSE_DOWNSCALE_OVERSIZED', True),
+        'allowed_formats': getattr(settings, 'AIPOSE_ALLOWED_IMAGE_FORMATS', ('JPEG', 'PNG')),
+    }
+
+
+def check_content_length(request, limits):
+    # Runs before request.data / request.FILES are touched, so an oversized body is never parsed
+    try:
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        raise UploadRejected("Invalid Content-Length header.")
+    # Allow some room for the multipart boundaries and the other form fields
+    if content_length > limits['max_upload_bytes'] + 64 * 1024:
+        raise UploadRejected("Request body too large.", status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+
+def sniff_format(image_file, allowed_formats):
+    image_file.seek(0)
+    head = image_file.read(16)
+    image_file.seek(0)
+    for image_format in allowed_formats:
+        if any(head.startswith(magic) for magic in MAGIC_BYTES.get(image_format, ())):
+            return image_format
+    raise UploadRejected("Unsupported file type. Please upload a JPEG or PNG image.",
+                         status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+
+def admit_image(image_file, limits):
+    if image_file.size > limits['max_upload_bytes']:
+        raise UploadRejected("Image file too large.", status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+    image_format = sniff_format(image_file, limits['allowed_formats'])
+
+    # PIL only parses the header here, the pixel data is not decoded until load()
+    try:
+        img = PILImage.open(image_file)
+        width, height = img.size
+    except PILImage.DecompressionBombError:
+        raise UploadRejected("Image dimensions too large.", status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    except Exception:
+        raise UploadRejected("Could not read the image header.")
+
+    if img.format not in PIL_FORMATS.get(image_format, (image_format,)):
+        raise UploadRejected("Image content does not match its file type.",
+                             status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+    if width * height > limits['max_image_pixels']:
+        raise UploadRejected("Image dimensions too large.", status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+    max_dimension = limits['max_image_dimension']
+    if max(width, height) <= max_dimension:
+        image_file.seek(0)
+        return image_file
+    if not limits['downscale_oversized']:
+        raise UploadRejected("Image dimensions too large.", status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    return downscale_image(img, image_file, image_format, max_dimension)
+
+
+def downscale_image(img, image_file, image_format, max_dimension):
+    # draft() lets the JPEG decoder scale by 1/2, 1/4 or 1/8 while decoding,
+    # so a large photo is never decoded at full resolution
+    img.draft('RGB', (max_dimension, max_dimension))
+    img.thumbnail((max_dimension, max_dimension))
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+
+    buffer = BytesIO()
+    if image_format == 'JPEG':
+        img.save(buffer, format='JPEG', quality=90)
+    else:
+        img.save(buffer, format=image_format)
+    size = buffer.tell()
+    buffer.seek(0)
+    return InMemoryUploadedFile(buffer, image_file.field_name, image_file.name,
+                                image_file.content_type, size, None)
+
+
+def admit_upload(view_method):
+    # Rejects bad uploads before anything is written to storage or decoded,
+    # and swaps in the downscaled file when the image is oversized
+    @wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        limits = get_limits()
+        try:
+            check_content_length(request, limits)
+            image_file = request.FILES.get('image_file', None)
+            if image_file:
+                upload_bytes = image_file.size
+                request.FILES['image_file'] = admit_image(image_file, limits)
+                # For request capture, which must not parse bodies itself and
+                # records the upload as the client sent it
+                request.upload_info = {
+                    'bytes': upload_bytes,
+                    'admitted_bytes': request.FILES['image_file'].size,
+                    'original': image_file,
+                }
+        except UploadRejected as e:
+            return Response({"error": e.message}, status=e.status_code)
+        return view_method(self, request, *args, **kwargs)
+    return wrapper
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, stage):
+        super().__init__(f"Deadline exceeded before {stage}.")
+        self.stage = stage
+
+
+class Deadline:
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+    def check(self, stage):
+        # Called between pipeline stages, nobody is waiting for the answer anymore
+        if self.remaining() <= 0:
+            raise DeadlineExceeded(stage)
+
+
+def request_deadline(request):
+    # Clients can ask for a shorter deadline than the configured one, not a longer one
+    seconds = getattr(settings, 'AIPOSE_REQUEST_DEADLINE', 30.0)
+    try:
+        requested = float(request.headers.get('X-Request-Timeout-Ms', '')) / 1000
+    except ValueError:
+        requested = None
+    if requested is not None and requested > 0:
+        seconds = min(seconds, requested)
+    return Deadline(seconds)
+
+
+def expired_response(view_name, e):
+    metrics.increment(f'admission.{view_name}.expired')
+    metrics.increment(f'admission.{view_name}.expired.{e.stage}')
+    return Response({"error": "Request deadline exceeded."}, status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    headers={'Retry-After': str(getattr(settings, 'AIPOSE_SHED_RETRY_AFTER', 1))})
+
+
+class TokenBucket:
+    # Per-client request quotas, at most max_clients buckets are kept (least
+    # recently seen are dropped, which only ever refills a client)
+
+    def __init__(self, rate, burst, max_clients=10000):
+        if rate <= 0:
+            raise ValueError("The quota rate must be above 0 requests per second.")
+        if burst < 1:
+            raise ValueError("The quota burst must allow at least 1 request.")
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key):
+        # Returns 0 when the request may go ahead, otherwise the seconds until a token is available
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+            return wait
+
+
+_in_flight = {}
+_quota = None
+_admission_lock = threading.Lock()
+
+
+def get_in_flight_limit(view_name):
+    with _admission_lock:
+        if view_name not in _in_flight:
+            limit = getattr(settings, 'AIPOSE_MAX_IN_FLIGHT', 4)
+            _in_flight[view_name] = threading.BoundedSemaphore(limit) if limit else None
+        return _in_flight[view_name]
+
+
+def get_quota():
+    global _quota
+    rate_limit = getattr(settings, 'AIPOSE_RATE_LIMIT', None)
+    # A rate of 0 disables quotas like None does
+    if not rate_limit or not rate_limit[0]:
+        return None
+    with _admission_lock:
+        if _quota is None:
+            _quota = TokenBucket(*rate_limit)
+        return _quota
+
+
+def quota_key(request):
+    # Never parses the body, so a throttled request is cheap. Anonymous
+    # clients are keyed on their address, a session id is chosen by the
+    # client and a new one per request would get a fresh bucket each time.
+    if request.user.is_authenticated:
+        return f'user:{request.user.pk}'
+    return f'addr:{request.META.get("REMOTE_ADDR", "")}'
+
+
+def shed_load(view_method):
+    # Sets request.deadline, applies the per-client quota and bounds the
+    # requests an endpoint works on at once. Excess requests get a fast 429 or
+    # 503 with Retry-After instead of queueing behind slow inference.
+    @wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        view_name = type(self).__name__
+        request.deadline = request_deadline(request)
+        retry_after = getattr(settings, 'AIPOSE_SHED_RETRY_AFTER', 1)
+
+        quota = get_quota()
+        if quota is not None:
+            wait = quota.take(quota_key(request))
+            if wait:
+                metrics.increment(f'admission.{view_name}.throttled')
+                return Response({"error": "Too many requests."}, status=status.HTTP_429_TOO_MANY_REQUESTS,
+                                headers={'Retry-After': str(math.ceil(wait))})
+
+        in_flight = get_in_flight_limit(view_name)
+        if in_flight is not None:
+            timeout = min(getattr(settings, 'AIPOSE_IN_FLIGHT_QUEUE_TIMEOUT', 0.0), request.deadline.remaining())
+            start = time.perf_counter()
+            if not in_flight.acquire(timeout=max(0.0, timeout)):
+                metrics.increment(f'admission.{view_name}.shed')
+                return Response({"error": "Server busy, please retry."}, status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                headers={'Retry-After': str(retry_after)})
+            metrics.observe(f'admission.{view_name}.queued', time.perf_counter() - start)
+
+        try:
+            request.deadline.check('admission')
+            metrics.increment(f'admission.{view_name}.admitted')
+            return view_method(self, request, *args, **kwargs)
+        except DeadlineExceeded as e:
+            return expired_response(view_name, e)
+        finally:
+            if in_flight is not None:
+                in_flight.release()
+    return wrapper
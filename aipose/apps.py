@@ -0,0 +1,22 @@
+from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    # Django 5.0 has no init_command for SQLite, so the PRAGMAs are applied to
+    # every new connection here
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = getattr(settings, 'AIPOSE_SQLITE_PRAGMAS', {})
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+
+class AiposeConfig(AppConfig):
+    name = 'aipose'
+    default_auto_field = 'django.db.models.BigAutoField'
+
+    def ready(self):
+        connection_created.connect(configure_sqlite, dispatch_uid='aipose.configure_sqlite')
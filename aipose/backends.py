@@ -0,0 +1,221 @@
+import atexit
+import threading
+from abc import ABC, abstractmethod
+
+import numpy as np
+from django.conf import settings
+
+MOVENET_LIGHTNING_URL = "https://tfhub.dev/google/movenet/singlepose/lightning/4"
+MOVENET_THUNDER_URL = "https://tfhub.dev/google/movenet/singlepose/thunder/4"
+MOVENET_MULTIPOSE_URL = "https://tfhub.dev/google/movenet/multipose/lightning/1"
+
+DEFAULT_MODELS = {
+    'lightning': {
+        'input_size': 192,
+        'savedmodel': MOVENET_LIGHTNING_URL,
+        'tflite': str(settings.BASE_DIR / 'models' / 'movenet_lightning_int8.tflite'),
+        'onnx': str(settings.BASE_DIR / 'models' / 'movenet_lightning.onnx'),
+    },
+    'thunder': {
+        'input_size': 256,
+        'savedmodel': MOVENET_THUNDER_URL,
+        'tflite': str(settings.BASE_DIR / 'models' / 'movenet_thunder_int8.tflite'),
+        'onnx': str(settings.BASE_DIR / 'models' / 'movenet_thunder.onnx'),
+    },
+    # MultiPose takes any input size that is a multiple of 32
+    'multipose': {
+        'input_size': 256,
+        'savedmodel': MOVENET_MULTIPOSE_URL,
+        'tflite': str(settings.BASE_DIR / 'models' / 'movenet_multipose_float16.tflite'),
+        'onnx': str(settings.BASE_DIR / 'models' / 'movenet_multipose.onnx'),
+    },
+}
+
+
+class InferenceBackend(ABC):
+    # Every backend takes a (1, H, W, 3) preprocessed image and returns the raw
+    # MoveNet output as a numpy array, (1, 1, 17, 3) for singlepose and
+    # (1, 6, 56) for multipose
+    name = None
+    # The published MoveNet exports take one image per call
+    max_batch_size = 1
+
+    def __init__(self, model_path, input_size=192, num_threads=None):
+        self.model_path = model_path
+        self.input_size = input_size
+        self.num_threads = num_threads
+
+    @abstractmethod
+    def run(self, image):
+        pass
+
+
+class SavedModelBackend(InferenceBackend):
+    name = 'savedmodel'
+
+    def __init__(self, model_path, input_size=192, num_threads=None):
+        super().__init__(model_path, input_size, num_threads)
+        import tensorflow as tf
+        import tensorflow_hub as hub
+
+        if num_threads:
+            try:
+                tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+                tf.config.threading.set_inter_op_parallelism_threads(1)
+            except RuntimeError:
+                # TF was already initialized by an earlier model, keep its pools
+                pass
+        try:
+            self.model = hub.load(model_path)
+            self.movenet = self.model.signatures['serving_default']  # type: ignore
+        except Exception as e:
+            raise RuntimeError("Failed to load the MoveNet model from TensorFlow Hub.") from e
+        self.tf = tf
+
+    def run(self, image):
+        outputs = self.movenet(self.tf.cast(image, dtype=self.tf.int32))
+        return outputs['output_0'].numpy()
+
+
+class TFLiteBackend(InferenceBackend):
+    name = 'tflite'
+
+    def __init__(self, model_path, input_size=192, num_threads=None):
+        super().__init__(model_path, input_size, num_threads)
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+
+        try:
+            self.interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+            self.interpreter.allocate_tensors()
+        except Exception as e:
+            raise RuntimeError(f"Failed to load the TFLite model from {model_path}.") from e
+        self.input_details = self.interpreter.get_input_details()[0]
+        self.output_details = self.interpreter.get_output_details()[0]
+        # The interpreter reuses its tensor buffers, so invocations must not overlap
+        self.lock = threading.Lock()
+
+    def run(self, image):
+        image = np.asarray(image)
+        dtype = self.input_details['dtype']
+        if dtype == np.uint8:
+            # int8/float16 exports take uint8 pixels, the int32 path is unclipped
+            image = np.clip(image, 0, 255)
+        image = image.astype(dtype, copy=False)
+        with self.lock:
+            self.interpreter.set_tensor(self.input_details['index'], image)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self.output_details['index']).copy()
+
+
+class ONNXRuntimeBackend(InferenceBackend):
+    name = 'onnx'
+
+    ONNX_DTYPES = {
+        'tensor(int32)': np.int32,
+        'tensor(uint8)': np.uint8,
+        'tensor(float)': np.float32,
+    }
+
+    def __init__(self, model_path, input_size=192, num_threads=None):
+        super().__init__(model_path, input_size, num_threads)
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+            options.inter_op_num_threads = 1
+        try:
+            self.session = ort.InferenceSession(model_path, sess_options=options,
+                                                providers=['CPUExecutionProvider'])
+        except Exception as e:
+            raise RuntimeError(f"Failed to load the ONNX model from {model_path}.") from e
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.input_dtype = self.ONNX_DTYPES.get(model_input.type, np.int32)
+        if not isinstance(model_input.shape[0], int):
+            # Exported with a dynamic batch dimension
+            self.max_batch_size = 64
+
+    def run(self, image):
+        image = np.asarray(image)
+        if self.input_dtype == np.uint8:
+            image = np.clip(image, 0, 255)
+        image = image.astype(self.input_dtype, copy=False)
+        return self.session.run(None, {self.input_name: image})[0]
+
+
+class SidecarBackend(InferenceBackend):
+    # Forwards to the models loaded by `manage.py runinference`, so web
+    # workers do not import TensorFlow or hold a copy of the graph
+    name = 'sidecar'
+
+    def __init__(self, model, input_size=192, num_threads=None):
+        super().__init__(model, input_size, num_threads)
+        self.model = model
+        self.client = get_sidecar_client()
+
+    def run(self, image):
+        return self.client.run(self.model, np.asarray(image))
+
+
+BACKENDS = {
+    SavedModelBackend.name: SavedModelBackend,
+    TFLiteBackend.name: TFLiteBackend,
+    ONNXRuntimeBackend.name: ONNXRuntimeBackend,
+    SidecarBackend.name: SidecarBackend,
+}
+
+_backends = {}
+_backends_lock = threading.Lock()
+_sidecar_client = None
+_sidecar_client_lock = threading.Lock()
+
+
+def get_sidecar_client():
+    # All models share one connection and segment per process
+    global _sidecar_client
+    with _sidecar_client_lock:
+        if _sidecar_client is None:
+            from .sidecar import SidecarClient
+            _sidecar_client = SidecarClient(
+                getattr(settings, 'AIPOSE_SIDECAR_SOCKET', '/tmp/aipose-inference.sock'),
+                timeout=getattr(settings, 'AIPOSE_SIDECAR_TIMEOUT', 10.0),
+            )
+            atexit.register(_sidecar_client.close)
+        return _sidecar_client
+
+
+def get_model_config(model):
+    # AIPOSE_MOVENET_MODELS only holds what differs from DEFAULT_MODELS
+    overrides = getattr(settings, 'AIPOSE_MOVENET_MODELS', {})
+    if model not in DEFAULT_MODELS and model not in overrides:
+        raise ValueError(f"Unknown MoveNet model '{model}'.")
+    return dict(DEFAULT_MODELS.get(model, {}), **overrides.get(model, {}))
+
+
+def create_backend(model='lightning', backend=None, num_threads=None):
+    backend = backend or getattr(settings, 'AIPOSE_INFERENCE_BACKEND', 'savedmodel')
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{backend}'.")
+    if num_threads is None:
+        num_threads = getattr(settings, 'AIPOSE_INFERENCE_THREADS', None)
+    config = get_model_config(model)
+    if backend == SidecarBackend.name:
+        # The sidecar resolves the model path itself
+        return SidecarBackend(model, input_size=config['input_size'])
+    return BACKENDS[backend](config[backend], input_size=config['input_size'], num_threads=num_threads)
+
+
+def get_backend(model='lightning', backend=None):
+    # Backends are loaded once per process and shared by all analyzers
+    backend = backend or getattr(settings, 'AIPOSE_INFERENCE_BACKEND', 'savedmodel')
+    key = (model, backend)
+    if key not in _backends:
+        with _backends_lock:
+            if key not in _backends:
+                _backends[key] = create_backend(model, backend)
+    return _backends[key]
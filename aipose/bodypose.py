@@ -1,137 +1,135 @@
-import tensorflow as tf
-import tensorflow_hub as hub
 import numpy as np
 
+from .backends import get_backend
+from .cascade import default_cascade
+from .phash import reuse_or_run
+from .preprocessing import preprocess_image
+
 class PoseAnalyzer:
-    def __init__(self):
-        try:
-            self.model = hub.load("https://tfhub.dev/google/movenet/singlepose/lightning/4")
-            self.movenet = self.model.signatures['serving_default']  # type: ignore
-        except Exception as e:
-            raise RuntimeError("Failed to load the MoveNet model from TensorFlow Hub.") from e
+    # Keypoints the rules read (nose, ears, shoulders, hips, knees, ankles),
+    # used to decide whether the cascade escalates. The "Improper picture"
+    # check in analyze_keypoints still looks at all 17.
+    required_keypoints = [0, 3, 4, 5, 6, 11, 12, 13, 14, 15, 16]
+
+    def __init__(self, backend=None, cascade=None):
+        # The backend (SavedModel, TFLite or ONNX Runtime) is chosen by AIPOSE_INFERENCE_BACKEND.
+        # With AIPOSE_POSE_CASCADE, Lightning runs first and Thunder only when needed.
+        self.backend = backend or get_backend('lightning')
+        self.cascade = cascade or (default_cascade() if backend is None else None)
 
     @staticmethod
     def calculate_angle(point1, point2, point3):
-        a = np.array([point1[0] - point2[0], point1[1] - point2[1]])
-        b = np.array([point3[0] - point2[0], point3[1] - point2[1]])
-        dot_product = np.dot(a, b)
-        magnitude_a = np.linalg.norm(a)
-        magnitude_b = np.linalg.norm(b)
-        angle = np.arccos(dot_product / (magnitude_a * magnitude_b))
+        # Works on single (y, x) points or on (..., 2) arrays of points
+        point1, point2, point3 = np.asarray(point1), np.asarray(point2), np.asarray(point3)
+        a = point1[..., :2] - point2[..., :2]
+        b = point3[..., :2] - point2[..., :2]
+        dot_product = np.sum(a * b, axis=-1)
+        magnitude_a = np.sqrt(np.sum(a * a, axis=-1))
+        magnitude_b = np.sqrt(np.sum(b * b, axis=-1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            angle = np.arccos(dot_product / (magnitude_a * magnitude_b))
         return np.degrees(angle)
 
     @staticmethod
     def calculate_horizontal_angle(point1, point2):
-        vector = np.array([point2[0] - point1[0], point2[1] - point1[1]])
-        horizontal = np.array([1, 0])
-        dot_product = np.dot(vector, horizontal)
-        magnitude_vector = np.linalg.norm(vector)
-        angle = np.arccos(dot_product / magnitude_vector)
+        point1, point2 = np.asarray(point1), np.asarray(point2)
+        vector = point2[..., :2] - point1[..., :2]
+        magnitude_vector = np.sqrt(np.sum(vector * vector, axis=-1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            angle = np.arccos(vector[..., 0] / magnitude_vector)
         return np.degrees(angle) - 90
 
-    @staticmethod
-    def preprocess_image(image_path):
-        try:
-            image = tf.io.read_file(image_path)
-            image = tf.image.decode_jpeg(image)
-            image = tf.image.convert_image_dtype(image, dtype=tf.float32)
-        except tf.errors.InvalidArgumentError:
-            raise ValueError("Invalid image file. Please check the image path and format.")
-        
-        image = tf.image.resize_with_pad(image, target_height=192, target_width=192)
-        image = tf.image.adjust_contrast(image, 300.0)
-        image = tf.cast(image, dtype=tf.int32)
-        return tf.expand_dims(image, axis=0)
+    # AIPOSE_PREPROCESSING picks the implementation, see default_preprocessing() in aipose/preprocessing.py
+    preprocess_image = staticmethod(preprocess_image)
 
     @staticmethod
     def check_legs_crossed(left_knee, right_knee, left_ankle, right_ankle):
-        knees_crossed = abs(left_knee[1] - right_knee[1]) < 0.1
-        ankles_crossed = abs(left_ankle[1] - right_ankle[1]) < 0.1
-        return knees_crossed or ankles_crossed
-
-    def analyze_pose(self, image_path):
-        image = self.preprocess_image(image_path)
+        knees_crossed = np.abs(left_knee[..., 1] - right_knee[..., 1]) < 0.1
+        ankles_crossed = np.abs(left_ankle[..., 1] - right_ankle[..., 1]) < 0.1
+        return knees_crossed | ankles_crossed
+
+    def detect_keypoints(self, image_path, deadline=None):
+        if self.cascade is not None:
+            return self.cascade.run(image_path, self.required_keypoints, self.preprocess_image, deadline)
+        image = self.preprocess_image(image_path, self.backend.input_size)
+        return self.backend.run(image)[0, 0]
+
+    def analyze_pose(self, image_path, cache_key=None, deadline=None):
+        # With a cache_key, keypoints of a near-duplicate image from the same
+        # client are reused and only the rules run again. The deadline is
+        # checked before the cascade escalates.
+        keypoints_with_scores = reuse_or_run(cache_key, type(self).__name__, image_path,
+                                             lambda: self.detect_keypoints(image_path, deadline))
+        scores = keypoints_with_scores[:, 2]
 
-        outputs = self.movenet(image)
-        keypoints_with_scores = outputs['output_0'].numpy()[0, 0]
+        results = self.analyze_keypoints(keypoints_with_scores[np.newaxis])[0]
+        return results, keypoints_with_scores, scores
 
-        keypoints = keypoints_with_scores[:, :2]
-        scores = keypoints_with_scores[:, 2]
+    @classmethod
+    def analyze_keypoints(cls, keypoints_with_scores):
+        # Evaluates the rules for a (people, 17, 3) array in one pass and
+        # returns the findings string of each person
+        keypoints = keypoints_with_scores[..., :2]
+        scores = keypoints_with_scores[..., 2]
 
         # Check confidence levels
-        low_confidence_points = np.sum(scores < 0.2)
-        if low_confidence_points / len(scores) > 0.75:
-            return "Improper picture. Please provide a clearer image.", keypoints_with_scores, scores
-
-        nose = keypoints[0]
-        left_ear = keypoints[3]
-        right_ear = keypoints[4]
-        left_shoulder = keypoints[5]
-        right_shoulder = keypoints[6]
-        left_hip = keypoints[11]
-        right_hip = keypoints[12]
-        left_knee = keypoints[13]
-        right_knee = keypoints[14]
-        left_ankle = keypoints[15]
-        right_ankle = keypoints[16]
-
-        results = ""
+        low_confidence_points = np.sum(scores < 0.2, axis=1)
+        improper = low_confidence_points / scores.shape[1] > 0.75
+
+        nose = keypoints[:, 0]
+        left_ear = keypoints[:, 3]
+        right_ear = keypoints[:, 4]
+        left_shoulder = keypoints[:, 5]
+        right_shoulder = keypoints[:, 6]
+        left_hip = keypoints[:, 11]
+        right_hip = keypoints[:, 12]
+        left_knee = keypoints[:, 13]
+        right_knee = keypoints[:, 14]
+        left_ankle = keypoints[:, 15]
+        right_ankle = keypoints[:, 16]
 
         # Determine facing direction by comparing the horizontal positions of the nose and ears
-        if abs(nose[0] - left_ear[0]) < abs(nose[0] - right_ear[0]):
-            facing_side = "left"
-            shoulder, hip, knee, ankle = right_shoulder, right_hip, right_knee, right_ankle
-        elif abs(nose[0] - left_ear[0]) > abs(nose[0] - right_ear[0]):
-            facing_side = "right"
-            shoulder, hip, knee, ankle = left_shoulder, left_hip, left_knee, left_ankle
-        else:
-            results += "Facing direction is ambiguous or frontal.\n"
-            facing_side = "ambiguous"
-
-        if facing_side != "ambiguous":
-            results += f"The {facing_side} side of the person is facing the camera.\n"
-            shoulder_hip_knee_angle = self.calculate_angle(shoulder, hip, knee)
-            hip_knee_ankle_angle = self.calculate_angle(hip, knee, ankle)
-
-            if 85 <= shoulder_hip_knee_angle <= 115:
-                results += "Correct sitting posture.\n"
-            elif shoulder_hip_knee_angle < 85:
-                results += "Leaning forward.\n"
-            else:
-                results += "Leaning backward.\n"
-
-            if 90 <= hip_knee_ankle_angle <= 110:
-                results += "Hip in line with legs.\n"
-            elif hip_knee_ankle_angle < 90:
-                results += "Hip lower than knees.\n"
-            else:
-                results += "Hip higher than knees.\n"
-
-            # Back Position
-            shoulder_hip_angle = self.calculate_angle(left_shoulder, (left_shoulder + right_shoulder) / 2, right_shoulder)
-            if shoulder_hip_angle < 160:
-                results += "Back is not straight.\n"
-            else:
-                results += "Back is straight.\n"
-
-            # Overall Balance
-            if abs(left_shoulder[1] - right_shoulder[1]) > 0.1:
-                if left_shoulder[1] > right_shoulder[1]:
-                    results += "Leaning to the right.\n"
-                else:
-                    results += "Leaning to the left.\n"
-            else:
-                results += "Body is well balanced.\n"
+        facing_left = np.abs(nose[:, 0] - left_ear[:, 0]) < np.abs(nose[:, 0] - right_ear[:, 0])
+        facing_right = np.abs(nose[:, 0] - left_ear[:, 0]) > np.abs(nose[:, 0] - right_ear[:, 0])
+        ambiguous = ~(facing_left | facing_right)
+
+        # The side away from the camera is the one measured, as in the single person rules
+        side = facing_left[:, np.newaxis]
+        shoulder = np.where(side, right_shoulder, left_shoulder)
+        hip = np.where(side, right_hip, left_hip)
+        knee = np.where(side, right_knee, left_knee)
+        ankle = np.where(side, right_ankle, left_ankle)
+
+        shoulder_hip_knee_angle = cls.calculate_angle(shoulder, hip, knee)
+        hip_knee_ankle_angle = cls.calculate_angle(hip, knee, ankle)
+        shoulder_hip_angle = cls.calculate_angle(left_shoulder, (left_shoulder + right_shoulder) / 2, right_shoulder)
+
+        facing = np.where(facing_left, "The left side of the person is facing the camera.\n",
+                          "The right side of the person is facing the camera.\n")
+        sitting = np.where((85 <= shoulder_hip_knee_angle) & (shoulder_hip_knee_angle <= 115), "Correct sitting posture.\n",
+                           np.where(shoulder_hip_knee_angle < 85, "Leaning forward.\n", "Leaning backward.\n"))
+        hip_position = np.where((90 <= hip_knee_ankle_angle) & (hip_knee_ankle_angle <= 110), "Hip in line with legs.\n",
+                                np.where(hip_knee_ankle_angle < 90, "Hip lower than knees.\n", "Hip higher than knees.\n"))
+        # Back Position
+        back = np.where(shoulder_hip_angle < 160, "Back is not straight.\n", "Back is straight.\n")
+        # Overall Balance
+        balance = np.where(np.abs(left_shoulder[:, 1] - right_shoulder[:, 1]) > 0.1,
+                           np.where(left_shoulder[:, 1] > right_shoulder[:, 1], "Leaning to the right.\n", "Leaning to the left.\n"),
+                           "Body is well balanced.\n")
 
         feet_on_ground_tolerance = 0.05
-        if abs(left_ankle[0] - right_ankle[0]) < feet_on_ground_tolerance:
-            results += "Both feet are placed on the ground.\n"
-        else:
-            results += "Feet are not evenly placed on the ground or at least one foot is not on the ground.\n"
-
-        if self.check_legs_crossed(left_knee, right_knee, left_ankle, right_ankle):
-            results += "The legs are not crossed.\n"
-        else:
-            results += "The legs are crossed.\n"
-
-        return results, keypoints_with_scores, scores
+        feet = np.where(np.abs(left_ankle[:, 0] - right_ankle[:, 0]) < feet_on_ground_tolerance,
+                        "Both feet are placed on the ground.\n",
+                        "Feet are not evenly placed on the ground or at least one foot is not on the ground.\n")
+        legs = np.where(cls.check_legs_crossed(left_knee, right_knee, left_ankle, right_ankle),
+                        "The legs are not crossed.\n", "The legs are crossed.\n")
+
+        results = []
+        for i in range(len(keypoints_with_scores)):
+            if improper[i]:
+                results.append("Improper picture. Please provide a clearer image.")
+            elif ambiguous[i]:
+                results.append(str("Facing direction is ambiguous or frontal.\n" + feet[i] + legs[i]))
+            else:
+                results.append(str(facing[i] + sitting[i] + hip_position[i] + back[i] + balance[i] + feet[i] + legs[i]))
+        return results
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.utils.crypto import salted_hmac
+from PIL import Image as PILImage
+
+from .admission import quota_key
+
+# Traffic capture for the posture endpoints. A sample of requests
+# (AIPOSE_CAPTURE_SAMPLE_RATE) is appended to AIPOSE_CAPTURE_FILE as JSON lines
+# with the endpoint, status, latency, sizes and a hash of the image, and with
+# AIPOSE_CAPTURE_STORE_IMAGES the image itself is kept content-addressed so
+# `manage.py replay_traffic` can send the same traffic mix again. The image is
+# the upload as the client sent it, before admission downscaled it, so a
+# replay goes through admission too.
+
+_log_lock = threading.Lock()
+_log = None
+_log_pid = None
+
+
+def write_record(record):
+    global _log, _log_pid
+    line = json.dumps(record) + '\n'
+    with _log_lock:
+        if _log is None or _log_pid != os.getpid():
+            path = get_capture_file()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Every line is one write() on an O_APPEND file, so workers can share it
+            _log = open(path, 'a', buffering=1)
+            _log_pid = os.getpid()
+        _log.write(line)
+
+
+def get_capture_file():
+    return getattr(settings, 'AIPOSE_CAPTURE_FILE', os.path.join(settings.BASE_DIR, 'var', 'capture', 'requests.jsonl'))
+
+
+def get_image_dir():
+    return os.path.join(os.path.dirname(get_capture_file()), 'images')
+
+
+def describe_image(image_file):
+    digest = hashlib.sha256()
+    image_file.seek(0)
+    for chunk in image_file.chunks():
+        digest.update(chunk)
+    image_file.seek(0)
+    info = {'sha256': digest.hexdigest(), 'bytes': image_file.size}
+    try:
+        with PILImage.open(image_file) as img:
+            info.update(width=img.width, height=img.height, format=img.format)
+    except Exception:
+        pass
+    image_file.seek(0)
+
+    if getattr(settings, 'AIPOSE_CAPTURE_STORE_IMAGES', False):
+        extension = {'JPEG': '.jpg', 'PNG': '.png'}.get(info.get('format'), '.bin')
+        path = os.path.join(get_image_dir(), info['sha256'] + extension)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'wb') as f:
+                for chunk in image_file.chunks():
+                    f.write(chunk)
+            os.replace(path + '.tmp', path)
+            image_file.seek(0)
+        info['stored'] = os.path.basename(path)
+    return info
+
+
+def capture_request(view_method):
+    @wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        rate = getattr(settings, 'AIPOSE_CAPTURE_SAMPLE_RATE', 0.0)
+        if rate <= 0 or random.random() >= rate:
+            return view_method(self, request, *args, **kwargs)
+
+        start = time.perf_counter()
+        response = view_method(self, request, *args, **kwargs)
+        latency = time.perf_counter() - start
+
+        record = {
+            'ts': round(time.time(), 3),
+            'view': type(self).__name__,
+            'path': request.path,
+            'status': response.status_code,
+            'latency_ms': round(latency * 1000, 2),
+            'request_bytes': int(request.META.get('CONTENT_LENGTH') or 0),
+            # Keyed with SECRET_KEY, so near-duplicate reuse per client can be
+            # replayed without storing who it was. A plain hash of an address
+            # or user pk could be reversed by trying them all.
+            'client': salted_hmac('aipose.capture.client', quota_key(request)).hexdigest()[:16],
+            'multi_person': request.query_params.get('multi_person'),
+        }
+        # Only when admission already parsed the body, a shed or throttled
+        # request is recorded without its image
+        upload_info = getattr(request, 'upload_info', None)
+        if upload_info is not None:
+            record['multi_person'] = request.data.get('multi_person', record['multi_person'])
+            sizes = {'upload_bytes': upload_info['bytes'], 'admitted_bytes': upload_info['admitted_bytes']}
+            try:
+                record['image'] = dict(describe_image(upload_info['original']), **sizes)
+            except (OSError, ValueError):
+                # The view may have closed the upload already
+                record['image'] = dict(sizes, bytes=upload_info['bytes'])
+        try:
+            write_record(record)
+        except OSError as e:
+            print("Could not write the capture record:", str(e))
+        return response
+    return wrapper
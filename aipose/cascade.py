@@ -0,0 +1,44 @@
+import time
+
+import numpy as np
+from django.conf import settings
+
+from . import metrics
+from .backends import get_backend
+
+
+class ModelCascade:
+    # Runs the cheapest MoveNet tier first and only escalates to the next,
+    # larger model when the keypoints a ruleset needs are not confident enough
+
+    def __init__(self, tiers=None, min_score=None, max_low_fraction=None):
+        self.tiers = tiers or getattr(settings, 'AIPOSE_CASCADE_TIERS', ('lightning', 'thunder'))
+        self.min_score = min_score if min_score is not None else getattr(settings, 'AIPOSE_CASCADE_MIN_SCORE', 0.2)
+        self.max_low_fraction = (max_low_fraction if max_low_fraction is not None
+                                 else getattr(settings, 'AIPOSE_CASCADE_MAX_LOW_FRACTION', 0.5))
+
+    def is_confident(self, keypoints_with_scores, required_keypoints):
+        scores = keypoints_with_scores[required_keypoints, 2]
+        return np.mean(scores < self.min_score) <= self.max_low_fraction
+
+    def run(self, image_path, required_keypoints, preprocess_image, deadline=None):
+        for i, model in enumerate(self.tiers):
+            if i and deadline is not None:
+                # Escalating is a new stage, nobody may be waiting for it anymore
+                deadline.check('escalation')
+            backend = get_backend(model)
+            start = time.perf_counter()
+            keypoints_with_scores = backend.run(preprocess_image(image_path, backend.input_size))[0, 0]
+            metrics.observe(f'cascade.{model}', time.perf_counter() - start)
+            metrics.increment(f'cascade.{model}.runs')
+
+            if i == len(self.tiers) - 1 or self.is_confident(keypoints_with_scores, required_keypoints):
+                metrics.increment(f'cascade.{model}.answered')
+                return keypoints_with_scores
+            metrics.increment(f'cascade.{model}.escalated')
+
+
+def default_cascade():
+    if getattr(settings, 'AIPOSE_POSE_CASCADE', False):
+        return ModelCascade()
+    return None
@@ -1,139 +1,127 @@
-import tensorflow as tf
-import tensorflow_hub as hub
 import numpy as np
 
+from .backends import get_backend
+from .cascade import default_cascade
+from .phash import reuse_or_run
+from .preprocessing import preprocess_image
+
 class DeskPoseAnalyzer:
-    def __init__(self):
-        try:
-            self.model = hub.load("https://tfhub.dev/google/movenet/singlepose/lightning/4")
-            self.movenet = self.model.signatures['serving_default']  # type: ignore
-        except Exception as e:
-            raise RuntimeError("Failed to load the MoveNet model from TensorFlow Hub.") from e
+    # List of indices for the keypoints of interest, also used by the cascade
+    required_keypoints = [0, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
+
+    def __init__(self, backend=None, cascade=None):
+        # The backend (SavedModel, TFLite or ONNX Runtime) is chosen by AIPOSE_INFERENCE_BACKEND.
+        # With AIPOSE_POSE_CASCADE, Lightning runs first and Thunder only when needed.
+        self.backend = backend or get_backend('lightning')
+        self.cascade = cascade or (default_cascade() if backend is None else None)
 
     @staticmethod
     def calculate_angle(point1, point2, point3):
-        a = np.array([point1[0] - point2[0], point1[1] - point2[1]])
-        b = np.array([point3[0] - point2[0], point3[1] - point2[1]])
-        dot_product = np.dot(a, b)
-        magnitude_a = np.linalg.norm(a)
-        magnitude_b = np.linalg.norm(b)
-        angle = np.arccos(dot_product / (magnitude_a * magnitude_b))
+        # Works on single (y, x) points or on (..., 2) arrays of points
+        point1, point2, point3 = np.asarray(point1), np.asarray(point2), np.asarray(point3)
+        a = point1[..., :2] - point2[..., :2]
+        b = point3[..., :2] - point2[..., :2]
+        dot_product = np.sum(a * b, axis=-1)
+        magnitude_a = np.sqrt(np.sum(a * a, axis=-1))
+        magnitude_b = np.sqrt(np.sum(b * b, axis=-1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            angle = np.arccos(dot_product / (magnitude_a * magnitude_b))
         return np.degrees(angle)
 
     @staticmethod
     def calculate_horizontal_angle(point1, point2):
-        vector = np.array([point2[0] - point1[0], point2[1] - point1[1]])
-        horizontal = np.array([1, 0])
-        dot_product = np.dot(vector, horizontal)
-        magnitude_vector = np.linalg.norm(vector)
-        angle = np.arccos(dot_product / magnitude_vector)
+        point1, point2 = np.asarray(point1), np.asarray(point2)
+        vector = point2[..., :2] - point1[..., :2]
+        magnitude_vector = np.sqrt(np.sum(vector * vector, axis=-1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            angle = np.arccos(vector[..., 0] / magnitude_vector)
         return np.degrees(angle) - 90
 
-    @staticmethod
-    def preprocess_image(image_path):
-        try:
-            image = tf.io.read_file(image_path)
-            image = tf.image.decode_jpeg(image)
-            image = tf.image.convert_image_dtype(image, dtype=tf.float32)
-        except tf.errors.InvalidArgumentError:
-            raise ValueError("Invalid image file. Please check the image path and format.")
-        
-        image = tf.image.resize_with_pad(image, target_height=192, target_width=192)
-        image = tf.image.adjust_contrast(image, 300.0)
-        image = tf.cast(image, dtype=tf.int32)
-        return tf.expand_dims(image, axis=0)
-
-    def analyze_pose(self, image_path):
-        image = self.preprocess_image(image_path)
-
-        outputs = self.movenet(image)
-        keypoints_with_scores = outputs['output_0'].numpy()[0, 0]
-
-        keypoints = keypoints_with_scores[:, :2]
+    # AIPOSE_PREPROCESSING picks the implementation, see default_preprocessing() in aipose/preprocessing.py
+    preprocess_image = staticmethod(preprocess_image)
+
+    def detect_keypoints(self, image_path, deadline=None):
+        if self.cascade is not None:
+            return self.cascade.run(image_path, self.required_keypoints, self.preprocess_image, deadline)
+        image = self.preprocess_image(image_path, self.backend.input_size)
+        return self.backend.run(image)[0, 0]
+
+    def analyze_pose(self, image_path, cache_key=None, deadline=None):
+        # With a cache_key, keypoints of a near-duplicate image from the same
+        # client are reused and only the rules run again. The deadline is
+        # checked before the cascade escalates.
+        keypoints_with_scores = reuse_or_run(cache_key, type(self).__name__, image_path,
+                                             lambda: self.detect_keypoints(image_path, deadline))
         scores = keypoints_with_scores[:, 2]
 
-        # List of indices for the keypoints of interest
-        keypoints_of_interest_indices = [0, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
+        results = self.analyze_keypoints(keypoints_with_scores[np.newaxis])[0]
+        return results, keypoints_with_scores, scores
+
+    @classmethod
+    def analyze_keypoints(cls, keypoints_with_scores):
+        # Evaluates the rules for a (people, 17, 3) array in one pass and
+        # returns the findings string of each person
+        keypoints = keypoints_with_scores[..., :2]
+        scores = keypoints_with_scores[..., 2]
 
         # Check confidence levels for the keypoints of interest
-        low_confidence_points = np.sum(scores[keypoints_of_interest_indices] < 0.2)
-        if low_confidence_points / len(keypoints_of_interest_indices) > 0.75:
-            return "Improper picture. Please take a better picture.", keypoints_with_scores, scores
-
-        nose = keypoints[0]
-        left_ear = keypoints[3]
-        right_ear = keypoints[4]
-        left_shoulder = keypoints[5]
-        right_shoulder = keypoints[6]
-        left_elbow = keypoints[7]
-        right_elbow = keypoints[8]
-        left_wrist = keypoints[9]
-        right_wrist = keypoints[10]
-
-        results = ""
+        low_confidence_points = np.sum(scores[:, cls.required_keypoints] < 0.2, axis=1)
+        improper = low_confidence_points / len(cls.required_keypoints) > 0.75
+
+        nose = keypoints[:, 0]
+        left_ear = keypoints[:, 3]
+        right_ear = keypoints[:, 4]
+        left_shoulder = keypoints[:, 5]
+        right_shoulder = keypoints[:, 6]
+        left_elbow = keypoints[:, 7]
+        right_elbow = keypoints[:, 8]
+        left_wrist = keypoints[:, 9]
+        right_wrist = keypoints[:, 10]
 
         # Determine facing direction by comparing the horizontal positions of the nose and ears
-        if abs(nose[0] - left_ear[0]) < abs(nose[0] - right_ear[0]):
-            facing_side = "left"
-            shoulder, elbow, wrist = right_shoulder, right_elbow, right_wrist
-        elif abs(nose[0] - left_ear[0]) > abs(nose[0] - right_ear[0]):
-            facing_side = "right"
-            shoulder, elbow, wrist = left_shoulder, left_elbow, left_wrist
-        else:
-            results += "Facing direction is ambiguous or frontal.\n"
-            facing_side = "ambiguous"
-
-        if facing_side != "ambiguous":
-            results += f"The {facing_side} side of the person is facing the camera.\n"
-            shoulder_elbow_wrist_angle = self.calculate_angle(shoulder, elbow, wrist)
-            
-            neck = (left_shoulder + right_shoulder) / 2
-            neck_angle = self.calculate_horizontal_angle(neck, nose)
-
-            if shoulder_elbow_wrist_angle < 90:
-                results += "The desk is too high.\n"
-            elif shoulder_elbow_wrist_angle > 120:
-                results += "Table too low.\n"
-            else:
-                results += "Correct table height.\n"
-
-            shoulder_wrist_distance = np.linalg.norm(np.array(shoulder) - np.array(wrist))
-            body_tolerance = 0.15  # Adjust this value as needed
-            if shoulder_wrist_distance > body_tolerance:
-                results += "Table too far.\n"
-            elif shoulder_wrist_distance < body_tolerance / 2:
-                results += "Table too close.\n"
+        facing_left = np.abs(nose[:, 0] - left_ear[:, 0]) < np.abs(nose[:, 0] - right_ear[:, 0])
+        facing_right = np.abs(nose[:, 0] - left_ear[:, 0]) > np.abs(nose[:, 0] - right_ear[:, 0])
+        ambiguous = ~(facing_left | facing_right)
+
+        side = facing_left[:, np.newaxis]
+        shoulder = np.where(side, right_shoulder, left_shoulder)
+        elbow = np.where(side, right_elbow, left_elbow)
+        wrist = np.where(side, right_wrist, left_wrist)
+
+        shoulder_elbow_wrist_angle = cls.calculate_angle(shoulder, elbow, wrist)
+        neck = (left_shoulder + right_shoulder) / 2
+        neck_angle = cls.calculate_horizontal_angle(neck, nose)
+        shoulder_wrist_distance = np.sqrt(np.sum((shoulder - wrist) ** 2, axis=1))
+        body_tolerance = 0.15  # Adjust this value as needed
+        shoulder_hip_angle = cls.calculate_angle(left_shoulder, (left_shoulder + right_shoulder) / 2, right_shoulder)
+
+        facing = np.where(facing_left, "The left side of the person is facing the camera.\n",
+                          "The right side of the person is facing the camera.\n")
+        table_height = np.where(shoulder_elbow_wrist_angle < 90, "The desk is too high.\n",
+                                np.where(shoulder_elbow_wrist_angle > 120, "Table too low.\n", "Correct table height.\n"))
+        table_distance = np.where(shoulder_wrist_distance > body_tolerance, "Table too far.\n",
+                                  np.where(shoulder_wrist_distance < body_tolerance / 2, "Table too close.\n",
+                                           "Table at a good distance.\n"))
+        neck_position = np.where(neck_angle > 5, "Looking upwards.\n",
+                                 np.where(neck_angle < -5, "Looking downwards.\n", "Good neck position.\n"))
+        # Arm and Wrist Position
+        arm = np.where(np.abs(wrist[:, 1] - elbow[:, 1]) > 0.1,
+                       np.where(wrist[:, 1] > elbow[:, 1], "Wrist higher than elbow.\n", "Wrist lower than elbow.\n"),
+                       "")
+        # Back Position
+        back = np.where(shoulder_hip_angle < 160, "Back is not straight.\n", "Back is straight.\n")
+        # Overall Balance
+        balance = np.where(np.abs(left_shoulder[:, 1] - right_shoulder[:, 1]) > 0.1,
+                           np.where(left_shoulder[:, 1] > right_shoulder[:, 1], "Leaning to the right.\n", "Leaning to the left.\n"),
+                           "Body is well balanced.\n")
+
+        results = []
+        for i in range(len(keypoints_with_scores)):
+            if improper[i]:
+                results.append("Improper picture. Please take a better picture.")
+            elif ambiguous[i]:
+                results.append("Facing direction is ambiguous or frontal.\n")
             else:
-                results += "Table at a good distance.\n"
-
-            if neck_angle > 5:
-                results += "Looking upwards.\n"
-            elif neck_angle < -5:
-                results += "Looking downwards.\n"
-            else:
-                results += "Good neck position.\n"
-
-            # Arm and Wrist Position
-            if abs(wrist[1] - elbow[1]) > 0.1:
-                if wrist[1] > elbow[1]:
-                    results += "Wrist higher than elbow.\n"
-                else:
-                    results += "Wrist lower than elbow.\n"
-
-            # Back Position
-            shoulder_hip_angle = self.calculate_angle(left_shoulder, (left_shoulder + right_shoulder) / 2, right_shoulder)
-            if shoulder_hip_angle < 160:
-                results += "Back is not straight.\n"
-            else:
-                results += "Back is straight.\n"
-
-            # Overall Balance
-            if abs(left_shoulder[1] - right_shoulder[1]) > 0.1:
-                if left_shoulder[1] > right_shoulder[1]:
-                    results += "Leaning to the right.\n"
-                else:
-                    results += "Leaning to the left.\n"
-            else:
-                results += "Body is well balanced.\n"
-
-        return results, keypoints_with_scores, scores
+                results.append(str(facing[i] + table_height[i] + table_distance[i] + neck_position[i]
+                                   + arm[i] + back[i] + balance[i]))
+        return results
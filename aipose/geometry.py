@@ -0,0 +1,27 @@
+import numpy as np
+
+
+def padding_for(width, height, input_size=192):
+    # Mirrors tf.image.resize_with_pad: scale to fit, then center with zero padding
+    scale = max(width / input_size, height / input_size)
+    pad_y = np.floor((input_size - height / scale) / 2)
+    pad_x = np.floor((input_size - width / scale) / 2)
+    return scale, pad_y, pad_x
+
+
+def keypoints_to_image(keypoints, width, height, input_size=192):
+    # MoveNet returns (y, x) normalized to the padded model input, this gives
+    # (y, x) in pixels of the original image
+    scale, pad_y, pad_x = padding_for(width, height, input_size)
+    y = (keypoints[..., 0] * input_size - pad_y) * scale
+    x = (keypoints[..., 1] * input_size - pad_x) * scale
+    return np.stack([y, x], axis=-1)
+
+
+def box_iou(a, b):
+    # Boxes are (x0, y0, x1, y1)
+    ix = max(0, min(a[2], b[2]) - max(a[0], b[0]))
+    iy = max(0, min(a[3], b[3]) - max(a[1], b[1]))
+    intersection = ix * iy
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
@@ -0,0 +1,92 @@
+import numpy as np
+from PIL import Image as PILImage
+
+from .backends import get_backend
+from .geometry import box_iou, keypoints_to_image
+from .handpose import HandPoseAnalyzer
+from .phash import reuse_or_run
+from .preprocessing import preprocess_image
+
+# MoveNet (elbow, wrist) keypoint indices per arm
+ARMS = ((7, 9), (8, 10))
+
+
+def hand_rois(keypoints_with_scores, width, height, input_size=192, min_score=0.2):
+    # Square boxes (x0, y0, x1, y1) in pixels around each confidently detected
+    # wrist. The box is pushed along the forearm, because the hand extends
+    # past the wrist, and sized from the forearm length.
+    points = keypoints_to_image(keypoints_with_scores[:, :2], width, height, input_size)
+    scores = keypoints_with_scores[:, 2]
+    fallback_side = 0.25 * min(width, height)
+
+    boxes = []
+    for elbow, wrist in ARMS:
+        if scores[wrist] < min_score:
+            continue
+        wrist_y, wrist_x = points[wrist]
+        if scores[elbow] >= min_score:
+            forearm = points[wrist] - points[elbow]
+            forearm_length = float(np.linalg.norm(forearm))
+            center_y, center_x = points[wrist] + 0.4 * forearm
+            side = max(1.2 * forearm_length, 0.1 * min(width, height))
+        else:
+            center_y, center_x = wrist_y, wrist_x
+            side = fallback_side
+        boxes.append(clamp_box(center_x - side / 2, center_y - side / 2,
+                               center_x + side / 2, center_y + side / 2, width, height))
+
+    # Hands close together (e.g. both on the keyboard) are cropped once
+    if len(boxes) == 2 and box_iou(boxes[0], boxes[1]) > 0.3:
+        a, b = boxes
+        boxes = [(min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))]
+    return [box for box in boxes if box[2] - box[0] > 1 and box[3] - box[1] > 1]
+
+
+def clamp_box(x0, y0, x1, y1, width, height):
+    return (int(max(0, x0)), int(max(0, y0)), int(min(width, x1)), int(min(height, y1)))
+
+
+def crop_landmarks_to_image(landmarks, box, width, height):
+    # Hand landmarks are normalized to the crop, map them back to the full
+    # image so the rule thresholds mean the same thing as in full-frame mode
+    x0, y0, x1, y1 = box
+    mapped = landmarks.copy()
+    mapped[..., 0] = (landmarks[..., 0] * (x1 - x0) + x0) / width
+    mapped[..., 1] = (landmarks[..., 1] * (y1 - y0) + y0) / height
+    # z uses roughly the same scale as x
+    mapped[..., 2] = landmarks[..., 2] * (x1 - x0) / width
+    return mapped
+
+
+class HandCropAnalyzer:
+    # Two-stage hand analysis: MoveNet finds the wrists on the downscaled
+    # image, then the hand landmarker only runs on small crops around them
+
+    def __init__(self, hand_analyzer=None, backend=None):
+        self.hand_analyzer = hand_analyzer or HandPoseAnalyzer()
+        self.backend = backend or get_backend('lightning')
+
+    def detect_landmarks(self, image_path):
+        image = PILImage.open(image_path).convert('RGB')
+        width, height = image.size
+
+        keypoints_with_scores = self.backend.run(
+            preprocess_image(image_path, self.backend.input_size))[0, 0]
+        boxes = hand_rois(keypoints_with_scores, width, height, self.backend.input_size)
+
+        # detect_landmarks reports hands like HandPoseAnalyzer does in full-frame mode
+        hands = []
+        for box in boxes:
+            landmarks = self.hand_analyzer.detect_landmarks(np.asarray(image.crop(box)))
+            hands.extend(crop_landmarks_to_image(landmarks, box, width, height))
+
+        if not hands:
+            # No wrists found or no hand inside the crops, fall back to the full frame
+            return self.hand_analyzer.detect_landmarks(np.asarray(image))
+        return np.array(hands)
+
+    def analyze_hand_pose(self, image_path, cache_key=None):
+        landmarks = reuse_or_run(cache_key, type(self).__name__, image_path, lambda: self.detect_landmarks(image_path))
+        if len(landmarks) == 0:
+            return "No hands detected. Please take another picture."
+        return self.hand_analyzer.evaluate_hands(landmarks)
@@ -1,9 +1,17 @@
-import requests
-import mediapipe as mp
-from mediapipe.tasks import python
-from mediapipe.tasks.python import vision
+import os
+import threading
+
 import numpy as np
 
+from .phash import reuse_or_run
+
+RUNNING_MODES = ('IMAGE', 'VIDEO', 'LIVE_STREAM')
+
+# IMAGE mode detectors are stateless, so one per process is shared by every analyzer
+_image_detector = None
+_image_detector_lock = threading.Lock()
+
+
 class HandPoseAnalyzer:
     landmark_names = [
         "WRIST", "THUMB_CMC", "THUMB_MCP", "THUMB_IP", "THUMB_TIP",
@@ -13,20 +21,61 @@ class HandPoseAnalyzer:
         "PINKY_MCP", "PINKY_PIP", "PINKY_DIP", "PINKY_TIP"
     ]
 
-    def __init__(self):
-        self.model_url = 'https://storage.googleapis.com/mediapipe-models/hand_landmarker/hand_landmarker/float16/1/hand_landmarker.task'
-        self.model_path = 'hand_landmarker.task'
+    # Tips of index, middle, ring, and pinky
+    finger_tips = [8, 12, 16, 20]
+
+    model_url = 'https://storage.googleapis.com/mediapipe-models/hand_landmarker/hand_landmarker/float16/1/hand_landmarker.task'
+    model_path = 'hand_landmarker.task'
+
+    def __init__(self, running_mode='IMAGE', result_callback=None):
+        # VIDEO and LIVE_STREAM detectors track hands across frames, so each
+        # analyzer owns one. Keep the analyzer alive for the whole sequence.
+        if running_mode not in RUNNING_MODES:
+            raise ValueError(f"Unknown running mode '{running_mode}'.")
+        if running_mode == 'LIVE_STREAM' and result_callback is None:
+            raise ValueError("LIVE_STREAM mode requires a result_callback.")
+        self.running_mode = running_mode
+        self.result_callback = result_callback
         self.download_model(self.model_url, self.model_path)
         self.setup_detector()
 
     def setup_detector(self):
+        global _image_detector
+
+        if self.running_mode == 'IMAGE':
+            if _image_detector is None:
+                with _image_detector_lock:
+                    if _image_detector is None:
+                        _image_detector = self.create_detector()
+            self.detector = _image_detector
+            self.detector_lock = _image_detector_lock
+        else:
+            self.detector = self.create_detector()
+            self.detector_lock = threading.Lock()
+
+    def create_detector(self):
+        # mediapipe is imported on first use so loading this module stays cheap
+        from mediapipe.tasks import python
+        from mediapipe.tasks.python import vision
+
         # Setup the hand landmark detector with the model file
         base_options = python.BaseOptions(model_asset_path=self.model_path)
-        self.options = vision.HandLandmarkerOptions(base_options=base_options, num_hands=2)
-        self.detector = vision.HandLandmarker.create_from_options(self.options)
+        options = {}
+        if self.running_mode == 'LIVE_STREAM':
+            options['result_callback'] = self.on_live_stream_result
+        self.options = vision.HandLandmarkerOptions(
+            base_options=base_options, num_hands=2,
+            running_mode=getattr(vision.RunningMode, self.running_mode), **options
+        )
+        return vision.HandLandmarker.create_from_options(self.options)
 
     def download_model(self, url, save_path):
         # Download the model file if it's not already present
+        if os.path.exists(save_path):
+            return
+
+        import requests
+
         try:
             response = requests.get(url)
             if response.status_code == 200:
@@ -38,80 +87,139 @@ class HandPoseAnalyzer:
         except Exception as e:
             print(f"An error occurred while downloading the model: {e}")
 
-    def analyze_hand_pose(self, image_path):
-        # Load the input image and detect hand landmarks
-        image = mp.Image.create_from_file(image_path)
-        detection_result = self.detector.detect(image)
-        if not detection_result.hand_landmarks:
+    @staticmethod
+    def to_mp_image(image):
+        # Accepts a file path, a PIL image, an RGB uint8 array or an mp.Image
+        import mediapipe as mp
+
+        if isinstance(image, mp.Image):
+            return image
+        if isinstance(image, (str, os.PathLike)):
+            return mp.Image.create_from_file(os.fspath(image))
+        frame = np.asarray(image.convert('RGB') if hasattr(image, 'convert') else image)
+        return mp.Image(image_format=mp.ImageFormat.SRGB, data=np.ascontiguousarray(frame, dtype=np.uint8))
+
+    def detect(self, image):
+        image = self.to_mp_image(image)
+        with self.detector_lock:
+            return self.detector.detect(image)
+
+    def detect_landmarks(self, image):
+        # Landmarks of every hand, repeated once per handedness category as in get_landmarks_string
+        detection_result = self.detect(image)
+        return self.landmarks_to_array(detection_result)[self.hand_indices(detection_result)]
+
+    def analyze_hand_pose(self, image, cache_key=None):
+        # Load the input image and detect hand landmarks. With a cache_key, the
+        # landmarks of a near-duplicate image from the same client are reused.
+        landmarks = reuse_or_run(cache_key, type(self).__name__, image, lambda: self.detect_landmarks(image))
+        if len(landmarks) == 0:
             return "No hands detected. Please take another picture."
-        
-        return self.get_landmarks_string(detection_result)
 
-    def get_landmarks_string(self, detection_result):
-        results = ""
-        for i, handedness_list in enumerate(detection_result.handedness):
-            for handedness in handedness_list:
-                # Analyze hand pose
-                landmarks = detection_result.hand_landmarks[i]
-                results += self.analyze_hand_bend(landmarks)
-                results += self.analyze_wrist_flexion(landmarks)
-                results += self.analyze_claw_grip(landmarks)
-                results += self.analyze_finger_extension(landmarks)
+        return self.evaluate_hands(landmarks)
+
+    def analyze_frames(self, frames, timestamps_ms=None, fps=30):
+        # Runs a frame sequence through one VIDEO mode detector, which tracks the
+        # hands between frames instead of running palm detection every time
+        if self.running_mode != 'VIDEO':
+            raise ValueError("analyze_frames requires a VIDEO mode analyzer.")
+        results = []
+        for i, frame in enumerate(frames):
+            timestamp_ms = timestamps_ms[i] if timestamps_ms is not None else int(i * 1000 / fps)
+            with self.detector_lock:
+                detection_result = self.detector.detect_for_video(self.to_mp_image(frame), timestamp_ms)
+            if not detection_result.hand_landmarks:
+                results.append("No hands detected. Please take another picture.")
+            else:
+                results.append(self.get_landmarks_string(detection_result))
         return results
 
-    def analyze_hand_bend(self, landmarks):
-        wrist = landmarks[0]
-        middle_mcp = landmarks[9]
-        middle_tip = landmarks[12]
+    def submit_frame(self, frame, timestamp_ms):
+        # LIVE_STREAM mode: results are delivered to result_callback(results, landmarks, timestamp_ms)
+        if self.running_mode != 'LIVE_STREAM':
+            raise ValueError("submit_frame requires a LIVE_STREAM mode analyzer.")
+        self.detector.detect_async(self.to_mp_image(frame), timestamp_ms)
 
-        if middle_tip.y < middle_mcp.y and middle_tip.y < wrist.y:
-            return "  Hand is bent inwards.\n"
-        elif middle_tip.y > middle_mcp.y and middle_tip.y > wrist.y:
-            return "  Hand is bent outwards.\n"
+    def on_live_stream_result(self, detection_result, output_image, timestamp_ms):
+        if not detection_result.hand_landmarks:
+            results = "No hands detected. Please take another picture."
         else:
-            return "  Hand is not bent inwards or outwards.\n"
+            results = self.get_landmarks_string(detection_result)
+        self.result_callback(results, self.landmarks_to_array(detection_result), timestamp_ms)
 
-    def analyze_wrist_flexion(self, landmarks):
-        wrist = landmarks[0]
-        index_mcp = landmarks[5]
-        pinky_mcp = landmarks[17]
+    @staticmethod
+    def landmarks_to_array(detection_result):
+        # One (hands, 21, 3) array of normalized x, y, z per detection
+        if not detection_result.hand_landmarks:
+            return np.zeros((0, 21, 3))
+        return np.array([[(lm.x, lm.y, lm.z) for lm in hand] for hand in detection_result.hand_landmarks],
+                        dtype=np.float64)
 
-        if index_mcp.y < wrist.y and pinky_mcp.y < wrist.y:
-            return "  Wrist is flexed upwards.\n"
-        elif index_mcp.y > wrist.y and pinky_mcp.y > wrist.y:
-            return "  Wrist is flexed downwards.\n"
-        else:
-            return "  Wrist is not flexed upwards or downwards.\n"
+    @staticmethod
+    def hand_indices(detection_result):
+        # Each hand is reported once per handedness category, as before
+        return [i for i, handedness_list in enumerate(detection_result.handedness)
+                for _ in handedness_list]
 
-    def analyze_claw_grip(self, landmarks):
+    def get_landmarks_string(self, detection_result):
+        landmarks = self.landmarks_to_array(detection_result)
+        return self.evaluate_hands(landmarks[self.hand_indices(detection_result)])
+
+    def evaluate_hands(self, landmarks):
+        # Evaluates every rule for all hands at once and joins the findings per hand
+        if len(landmarks) == 0:
+            return ""
+        findings = np.stack([
+            self.analyze_hand_bend(landmarks),
+            self.analyze_wrist_flexion(landmarks),
+            self.analyze_claw_grip(landmarks),
+            self.analyze_finger_extension(landmarks),
+        ], axis=1)
+        return "".join("".join(hand) for hand in findings)
+
+    @staticmethod
+    def analyze_hand_bend(landmarks):
+        wrist = landmarks[:, 0, 1]
+        middle_mcp = landmarks[:, 9, 1]
+        middle_tip = landmarks[:, 12, 1]
+
+        return np.where((middle_tip < middle_mcp) & (middle_tip < wrist), "  Hand is bent inwards.\n",
+                        np.where((middle_tip > middle_mcp) & (middle_tip > wrist), "  Hand is bent outwards.\n",
+                                 "  Hand is not bent inwards or outwards.\n"))
+
+    @staticmethod
+    def analyze_wrist_flexion(landmarks):
+        wrist = landmarks[:, 0, 1]
+        index_mcp = landmarks[:, 5, 1]
+        pinky_mcp = landmarks[:, 17, 1]
+
+        return np.where((index_mcp < wrist) & (pinky_mcp < wrist), "  Wrist is flexed upwards.\n",
+                        np.where((index_mcp > wrist) & (pinky_mcp > wrist), "  Wrist is flexed downwards.\n",
+                                 "  Wrist is not flexed upwards or downwards.\n"))
+
+    @classmethod
+    def analyze_claw_grip(cls, landmarks):
         threshold = 0.1
-        bent_fingers = 0
-        for tip_index in [8, 12, 16, 20]:  # Tips of index, middle, ring, and pinky
-            if np.linalg.norm(np.array([landmarks[tip_index].x, landmarks[tip_index].y]) - 
-                              np.array([landmarks[tip_index - 2].x, landmarks[tip_index - 2].y])) < threshold:
-                bent_fingers += 1
-
-        if bent_fingers >= 3:
-            return "  Claw grip detected.\n"
-        else:
-            return "  Claw grip not detected.\n"
+        tips = landmarks[:, cls.finger_tips, :2]
+        pip_joints = landmarks[:, [tip - 2 for tip in cls.finger_tips], :2]
+        bent_fingers = np.sum(np.linalg.norm(tips - pip_joints, axis=2) < threshold, axis=1)
 
-    def analyze_finger_extension(self, landmarks):
-        extended_fingers = 0
-        for tip_index in [8, 12, 16, 20]:  # Tips of index, middle, ring, and pinky
-            pip_joint = landmarks[tip_index - 2]
-            dip_joint = landmarks[tip_index - 1]
-            tip = landmarks[tip_index]
+        return np.where(bent_fingers >= 3, "  Claw grip detected.\n", "  Claw grip not detected.\n")
 
-            if tip.y < dip_joint.y < pip_joint.y:
-                extended_fingers += 1
+    @classmethod
+    def analyze_finger_extension(cls, landmarks):
+        tips = landmarks[:, cls.finger_tips, 1]
+        dip_joints = landmarks[:, [tip - 1 for tip in cls.finger_tips], 1]
+        pip_joints = landmarks[:, [tip - 2 for tip in cls.finger_tips], 1]
+        extended_fingers = np.sum((tips < dip_joints) & (dip_joints < pip_joints), axis=1)
 
-        if extended_fingers >= 3:
-            return "  Fingers are extended.\n"
-        else:
-            return "  Fingers are not extended.\n"
+        return np.where(extended_fingers >= 3, "  Fingers are extended.\n", "  Fingers are not extended.\n")
 
 # Example usage:
 # hand_pose_analyzer = HandPoseAnalyzer()
 # results = hand_pose_analyzer.analyze_hand_pose("aipose/hand_input.jpg")
 # print(results)
+#
+# Frame sequences, with one detector tracking hands across frames:
+# video_analyzer = HandPoseAnalyzer(running_mode='VIDEO')
+# results = video_analyzer.analyze_frames(frames, fps=30)
@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from aipose.models import Image
+from aipose.writebehind import WriteBehindBuffer
+
+# SQLite's own defaults, for the baseline
+DEFAULT_PRAGMAS = {'journal_mode': 'DELETE', 'busy_timeout': 5000, 'synchronous': 'FULL'}
+
+
+class Command(BaseCommand):
+    help = "Measure Image row write throughput with direct saves and with the write-behind buffer, on a scratch SQLite database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--rows', type=int, default=200, help="Rows written by each thread.")
+        parser.add_argument('--max-rows', type=int, default=getattr(settings, 'AIPOSE_WRITE_BEHIND_MAX_ROWS', 50))
+
+    def handle(self, *args, **options):
+        scratch = tempfile.mkdtemp(prefix='aipose-bench-writes-')
+        original = dict(connections.databases['default'])
+        original_pragmas = getattr(settings, 'AIPOSE_SQLITE_PRAGMAS', {})
+        try:
+            self.stdout.write(f"{'pragmas':<10}{'mode':<14}{'rows/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+            for pragma_name, pragmas in (('default', DEFAULT_PRAGMAS), ('tuned', original_pragmas)):
+                for mode in ('direct', 'write-behind'):
+                    database = os.path.join(scratch, f'{pragma_name}-{mode}.sqlite3')
+                    self.use_database(database, pragmas)
+                    call_command('migrate', verbosity=0)
+                    self.run(pragma_name, mode, scratch, options)
+        finally:
+            connections.close_all()
+            connections.databases['default'] = original
+            connections['default'].settings_dict = original
+            settings.AIPOSE_SQLITE_PRAGMAS = original_pragmas
+            shutil.rmtree(scratch)
+
+    def use_database(self, path, pragmas):
+        connections.close_all()
+        connections.databases['default']['NAME'] = path
+        connections['default'].settings_dict['NAME'] = path
+        settings.AIPOSE_SQLITE_PRAGMAS = pragmas
+
+    def run(self, pragma_name, mode, scratch, options):
+        buffer = None
+        if mode == 'write-behind':
+            buffer = WriteBehindBuffer(os.path.join(scratch, f'{pragma_name}-write-behind'),
+                                       max_rows=options['max_rows'])
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+
+        def writer(thread):
+            mine = []
+            for i in range(options['rows']):
+                fields = {'title': f'bench {thread}-{i}', 'image_file': f'images/bench_{thread}_{i}.jpg',
+                          'analysis': {'pose_analysis': ['Good posture']}}
+                start = time.perf_counter()
+                try:
+                    if buffer is not None:
+                        buffer.add(**fields)
+                    else:
+                        Image.objects.create(**fields)
+                except Exception as e:
+                    with lock:
+                        errors.append(e)
+                mine.append(time.perf_counter() - start)
+            connections.close_all()
+            with lock:
+                latencies.extend(mine)
+
+        threads = [threading.Thread(target=writer, args=(t,)) for t in range(options['threads'])]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if buffer is not None:
+            buffer.close()
+        elapsed = time.perf_counter() - start
+
+        written = Image.objects.count()
+        self.stdout.write(f"{pragma_name:<10}{mode:<14}{written / elapsed:>10.0f}"
+                          f"{np.percentile(latencies, 50) * 1000:>10.2f}{np.percentile(latencies, 99) * 1000:>10.2f}"
+                          f"{len(errors):>8}")
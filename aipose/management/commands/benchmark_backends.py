@@ -0,0 +1,87 @@
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from aipose.backends import BACKENDS
+
+
+class Command(BaseCommand):
+    help = "Benchmark MoveNet inference backends: import time, model load time, latency and peak RSS."
+
+    def add_arguments(self, parser):
+        parser.add_argument('images', nargs='*', default=[str(settings.BASE_DIR / 'aipose' / 'input.jpg')])
+        parser.add_argument('--backends', nargs='+', default=sorted(BACKENDS), choices=sorted(BACKENDS))
+        parser.add_argument('--model', default='lightning')
+        parser.add_argument('--threads', type=int, default=None)
+        parser.add_argument('--repeat', type=int, default=50)
+        parser.add_argument('--warmup', type=int, default=5)
+        parser.add_argument('--worker', default=None, help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['worker']:
+            self.stdout.write(json.dumps(self.run_worker(options['worker'], options)))
+            return
+
+        # Each backend runs in a fresh interpreter so import time and RSS are not shared
+        self.stdout.write(f"{'backend':<12}{'import s':>10}{'load s':>10}{'p50 ms':>10}{'p95 ms':>10}{'max RSS MB':>12}")
+        for name in options['backends']:
+            command = [sys.executable, str(settings.BASE_DIR / 'manage.py'), 'benchmark_backends',
+                       '--worker', name, '--model', options['model'],
+                       '--repeat', str(options['repeat']), '--warmup', str(options['warmup']),
+                       *options['images']]
+            if options['threads']:
+                command += ['--threads', str(options['threads'])]
+            completed = subprocess.run(command, capture_output=True, text=True)
+            if completed.returncode != 0:
+                self.stdout.write(self.style.WARNING(f"{name:<12}failed: {completed.stderr.strip().splitlines()[-1:]}"))
+                continue
+            result = json.loads(completed.stdout.strip().splitlines()[-1])
+            self.stdout.write(
+                f"{name:<12}{result['import_s']:>10.2f}{result['load_s']:>10.2f}"
+                f"{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}{result['max_rss_mb']:>12.0f}"
+            )
+
+    def run_worker(self, name, options):
+        from aipose.backends import create_backend
+
+        start = time.perf_counter()
+        if name == 'onnx':
+            import onnxruntime  # noqa: F401
+        else:
+            try:
+                import tflite_runtime.interpreter  # noqa: F401
+            except ImportError:
+                import tensorflow  # noqa: F401
+        import_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        backend = create_backend(options['model'], name, num_threads=options['threads'])
+        load_s = time.perf_counter() - start
+
+        from aipose.preprocessing import preprocess_image
+        images = [np.asarray(preprocess_image(path, backend.input_size)) for path in options['images']]
+
+        for i in range(options['warmup']):
+            backend.run(images[i % len(images)])
+        latencies = []
+        for i in range(options['repeat']):
+            start = time.perf_counter()
+            backend.run(images[i % len(images)])
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        return {
+            'backend': name,
+            'import_s': import_s,
+            'load_s': load_s,
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p95_ms': float(np.percentile(latencies, 95)),
+            # ru_maxrss is reported in kilobytes on Linux
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
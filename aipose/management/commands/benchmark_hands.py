@@ -0,0 +1,51 @@
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from PIL import Image as PILImage
+
+from aipose.handpose import HandPoseAnalyzer
+
+
+class Command(BaseCommand):
+    help = "Compare hand landmarking throughput: a detector per frame, a shared IMAGE detector and a VIDEO mode detector."
+
+    def add_arguments(self, parser):
+        parser.add_argument('images', nargs='*', default=[str(settings.BASE_DIR / 'aipose' / 'input.jpg')])
+        parser.add_argument('--frames', type=int, default=60)
+
+    def handle(self, *args, **options):
+        paths = [options['images'][i % len(options['images'])] for i in range(options['frames'])]
+        frames = [np.asarray(PILImage.open(path).convert('RGB')) for path in paths]
+
+        def per_frame_detector():
+            # What every request used to pay: a new landmarker and a disk reload per image
+            from mediapipe.tasks import python
+            from mediapipe.tasks.python import vision
+
+            analyzer = HandPoseAnalyzer()
+            for path in paths:
+                options = vision.HandLandmarkerOptions(
+                    base_options=python.BaseOptions(model_asset_path=analyzer.model_path), num_hands=2)
+                with vision.HandLandmarker.create_from_options(options) as detector:
+                    detector.detect(analyzer.to_mp_image(path))
+
+        def shared_image_detector():
+            analyzer = HandPoseAnalyzer()
+            for frame in frames:
+                analyzer.analyze_hand_pose(frame)
+
+        def video_detector():
+            HandPoseAnalyzer(running_mode='VIDEO').analyze_frames(frames)
+
+        # Warm up imports and the shared detector so only steady-state work is timed
+        HandPoseAnalyzer().analyze_hand_pose(frames[0])
+
+        for name, run in (('detector per frame', per_frame_detector),
+                          ('shared IMAGE detector', shared_image_detector),
+                          ('VIDEO mode detector', video_detector)):
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            self.stdout.write(f"{name:<24}{len(frames) / elapsed:>10.1f} frames/s{elapsed * 1000 / len(frames):>10.2f} ms/frame")
@@ -0,0 +1,43 @@
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from aipose.preprocessing import preprocess_batch, preprocess_image_np, preprocess_image_tf
+
+
+class Command(BaseCommand):
+    help = "Benchmark per-image MoveNet preprocessing with TensorFlow and with NumPy."
+
+    def add_arguments(self, parser):
+        parser.add_argument('images', nargs='*', default=[str(settings.BASE_DIR / 'aipose' / 'input.jpg')])
+        parser.add_argument('--size', type=int, default=192)
+        parser.add_argument('--repeat', type=int, default=100)
+        parser.add_argument('--skip-tensorflow', action='store_true')
+
+    def handle(self, *args, **options):
+        paths = [options['images'][i % len(options['images'])] for i in range(options['repeat'])]
+        size = options['size']
+
+        runs = [('numpy', lambda path: preprocess_image_np(path, size))]
+        if not options['skip_tensorflow']:
+            runs.insert(0, ('tensorflow', lambda path: preprocess_image_tf(path, size).numpy()))
+
+        for name, run in runs:
+            # The first call pays imports and kernel setup, keep it out of the timing
+            run(paths[0])
+            latencies = []
+            for path in paths:
+                start = time.perf_counter()
+                run(path)
+                latencies.append(time.perf_counter() - start)
+            self.stdout.write(f"{name:<20}{np.mean(latencies) * 1000:>10.2f} ms/image"
+                              f"{np.percentile(latencies, 95) * 1000:>10.2f} ms p95")
+
+        # The whole batch written in place into one preallocated buffer
+        buffer = np.empty((len(paths), size, size, 3), dtype=np.int32)
+        start = time.perf_counter()
+        preprocess_batch(paths, size, out=buffer)
+        per_image = (time.perf_counter() - start) / len(paths)
+        self.stdout.write(f"{'numpy into buffer':<20}{per_image * 1000:>10.2f} ms/image")
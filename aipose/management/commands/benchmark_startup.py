@@ -0,0 +1,119 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+IMPORT_SCRIPT = """
+import json, os, resource, sys, time
+start = time.perf_counter()
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'aipose.settings')
+import django
+django.setup()
+import aipose.urls
+from aipose.preload import preload
+preload(sys.argv[1] if sys.argv[1] != 'none' else None)
+print(json.dumps({
+    'seconds': time.perf_counter() - start,
+    'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    'modules': len(sys.modules),
+}))
+"""
+
+
+def read_smaps_rollup():
+    # Pss splits shared pages between the processes mapping them, so summing it
+    # over workers gives the real memory cost
+    fields = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    return {
+        'rss_mb': fields.get('Rss', 0.0),
+        'pss_mb': fields.get('Pss', 0.0),
+        'private_mb': fields.get('Private_Clean', 0.0) + fields.get('Private_Dirty', 0.0),
+    }
+
+
+class Command(BaseCommand):
+    help = "Measure startup time of the URLconf and per-worker memory with and without preloading ML dependencies."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--levels', nargs='+', default=['none', 'imports', 'models'],
+                            choices=['none', 'imports', 'models'])
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--fork-workers', default=None, help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['fork_workers']:
+            self.stdout.write(json.dumps(self.fork_workers(options['fork_workers'], options['workers'])))
+            return
+
+        env = dict(os.environ, PYTHONPATH=str(settings.BASE_DIR))
+        self.stdout.write(f"{'preload':<10}{'startup s':>10}{'wall s':>10}{'RSS MB':>10}{'modules':>10}"
+                          f"{'worker PSS MB':>15}{'worker private MB':>19}{'total PSS MB':>14}")
+        for level in options['levels']:
+            start = time.perf_counter()
+            completed = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT, level],
+                                       capture_output=True, text=True, env=env, cwd=settings.BASE_DIR)
+            wall = time.perf_counter() - start
+            if completed.returncode != 0:
+                self.stdout.write(self.style.WARNING(f"{level:<10}failed: {completed.stderr.strip().splitlines()[-1:]}"))
+                continue
+            startup = json.loads(completed.stdout.strip().splitlines()[-1])
+
+            completed = subprocess.run([sys.executable, str(settings.BASE_DIR / 'manage.py'), 'benchmark_startup',
+                                        '--fork-workers', level, '--workers', str(options['workers'])],
+                                       capture_output=True, text=True, env=env)
+            if completed.returncode != 0:
+                self.stdout.write(self.style.WARNING(f"{level:<10}workers failed: {completed.stderr.strip().splitlines()[-1:]}"))
+                continue
+            workers = json.loads(completed.stdout.strip().splitlines()[-1])
+
+            self.stdout.write(
+                f"{level:<10}{startup['seconds']:>10.2f}{wall:>10.2f}{startup['max_rss_mb']:>10.0f}{startup['modules']:>10}"
+                f"{workers['pss_mb']:>15.0f}{workers['private_mb']:>19.0f}{workers['total_pss_mb']:>14.0f}"
+            )
+
+    def fork_workers(self, level, count):
+        # Mimics gunicorn --preload: preload in the parent, then each forked
+        # worker serves its first inference and reports its memory
+        import numpy as np
+        from aipose.backends import get_backend
+        from aipose.preload import preload
+
+        preload(level if level != 'none' else None)
+
+        pipes = []
+        for _ in range(count):
+            read_fd, write_fd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(read_fd)
+                backend = get_backend('lightning')
+                backend.run(np.zeros((1, backend.input_size, backend.input_size, 3), dtype=np.int32))
+                os.write(write_fd, json.dumps(read_smaps_rollup()).encode())
+                os.close(write_fd)
+                # Stay alive until every worker has measured, so shared pages are counted as shared
+                time.sleep(2)
+                os._exit(0)
+            os.close(write_fd)
+            pipes.append((pid, read_fd))
+
+        results = []
+        for pid, read_fd in pipes:
+            with os.fdopen(read_fd) as f:
+                results.append(json.loads(f.read()))
+            os.waitpid(pid, 0)
+
+        return {
+            'pss_mb': sum(r['pss_mb'] for r in results) / count,
+            'private_mb': sum(r['private_mb'] for r in results) / count,
+            'total_pss_mb': sum(r['pss_mb'] for r in results) + read_smaps_rollup()['pss_mb'],
+        }
@@ -0,0 +1,61 @@
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from aipose.backends import BACKENDS, create_backend
+from aipose.bodypose import PoseAnalyzer
+from aipose.deskpose import DeskPoseAnalyzer
+from aipose.preprocessing import preprocess_image
+
+
+class Command(BaseCommand):
+    help = "Compare MoveNet keypoints and posture findings of each inference backend against a reference backend."
+
+    def add_arguments(self, parser):
+        parser.add_argument('images', nargs='*', default=[str(settings.BASE_DIR / 'aipose' / 'input.jpg')])
+        parser.add_argument('--reference', default='savedmodel', choices=sorted(BACKENDS))
+        parser.add_argument('--backends', nargs='+', default=['tflite', 'onnx'], choices=sorted(BACKENDS))
+        parser.add_argument('--model', default='lightning')
+        parser.add_argument('--score-threshold', type=float, default=0.3,
+                            help="Only keypoints both backends are confident about are compared.")
+        parser.add_argument('--tolerance', type=float, default=0.02,
+                            help="Maximum allowed keypoint distance in normalized image coordinates.")
+
+    def handle(self, *args, **options):
+        reference = create_backend(options['model'], options['reference'])
+        failed = False
+        for name in options['backends']:
+            try:
+                candidate = create_backend(options['model'], name)
+            except (ImportError, RuntimeError) as e:
+                self.stdout.write(self.style.WARNING(f"{name}: skipped ({e})"))
+                continue
+            for image_path in options['images']:
+                ok = self.compare(reference, candidate, image_path, options)
+                failed = failed or not ok
+        if failed:
+            raise CommandError("Backend parity check failed.")
+
+    def compare(self, reference, candidate, image_path, options):
+        image = preprocess_image(image_path, reference.input_size)
+        expected = reference.run(image)[0, 0]
+        actual = candidate.run(image)[0, 0]
+
+        confident = (expected[:, 2] > options['score_threshold']) & (actual[:, 2] > options['score_threshold'])
+        distances = np.linalg.norm(expected[:, :2] - actual[:, :2], axis=1)
+        max_distance = float(distances[confident].max()) if confident.any() else 0.0
+        max_score_diff = float(np.abs(expected[:, 2] - actual[:, 2]).max())
+
+        # The findings are what clients see, so they have to agree too
+        same_findings = all(
+            analyzer_class(reference).analyze_pose(image_path)[0] == analyzer_class(candidate).analyze_pose(image_path)[0]
+            for analyzer_class in (PoseAnalyzer, DeskPoseAnalyzer)
+        )
+        ok = max_distance <= options['tolerance'] and same_findings
+        style = self.style.SUCCESS if ok else self.style.ERROR
+        self.stdout.write(style(
+            f"{candidate.name} vs {reference.name} on {image_path}: "
+            f"max keypoint distance {max_distance:.4f} over {int(confident.sum())} keypoints, "
+            f"max score diff {max_score_diff:.3f}, findings {'match' if same_findings else 'differ'}"
+        ))
+        return ok
@@ -0,0 +1,56 @@
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from aipose.preprocessing import DECODERS, preprocess_image_np, preprocess_image_tf, simplejpeg
+
+
+class Command(BaseCommand):
+    help = ("Check that the NumPy preprocessing path matches the TensorFlow one, with each JPEG decoder. "
+            "simplejpeg must match within --max-abs-diff, Pillow within --pillow-max-abs-diff.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('images', nargs='*', default=[str(settings.BASE_DIR / 'aipose' / 'input.jpg')])
+        parser.add_argument('--sizes', nargs='+', type=int, default=[192, 256])
+        parser.add_argument('--decoders', nargs='+', choices=DECODERS,
+                            help="Defaults to every installed decoder.")
+        parser.add_argument('--max-abs-diff', type=int, default=1,
+                            help="Float32 summation order can move a value across an integer boundary.")
+        parser.add_argument('--max-mismatch-fraction', type=float, default=0.001)
+        parser.add_argument('--pillow-max-abs-diff', type=int, default=6,
+                            help="Pillow's accurate DCT is a level or two off libjpeg's fast one, the "
+                                 "contrast stretch amplifies that. Most values differ, only the bound is checked.")
+
+    def handle(self, *args, **options):
+        decoders = options['decoders'] or [decoder for decoder in DECODERS
+                                           if decoder != 'simplejpeg' or simplejpeg is not None]
+        if 'simplejpeg' in decoders and simplejpeg is None:
+            raise CommandError("simplejpeg is not installed.")
+
+        failed = False
+        for image_path in options['images']:
+            for size in options['sizes']:
+                expected = preprocess_image_tf(image_path, size).numpy()
+                for decoder in decoders:
+                    actual = preprocess_image_np(image_path, size, decoder=decoder)
+                    label = f"{image_path} @ {size} ({decoder})"
+
+                    if expected.shape != actual.shape:
+                        self.stdout.write(self.style.ERROR(f"{label}: shape {actual.shape} != {expected.shape}"))
+                        failed = True
+                        continue
+
+                    diff = np.abs(expected.astype(np.int64) - actual)
+                    mismatch_fraction = float(np.mean(diff > 0))
+                    if decoder == 'pillow':
+                        ok = diff.max() <= options['pillow_max_abs_diff']
+                    else:
+                        ok = (diff.max() <= options['max_abs_diff']
+                              and mismatch_fraction <= options['max_mismatch_fraction'])
+                    failed = failed or not ok
+                    style = self.style.SUCCESS if ok else self.style.ERROR
+                    self.stdout.write(style(
+                        f"{label}: max abs diff {int(diff.max())}, {mismatch_fraction:.4%} of values differ"
+                    ))
+        if failed:
+            raise CommandError("Preprocessing parity check failed.")
@@ -0,0 +1,223 @@
+import glob
+import http.client
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from urllib.parse import urlsplit
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from aipose.capture import get_capture_file, get_image_dir
+
+
+def encode_multipart(fields, image_path):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    content_type = 'image/png' if image_path.endswith('.png') else 'image/jpeg'
+    with open(image_path, 'rb') as f:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="image_file"; '
+                     f'filename="{os.path.basename(image_path)}"\r\nContent-Type: {content_type}\r\n\r\n'.encode()
+                     + f.read() + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+class HTTPSender:
+    # One keep-alive connection per replay thread
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.https = parts.scheme == 'https'
+        self.local = threading.local()
+
+    def connection(self):
+        if getattr(self.local, 'connection', None) is None:
+            connection_class = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            self.local.connection = connection_class(self.host, timeout=60)
+        return self.local.connection
+
+    def send(self, path, fields, image_path, headers):
+        body, content_type = encode_multipart(fields, image_path)
+        try:
+            connection = self.connection()
+            connection.request('POST', self.prefix + path, body=body,
+                               headers=dict(headers, **{'Content-Type': content_type}))
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        except (OSError, http.client.HTTPException):
+            self.local.connection = None
+            return 0
+
+
+class InProcessSender:
+    # Django's test client against this project's settings, database and media
+    def __init__(self):
+        from django.test import Client
+
+        self.client_class = Client
+        self.host = next((host.lstrip('.') for host in settings.ALLOWED_HOSTS if host != '*'), 'localhost')
+        self.local = threading.local()
+
+    def send(self, path, fields, image_path, headers):
+        if getattr(self.local, 'client', None) is None:
+            self.local.client = self.client_class(HTTP_HOST=self.host)
+        extra = {'HTTP_' + name.upper().replace('-', '_'): value for name, value in headers.items()}
+        with open(image_path, 'rb') as f:
+            return self.local.client.post(path, dict(fields, image_file=f), **extra).status_code
+
+
+class Command(BaseCommand):
+    help = ("Replay captured posture API traffic (see AIPOSE_CAPTURE_SAMPLE_RATE) in-process or against a "
+            "running server, and report throughput and latency percentiles. Stored images are the uploads as "
+            "clients sent them, before admission, so replayed requests are downscaled again.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('captures', nargs='*', help="Capture files, defaults to AIPOSE_CAPTURE_FILE.")
+        parser.add_argument('--url', help="Base URL of a running server, e.g. http://127.0.0.1:8000. "
+                                          "Without it requests go through Django's test client in this process.")
+        parser.add_argument('--concurrency', type=int, default=4)
+        parser.add_argument('--rate', type=float, default=0.0,
+                            help="Requests per second, 0 sends as fast as the workers allow.")
+        parser.add_argument('--original-timing', action='store_true',
+                            help="Keep the captured inter-arrival times instead of --rate.")
+        parser.add_argument('--speed', type=float, default=1.0, help="Time scale for --original-timing.")
+        parser.add_argument('--limit', type=int, default=0)
+        parser.add_argument('--repeat', type=int, default=1)
+        parser.add_argument('--fallback-image', default=str(settings.BASE_DIR / 'aipose' / 'input.jpg'),
+                            help="Sent when the captured image was not stored.")
+        parser.add_argument('--include-rejected', action='store_true',
+                            help="Also replay requests that were shed, throttled or rejected when captured.")
+        parser.add_argument('--json', action='store_true', help="Print the report as JSON.")
+
+    def handle(self, *args, **options):
+        records = self.load(options)
+        if not records:
+            raise CommandError("No captured requests to replay.")
+        sender = HTTPSender(options['url']) if options['url'] else InProcessSender()
+        schedule = self.schedule(records, options)
+
+        jobs = queue.Queue()
+        for job in zip(schedule, records):
+            jobs.put(job)
+        results = []
+        results_lock = threading.Lock()
+        open_loop = options['rate'] > 0 or options['original_timing']
+        start = time.perf_counter()
+
+        def worker():
+            mine = []
+            while True:
+                try:
+                    offset, record = jobs.get_nowait()
+                except queue.Empty:
+                    break
+                scheduled = start + offset
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                sent = time.perf_counter()
+                status = sender.send(*self.build_request(record, options))
+                done = time.perf_counter()
+                # At a fixed rate latency is measured from the scheduled time, so
+                # requests delayed by busy workers count their wait (no
+                # coordinated omission)
+                latency = done - scheduled if open_loop else done - sent
+                mine.append((record['view'], status, latency, done - sent))
+            with results_lock:
+                results.extend(mine)
+
+        threads = [threading.Thread(target=worker) for _ in range(options['concurrency'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.report(results, time.perf_counter() - start, options)
+
+    def load(self, options):
+        paths = options['captures'] or [get_capture_file()]
+        records = []
+        for pattern in paths:
+            for path in sorted(glob.glob(pattern)) or [pattern]:
+                if not os.path.exists(path):
+                    raise CommandError(f"Capture file {path} not found.")
+                with open(path) as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError:
+                            continue
+                        if options['include_rejected'] or 200 <= record.get('status', 200) < 300:
+                            records.append(record)
+        records.sort(key=lambda record: record.get('ts', 0))
+        if options['limit']:
+            records = records[:options['limit']]
+        return records * options['repeat']
+
+    def schedule(self, records, options):
+        # Send offsets in seconds from the start of the replay
+        if options['original_timing']:
+            first = records[0].get('ts', 0)
+            period = (records[-1].get('ts', 0) - first) / options['speed'] + 1.0
+            count = len(records) // options['repeat']
+            return [(record.get('ts', first) - first) / options['speed'] + (i // count) * period
+                    for i, record in enumerate(records)]
+        if options['rate'] > 0:
+            return [i / options['rate'] for i in range(len(records))]
+        return [0.0] * len(records)
+
+    def build_request(self, record, options):
+        image_path = options['fallback_image']
+        stored = record.get('image', {}).get('stored')
+        if stored and os.path.exists(os.path.join(get_image_dir(), stored)):
+            image_path = os.path.join(get_image_dir(), stored)
+        fields = {}
+        if record.get('multi_person'):
+            fields['multi_person'] = record['multi_person']
+        headers = {'X-Session-Id': record.get('client', 'replay')}
+        return record['path'], fields, image_path, headers
+
+    def report(self, results, elapsed, options):
+        def summarize(rows):
+            latencies = np.array([row[2] for row in rows]) * 1000
+            service = np.array([row[3] for row in rows]) * 1000
+            return {
+                'requests': len(rows),
+                'statuses': dict(Counter(str(row[1]) for row in rows)),
+                'p50_ms': round(float(np.percentile(latencies, 50)), 2),
+                'p90_ms': round(float(np.percentile(latencies, 90)), 2),
+                'p99_ms': round(float(np.percentile(latencies, 99)), 2),
+                'max_ms': round(float(latencies.max()), 2),
+                'mean_service_ms': round(float(service.mean()), 2),
+            }
+
+        by_view = defaultdict(list)
+        for row in results:
+            by_view[row[0]].append(row)
+        report = {
+            'target': options['url'] or 'in-process',
+            'concurrency': options['concurrency'],
+            'elapsed_s': round(elapsed, 3),
+            'throughput_rps': round(len(results) / elapsed, 2),
+            'overall': summarize(results),
+            'views': {view: summarize(rows) for view, rows in sorted(by_view.items())},
+        }
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        self.stdout.write(f"{len(results)} requests in {elapsed:.2f}s against {report['target']}, "
+                          f"{report['throughput_rps']} req/s with concurrency {options['concurrency']}")
+        self.stdout.write(f"{'view':<16}{'requests':>9}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}  statuses")
+        for name, summary in [('all', report['overall'])] + list(report['views'].items()):
+            self.stdout.write(f"{name:<16}{summary['requests']:>9}{summary['p50_ms']:>10}{summary['p90_ms']:>10}"
+                              f"{summary['p99_ms']:>10}{summary['max_ms']:>10}  {summary['statuses']}")
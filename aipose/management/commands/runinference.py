@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from aipose import metrics
+from aipose.backends import BACKENDS, SidecarBackend, create_backend
+from aipose.sidecar import ModelWorker, SidecarServer
+
+
+class Command(BaseCommand):
+    help = "Run the local inference sidecar that serves MoveNet to web workers using AIPOSE_INFERENCE_BACKEND='sidecar'."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', default=getattr(settings, 'AIPOSE_SIDECAR_SOCKET', '/tmp/aipose-inference.sock'))
+        parser.add_argument('--backend', default=getattr(settings, 'AIPOSE_SIDECAR_BACKEND', 'savedmodel'),
+                            choices=sorted(set(BACKENDS) - {SidecarBackend.name}))
+        parser.add_argument('--models', nargs='+',
+                            default=list(getattr(settings, 'AIPOSE_SIDECAR_MODELS', ('lightning', 'thunder', 'multipose'))))
+        parser.add_argument('--threads', type=int, default=getattr(settings, 'AIPOSE_INFERENCE_THREADS', None))
+        parser.add_argument('--max-coalesced', type=int, default=getattr(settings, 'AIPOSE_SIDECAR_MAX_COALESCED', 8),
+                            help="Waiting requests run in one model call, only with a backend that accepts a batch.")
+        parser.add_argument('--coalesce-wait-ms', type=float,
+                            default=getattr(settings, 'AIPOSE_SIDECAR_COALESCE_WAIT', 0.002) * 1000)
+
+    def handle(self, *args, **options):
+        workers = {}
+        for model in options['models']:
+            try:
+                backend = create_backend(model, options['backend'], options['threads'])
+            except (ImportError, RuntimeError, ValueError) as e:
+                raise CommandError(f"Could not load {model} with the {options['backend']} backend: {e}")
+            workers[model] = ModelWorker(model, backend, options['max_coalesced'], options['coalesce_wait_ms'] / 1000)
+            mode = 'coalesced' if workers[model].max_coalesced > 1 else 'serial'
+            self.stdout.write(f"Loaded {model} ({options['backend']}, input {backend.input_size}, {mode})")
+
+        server = SidecarServer(options['socket'], workers)
+        self.stdout.write(self.style.SUCCESS(f"Serving {', '.join(workers)} on {options['socket']}"))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            counters = metrics.snapshot()['counters']
+            for model in workers:
+                calls = counters.get(f'sidecar.{model}.calls', 0)
+                requests = counters.get(f'sidecar.{model}.requests', 0)
+                if calls:
+                    self.stdout.write(f"{model}: {requests} requests in {calls} model calls "
+                                      f"({requests / calls:.2f} per call)")
@@ -0,0 +1,192 @@
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_http_methods
+from PIL import Image as PILImage
+
+from . import metrics
+
+# Serves annotated images from MEDIA_ROOT with validators and cache headers,
+# plus resized derivatives (?size=thumb or ?size=preview) that are generated
+# on first request and kept under MEDIA_ROOT/derivatives.
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+
+_etags = {}
+_etags_lock = threading.Lock()
+
+
+def get_derivatives():
+    return getattr(settings, 'AIPOSE_MEDIA_DERIVATIVES', {'thumb': 256, 'preview': 1024})
+
+
+def file_etag(path, stat):
+    # Strong ETag from the content. The hash is computed once per file version
+    # (size and mtime), repeat requests only stat the file.
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    etag = _etags.get(key)
+    if etag is None:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+        etag = f'"{digest.hexdigest()[:32]}"'
+        with _etags_lock:
+            if len(_etags) >= getattr(settings, 'AIPOSE_MEDIA_ETAG_CACHE_SIZE', 10000):
+                _etags.clear()
+            _etags[key] = etag
+    return etag
+
+
+def derivative_path(source_path, relative_path, variant):
+    # Regenerated when the source is newer than the cached derivative
+    size = get_derivatives()[variant]
+    target = os.path.join(settings.MEDIA_ROOT, 'derivatives', variant, relative_path + '.jpg')
+    source_mtime = os.stat(source_path).st_mtime_ns
+    try:
+        if os.stat(target).st_mtime_ns >= source_mtime:
+            return target
+    except FileNotFoundError:
+        pass
+
+    start = time.perf_counter()
+    with PILImage.open(source_path) as img:
+        if max(img.size) <= size and img.format == 'JPEG':
+            # Re-encoding would not make it smaller, only the header was read
+            return source_path
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        img.draft('RGB', (size, size))
+        img.thumbnail((size, size))
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        # Written next to the target and renamed, so concurrent requests never
+        # see a partial file
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                img.save(f, format='JPEG', quality=getattr(settings, 'AIPOSE_MEDIA_JPEG_QUALITY', 80),
+                         optimize=True, progressive=True)
+            os.replace(temp_path, target)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+    metrics.observe(f'media.derivative.{variant}', time.perf_counter() - start)
+    return target
+
+
+def parse_range(header, size):
+    # Single byte ranges only, a multi-range request gets the whole file.
+    # Returns (start, end) inclusive, None to serve the whole file, or
+    # False when the range cannot be satisfied.
+    match = RANGE_RE.match(header.strip())
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if first and last and int(first) > int(last):
+        # Invalid rather than unsatisfiable, ignored like a malformed header (RFC 9110, 14.1.1)
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            return False
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size:
+        return False
+    return start, end
+
+
+def if_range_matches(request, etag, last_modified):
+    if_range = request.headers.get('If-Range')
+    if if_range is None:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag
+    date = parse_http_date_safe(if_range)
+    return date is not None and int(last_modified) <= date
+
+
+def iter_file_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+@require_http_methods(['GET', 'HEAD'])
+def serve_media(request, path):
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404("Not found.")
+    # Checked on the normalized path, so '..' cannot leave the served directories
+    path = os.path.relpath(full_path, os.path.abspath(settings.MEDIA_ROOT)).replace(os.sep, '/')
+    if path.split('/', 1)[0] not in getattr(settings, 'AIPOSE_MEDIA_SERVED_DIRS', ('images',)):
+        raise Http404("Not found.")
+    if not os.path.isfile(full_path):
+        raise Http404("Not found.")
+
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    variant = request.GET.get('size')
+    if variant:
+        if variant not in get_derivatives():
+            return HttpResponseBadRequest(f"Unknown size, use one of: {', '.join(get_derivatives())}.")
+        try:
+            full_path = derivative_path(full_path, path, variant)
+        except (PILImage.UnidentifiedImageError, PILImage.DecompressionBombError):
+            return HttpResponseBadRequest("Sizes are only available for images.")
+        content_type = mimetypes.guess_type(full_path)[0] or content_type
+
+    stat = os.stat(full_path)
+    etag = file_etag(full_path, stat)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Cache-Control': f"public, max-age={getattr(settings, 'AIPOSE_MEDIA_MAX_AGE', 86400)}",
+        'Accept-Ranges': 'bytes',
+    }
+
+    response = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if response is not None:
+        metrics.increment(f'media.{response.status_code}')
+        for name, value in headers.items():
+            response.headers[name] = value
+        return response
+
+    byte_range = None
+    if 'Range' in request.headers and if_range_matches(request, etag, stat.st_mtime):
+        byte_range = parse_range(request.headers['Range'], stat.st_size)
+
+    if byte_range is False:
+        response = HttpResponse(status=416, headers={'Content-Range': f'bytes */{stat.st_size}'})
+    elif byte_range is not None:
+        start, end = byte_range
+        response = StreamingHttpResponse(iter_file_range(full_path, start, end - start + 1),
+                                         status=206, content_type=content_type)
+        response.headers['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+        response.headers['Content-Length'] = str(end - start + 1)
+    else:
+        response = FileResponse(open(full_path, 'rb'), content_type=content_type)
+
+    metrics.increment(f'media.{response.status_code}')
+    for name, value in headers.items():
+        response.headers[name] = value
+    return response
@@ -0,0 +1,47 @@
+import threading
+from collections import defaultdict, deque
+
+import numpy as np
+
+# In-process counters and timings. Each worker keeps its own, and the
+# metrics endpoint reports the worker that served the request.
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_timings = defaultdict(lambda: {'count': 0, 'total': 0.0, 'recent': deque(maxlen=1000)})
+
+
+def increment(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def observe(name, seconds):
+    with _lock:
+        timing = _timings[name]
+        timing['count'] += 1
+        timing['total'] += seconds
+        timing['recent'].append(seconds)
+
+
+def snapshot():
+    with _lock:
+        counters = dict(_counters)
+        timings = {name: (t['count'], t['total'], list(t['recent'])) for name, t in _timings.items()}
+
+    summary = {}
+    for name, (count, total, recent) in timings.items():
+        # Percentiles are over the most recent observations only
+        summary[name] = {
+            'count': count,
+            'mean_ms': round(total / count * 1000, 2) if count else 0.0,
+            'p50_ms': round(float(np.percentile(recent, 50)) * 1000, 2) if recent else 0.0,
+            'p95_ms': round(float(np.percentile(recent, 95)) * 1000, 2) if recent else 0.0,
+            'p99_ms': round(float(np.percentile(recent, 99)) * 1000, 2) if recent else 0.0,
+        }
+    return {'counters': counters, 'timings': summary}
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timings.clear()
@@ -5,3 +5,7 @@ class Image(models.Model):
     title = models.CharField(max_length=255, blank=True)
     image_file = models.ImageField(upload_to='images/')
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    analysis = models.JSONField(null=True, blank=True)
+    # Set for rows persisted through aipose.writebehind, so replaying a journal
+    # never inserts a row twice
+    write_id = models.UUIDField(null=True, blank=True, unique=True, editable=False)
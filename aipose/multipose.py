@@ -0,0 +1,49 @@
+
+from .backends import get_backend
+from .geometry import keypoints_to_image
+from .phash import reuse_or_run
+from .preprocessing import preprocess_image
+
+
+class MultiPoseAnalyzer:
+    # Runs MoveNet MultiPose once per image and evaluates the rules of
+    # rules_class (PoseAnalyzer or DeskPoseAnalyzer) for every detected person
+
+    def __init__(self, rules_class, backend=None, min_person_score=0.2):
+        self.rules_class = rules_class
+        self.backend = backend or get_backend('multipose')
+        self.min_person_score = min_person_score
+
+    def detect_people(self, image_path):
+        image = preprocess_image(image_path, self.backend.input_size)
+        # (6, 56): 17 (y, x, score) keypoints, then ymin, xmin, ymax, xmax, score
+        detections = self.backend.run(image)[0]
+        detections = detections[detections[:, 55] > self.min_person_score]
+        keypoints_with_scores = detections[:, :51].reshape(-1, 17, 3)
+        boxes = detections[:, 51:55]
+        person_scores = detections[:, 55]
+        return keypoints_with_scores, boxes, person_scores
+
+    def analyze_pose(self, image_path, width, height, cache_key=None):
+        # Only the detections are reused, so both rule sets can share them
+        keypoints_with_scores, boxes, person_scores = reuse_or_run(cache_key, type(self).__name__, image_path,
+                                                                   lambda: self.detect_people(image_path))
+        findings = self.rules_class.analyze_keypoints(keypoints_with_scores)
+
+        input_size = self.backend.input_size
+        pixel_keypoints = keypoints_to_image(keypoints_with_scores, width, height, input_size)
+        # Box corners are (y, x) pairs too, so they map the same way as keypoints
+        pixel_boxes = keypoints_to_image(boxes.reshape(-1, 2, 2), width, height, input_size)
+
+        people = []
+        for i in range(len(keypoints_with_scores)):
+            (ymin, xmin), (ymax, xmax) = pixel_boxes[i]
+            people.append({
+                'person': i,
+                'score': round(float(person_scores[i]), 3),
+                'bbox': [round(float(v), 1) for v in (xmin, ymin, xmax, ymax)],
+                'keypoints': [[round(float(y), 1), round(float(x), 1), round(float(score), 3)]
+                              for (y, x), score in zip(pixel_keypoints[i], keypoints_with_scores[i, :, 2])],
+                'findings': findings[i],
+            })
+        return people
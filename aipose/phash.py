@@ -0,0 +1,138 @@
+import threading
+import time
+from collections import OrderedDict, deque
+
+from django.conf import settings
+from PIL import Image as PILImage
+
+from . import metrics
+
+
+def dhash(image_path, hash_size=8):
+    # Difference hash: compares neighbouring pixels of a tiny grayscale
+    # thumbnail, so JPEG re-encoding and small exposure changes keep the hash
+    # within a few bits
+    with PILImage.open(image_path) as img:
+        # The JPEG decoder can scale down while decoding, a thumbnail is all we need
+        img.draft('L', (hash_size * 8, hash_size * 8))
+        pixels = list(img.convert('L').resize((hash_size + 1, hash_size), PILImage.Resampling.LANCZOS).getdata())
+
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming_distance(a, b):
+    return (a ^ b).bit_count()
+
+
+class PerceptualHashIndex:
+    # Recent inference results per client, found again by perceptual hash.
+    # Memory is bounded: at most max_keys clients (least recently used are
+    # evicted) with at most entries_per_key results each.
+
+    def __init__(self, max_keys=1000, entries_per_key=8, max_distance=4, max_age=600):
+        self.max_keys = max_keys
+        self.entries_per_key = entries_per_key
+        self.max_distance = max_distance
+        self.max_age = max_age
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, key, namespace, image_hash):
+        now = time.monotonic()
+        with self.lock:
+            recent = self.entries.get(key)
+            if recent is not None:
+                self.entries.move_to_end(key)
+                best = None
+                for entry_namespace, entry_hash, added, payload in recent:
+                    if entry_namespace != namespace or now - added > self.max_age:
+                        continue
+                    distance = hamming_distance(entry_hash, image_hash)
+                    if distance <= self.max_distance and (best is None or distance < best[0]):
+                        best = (distance, payload)
+                if best is not None:
+                    self.hits += 1
+                    metrics.increment('phash.hits')
+                    return best[1]
+            self.misses += 1
+            metrics.increment('phash.misses')
+            return None
+
+    def add(self, key, namespace, image_hash, payload):
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = deque(maxlen=self.entries_per_key)
+            self.entries.move_to_end(key)
+            self.entries[key].append((namespace, image_hash, time.monotonic(), payload))
+            while len(self.entries) > self.max_keys:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+                metrics.increment('phash.evictions')
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'keys': len(self.entries),
+                'entries': sum(len(recent) for recent in self.entries.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = PerceptualHashIndex(
+                    max_keys=getattr(settings, 'AIPOSE_PHASH_MAX_KEYS', 1000),
+                    entries_per_key=getattr(settings, 'AIPOSE_PHASH_ENTRIES_PER_KEY', 8),
+                    max_distance=getattr(settings, 'AIPOSE_PHASH_MAX_DISTANCE', 4),
+                    max_age=getattr(settings, 'AIPOSE_PHASH_MAX_AGE', 600),
+                )
+    return _index
+
+
+def reuse_or_run(cache_key, namespace, image_path, run):
+    # Returns the result stored for a near-duplicate of image_path sent by the
+    # same client, otherwise calls run() and stores its result. Callers pass
+    # their analyzer class name as namespace, results of different analyzers
+    # are never interchangeable.
+    if cache_key is None or not getattr(settings, 'AIPOSE_PHASH_ENABLED', True):
+        return run()
+
+    index = get_index()
+    image_hash = dhash(image_path)
+    result = index.lookup(cache_key, namespace, image_hash)
+    if result is None:
+        result = run()
+        index.add(cache_key, namespace, image_hash, result)
+    return result
+
+
+def client_cache_key(request):
+    # Near-duplicates are only matched within one user or client session. An
+    # address is not a client, many share one behind a NAT, so anonymous
+    # requests without a session id are never matched.
+    if request.user.is_authenticated:
+        return f'user:{request.user.pk}'
+    session_id = request.headers.get('X-Session-Id') or request.data.get('session_id')
+    if session_id:
+        return f'session:{session_id}'
+    return None
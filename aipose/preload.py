@@ -0,0 +1,43 @@
+import importlib
+
+from django.conf import settings
+
+# Heavy modules the analyzers pull in on first use
+ML_MODULES = {
+    'savedmodel': ('tensorflow', 'tensorflow_hub'),
+    'tflite': ('tensorflow',),
+    'onnx': ('onnxruntime',),
+    # The sidecar process imports them, the web workers do not
+    'sidecar': (),
+}
+HAND_MODULES = ('mediapipe', 'mediapipe.tasks.python.vision')
+# Backends whose model can be loaded before the fork. TensorFlow's eager
+# runtime (savedmodel) is not fork-safe once it has started.
+FORK_SAFE_BACKENDS = ('tflite', 'onnx', 'sidecar')
+
+
+def preload(level=None):
+    # 'imports' only imports the ML libraries. Their code and data pages are
+    # then shared copy-on-write by forked workers, and runtime thread pools are
+    # still created after the fork.
+    # 'models' also loads the MoveNet backend before the fork, and falls back
+    # to 'imports' for backends that are not in FORK_SAFE_BACKENDS.
+    level = level or getattr(settings, 'AIPOSE_PRELOAD', None)
+    if not level:
+        return
+
+    backend = getattr(settings, 'AIPOSE_INFERENCE_BACKEND', 'savedmodel')
+    if level == 'models' and backend not in FORK_SAFE_BACKENDS:
+        print(f"Preload of models is not fork-safe with the {backend} backend, only importing its modules. "
+              f"Use one of: {', '.join(FORK_SAFE_BACKENDS)}.")
+        level = 'imports'
+
+    for module in ML_MODULES.get(backend, ()) + HAND_MODULES:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            print(f"Preload skipped {module}: {e}")
+
+    if level == 'models':
+        from .backends import get_backend
+        get_backend('lightning')
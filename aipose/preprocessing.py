@@ -0,0 +1,173 @@
+from io import BytesIO
+
+import numpy as np
+from PIL import Image as PILImage
+
+try:
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
+# MoveNet input preprocessing. preprocess_image_tf is the original eager
+# TensorFlow chain. preprocess_image_np reproduces it with NumPy and Pillow, so
+# the request path does not need TensorFlow and skips per-op eager dispatch.
+
+CONTRAST_FACTOR = 300.0
+
+JPEG_MAGIC = b'\xff\xd8\xff'
+
+# 'simplejpeg' matches tf.image.decode_jpeg exactly. 'pillow' uses libjpeg's
+# accurate DCT, so after the contrast stretch most values are a few units off
+# the TensorFlow output.
+DECODERS = ('simplejpeg', 'pillow')
+
+
+def default_decoder():
+    return 'simplejpeg' if simplejpeg is not None else 'pillow'
+
+
+def default_preprocessing():
+    # The NumPy path only reproduces the TensorFlow input with simplejpeg
+    return 'numpy' if simplejpeg is not None else 'tensorflow'
+
+
+def preprocess_image_tf(image_path, target_size=192):
+    # Imported here so loading this module does not pull in TensorFlow
+    import tensorflow as tf
+
+    try:
+        image = tf.io.read_file(image_path)
+        image = tf.image.decode_jpeg(image)
+        image = tf.image.convert_image_dtype(image, dtype=tf.float32)
+    except tf.errors.InvalidArgumentError:
+        raise ValueError("Invalid image file. Please check the image path and format.")
+
+    image = tf.image.resize_with_pad(image, target_height=target_size, target_width=target_size)
+    image = tf.image.adjust_contrast(image, CONTRAST_FACTOR)
+    image = tf.cast(image, dtype=tf.int32)
+    return tf.expand_dims(image, axis=0)
+
+
+def preprocess_image_np(image, target_size=192, out=None, decoder=None):
+    # Same result as preprocess_image_tf for a path, PIL image or RGB uint8
+    # array when JPEGs are decoded with simplejpeg. With out, the
+    # (target_size, target_size, 3) int32 result is written in place, e.g.
+    # into one row of a preallocated batch buffer.
+    pixels = load_rgb(image, decoder)
+    if out is None:
+        out = np.empty((1, target_size, target_size, 3), dtype=np.int32)
+        preprocess_into(pixels, out[0])
+        return out
+    preprocess_into(pixels, out)
+    return out
+
+
+def preprocess_batch(images, target_size=192, out=None, decoder=None):
+    if out is None:
+        out = np.empty((len(images), target_size, target_size, 3), dtype=np.int32)
+    for i, image in enumerate(images):
+        preprocess_into(load_rgb(image, decoder), out[i])
+    return out
+
+
+def load_rgb(image, decoder=None):
+    if isinstance(image, np.ndarray):
+        return image
+    decoder = decoder or default_decoder()
+    if decoder not in DECODERS:
+        raise ValueError(f"Unknown JPEG decoder '{decoder}', use one of: {', '.join(DECODERS)}.")
+    if decoder == 'simplejpeg' and simplejpeg is None:
+        raise ImportError("The simplejpeg decoder needs the simplejpeg package.")
+    if not isinstance(image, PILImage.Image):
+        try:
+            if hasattr(image, 'read'):
+                data = image.read()
+            else:
+                with open(image, 'rb') as f:
+                    data = f.read()
+            if decoder == 'simplejpeg' and data.startswith(JPEG_MAGIC):
+                # tf.image.decode_jpeg uses libjpeg's fast integer DCT with fancy
+                # upsampling. Pillow cannot select that combination, simplejpeg
+                # can, so the decoded pixels are bit-identical.
+                return simplejpeg.decode_jpeg(data, colorspace='RGB', fastdct=True, fastupsample=False)
+            with PILImage.open(BytesIO(data)) as img:
+                img.load()
+                image = img
+        except (OSError, ValueError):
+            raise ValueError("Invalid image file. Please check the image path and format.")
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return np.asarray(image)
+
+
+def preprocess_into(pixels, out):
+    target_height, target_width = out.shape[:2]
+    height, width = pixels.shape[:2]
+
+    # tf.image.resize_with_pad, computed in float32 like the TF graph
+    f_height, f_width = np.float32(height), np.float32(width)
+    ratio = max(f_width / np.float32(target_width), f_height / np.float32(target_height))
+    resized_height_float = f_height / ratio
+    resized_width_float = f_width / ratio
+    resized_height = int(np.floor(resized_height_float))
+    resized_width = int(np.floor(resized_width_float))
+    pad_top = max(0, int(np.floor((np.float32(target_height) - resized_height_float) / np.float32(2))))
+    pad_left = max(0, int(np.floor((np.float32(target_width) - resized_width_float) / np.float32(2))))
+
+    padded = np.zeros((target_height, target_width, 3), dtype=np.float32)
+    padded[pad_top:pad_top + resized_height, pad_left:pad_left + resized_width] = \
+        resize_bilinear(pixels, resized_height, resized_width)
+
+    # tf.image.adjust_contrast: (x - mean) * factor + mean, per channel over the
+    # padded image. The int32 cast truncates toward zero like tf.cast.
+    mean = padded.mean(axis=(0, 1), dtype=np.float64).astype(np.float32)
+    padded -= mean
+    padded *= np.float32(CONTRAST_FACTOR)
+    padded += mean
+    np.copyto(out, padded, casting='unsafe')
+
+
+def interpolation_weights(in_size, out_size):
+    # Half-pixel-center sampling, as in tf.image.resize (v2) with antialias off
+    scale = np.float32(in_size) / np.float32(out_size)
+    coords = (np.arange(out_size, dtype=np.float32) + np.float32(0.5)) * scale - np.float32(0.5)
+    floor = np.floor(coords)
+    lower = np.maximum(floor, 0).astype(np.intp)
+    upper = np.minimum(np.ceil(coords), in_size - 1).astype(np.intp)
+    return lower, upper, coords - floor
+
+
+def resize_bilinear(pixels, out_height, out_width):
+    y_lower, y_upper, y_lerp = interpolation_weights(pixels.shape[0], out_height)
+    x_lower, x_upper, x_lerp = interpolation_weights(pixels.shape[1], out_width)
+    x_lerp = x_lerp[np.newaxis, :, np.newaxis]
+    y_lerp = y_lerp[:, np.newaxis, np.newaxis]
+
+    # Only the sampled rows and columns are converted to float, which gives the
+    # same values as converting the whole photo first.
+    # tf.image.convert_image_dtype scales by a float32 reciprocal, not a division.
+    scale = np.float32(1.0 / 255)
+    top_rows = pixels[y_lower]
+    bottom_rows = pixels[y_upper]
+    top_left = top_rows[:, x_lower].astype(np.float32) * scale
+    top_right = top_rows[:, x_upper].astype(np.float32) * scale
+    bottom_left = bottom_rows[:, x_lower].astype(np.float32) * scale
+    bottom_right = bottom_rows[:, x_upper].astype(np.float32) * scale
+
+    top = top_left + (top_right - top_left) * x_lerp
+    bottom = bottom_left + (bottom_right - bottom_left) * x_lerp
+    return top + (bottom - top) * y_lerp
+
+
+def preprocess_image(image_path, target_size=192):
+    # Entry point used by the analyzers, AIPOSE_PREPROCESSING picks the implementation
+    from django.conf import settings
+
+    from .profiling import note_tensor
+
+    if (getattr(settings, 'AIPOSE_PREPROCESSING', None) or default_preprocessing()) == 'tensorflow':
+        image = preprocess_image_tf(image_path, target_size)
+    else:
+        image = preprocess_image_np(image_path, target_size)
+    note_tensor(f'movenet_input_{target_size}', image)
+    return image
@@ -0,0 +1,156 @@
+import contextvars
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import uuid
+from functools import wraps
+
+from django.conf import settings
+
+# Opt-in profiling of the posture endpoints. A request is profiled when a staff
+# user sends X-Aipose-Profile: 1 or ?profile=1, or when it is picked by
+# AIPOSE_PROFILE_SAMPLE_RATE. The whole post path runs under cProfile and the
+# profile is saved to AIPOSE_PROFILE_DIR with a JSON summary of per-stage
+# times and the tensors that were built. Requests that are not profiled only
+# pay the checks in should_profile.
+
+# Stage name -> functions (file suffix, function name) whose cumulative time is reported for it
+STAGES = {
+    'admission': [('aipose/admission.py', 'admit_image')],
+    'storage_save': [('django/core/files/storage/base.py', 'save')],
+    'preprocess': [('aipose/preprocessing.py', 'preprocess_image')],
+    # SidecarBackend.run lives in backends.py too, the client call nested in it is not counted again
+    'inference': [('aipose/backends.py', 'run')],
+    'hand_landmarks': [('aipose/handpose.py', 'detect')],
+    'phash': [('aipose/phash.py', 'dhash')],
+    'drawing': [('aipose/views.py', 'draw_skeleton')],
+    'image_encode': [('PIL/Image.py', 'save')],
+    'persist': [('aipose/writebehind.py', 'save_image')],
+}
+
+PROFILE_ID_RE = re.compile(r'^\d{8}-\d{6}-[0-9a-f]{32}$')
+
+_current = contextvars.ContextVar('aipose_profile', default=None)
+# cProfile cannot run twice at once on Python 3.12+, a second request is simply not profiled
+_profiler_lock = threading.Lock()
+
+
+def note_tensor(name, array):
+    # No-op unless the current request is being profiled
+    profile = _current.get()
+    if profile is not None:
+        profile['tensors'].append({
+            'name': name,
+            'shape': list(array.shape),
+            'dtype': str(array.dtype),
+            'bytes': int(array.nbytes),
+        })
+
+
+def should_profile(request):
+    if request.headers.get('X-Aipose-Profile') == '1' or request.query_params.get('profile') == '1':
+        return request.user.is_staff
+    rate = getattr(settings, 'AIPOSE_PROFILE_SAMPLE_RATE', 0.0)
+    return rate > 0 and random.random() < rate
+
+
+def get_profile_dir():
+    return getattr(settings, 'AIPOSE_PROFILE_DIR', os.path.join(settings.BASE_DIR, 'var', 'profiles'))
+
+
+def stage_times(stats):
+    times = {}
+    for (filename, _, function), (_, _, _, cumulative, _) in stats.stats.items():
+        filename = filename.replace(os.sep, '/')
+        for stage, functions in STAGES.items():
+            if any(filename.endswith(suffix) and function == name for suffix, name in functions):
+                times[stage] = times.get(stage, 0.0) + cumulative
+    return {stage: round(seconds * 1000, 2) for stage, seconds in sorted(times.items())}
+
+
+def save_artifacts(profile_id, profiler, summary):
+    profile_dir = get_profile_dir()
+    os.makedirs(profile_dir, exist_ok=True)
+    profiler.dump_stats(os.path.join(profile_dir, f'{profile_id}.prof'))
+
+    stats = pstats.Stats(profiler)
+    summary['stages_ms'] = stage_times(stats)
+    top = io.StringIO()
+    stats.stream = top
+    stats.sort_stats('cumulative').print_stats(getattr(settings, 'AIPOSE_PROFILE_TOP_FUNCTIONS', 40))
+    summary['top_functions'] = top.getvalue()
+    with open(os.path.join(profile_dir, f'{profile_id}.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    # Keep only the newest artifacts
+    summaries = sorted((name for name in os.listdir(profile_dir) if name.endswith('.json')), reverse=True)
+    for name in summaries[getattr(settings, 'AIPOSE_PROFILE_MAX_ARTIFACTS', 200):]:
+        for extension in ('.json', '.prof'):
+            try:
+                os.remove(os.path.join(profile_dir, name[:-len('.json')] + extension))
+            except FileNotFoundError:
+                pass
+
+
+def list_profiles():
+    profile_dir = get_profile_dir()
+    if not os.path.isdir(profile_dir):
+        return []
+    profiles = []
+    for name in sorted(os.listdir(profile_dir), reverse=True):
+        if name.endswith('.json'):
+            with open(os.path.join(profile_dir, name)) as f:
+                summary = json.load(f)
+            summary.pop('top_functions', None)
+            profiles.append(summary)
+    return profiles
+
+
+def profile_path(profile_id, extension):
+    if not PROFILE_ID_RE.match(profile_id):
+        return None
+    path = os.path.join(get_profile_dir(), profile_id + extension)
+    return path if os.path.isfile(path) else None
+
+
+def profile_request(view_method):
+    @wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        if not should_profile(request) or not _profiler_lock.acquire(blocking=False):
+            return view_method(self, request, *args, **kwargs)
+
+        profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex}"
+        summary = {
+            'id': profile_id,
+            'view': type(self).__name__,
+            'path': request.path,
+            'content_length': int(request.META.get('CONTENT_LENGTH') or 0),
+            'tensors': [],
+        }
+        token = _current.set(summary)
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            profiler.enable()
+            try:
+                response = view_method(self, request, *args, **kwargs)
+            finally:
+                profiler.disable()
+            summary['wall_ms'] = round((time.perf_counter() - start) * 1000, 2)
+            summary['status'] = response.status_code
+            try:
+                save_artifacts(profile_id, profiler, summary)
+                response['X-Aipose-Profile-Id'] = profile_id
+            except OSError as e:
+                print("Could not save the request profile:", str(e))
+            return response
+        finally:
+            _current.reset(token)
+            _profiler_lock.release()
+    return wrapper
@@ -3,6 +3,23 @@ from rest_framework import serializers
 from .models import Image
 
 class ImageSerializer(serializers.ModelSerializer):
+    # Resized versions for lists and previews, generated on first request
+    thumbnail_url = serializers.SerializerMethodField()
+    preview_url = serializers.SerializerMethodField()
+
     class Meta:
         model = Image
-        fields = ['id', 'title', 'image_file', 'uploaded_at']
+        fields = ['id', 'title', 'image_file', 'uploaded_at', 'thumbnail_url', 'preview_url']
+
+    def get_thumbnail_url(self, obj):
+        return self.derivative_url(obj, 'thumb')
+
+    def get_preview_url(self, obj):
+        return self.derivative_url(obj, 'preview')
+
+    def derivative_url(self, obj, size):
+        if not obj.image_file:
+            return None
+        url = f'{obj.image_file.url}?size={size}'
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
@@ -83,6 +83,15 @@ DATABASES = {
     }
 }
 
+# Applied to every new SQLite connection (see aipose/apps.py). WAL lets readers
+# run while a row is written, busy_timeout waits for the write lock instead of
+# failing, and synchronous NORMAL is durable in WAL mode except on power loss.
+AIPOSE_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'busy_timeout': 5000,
+    'synchronous': 'NORMAL',
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -128,3 +137,101 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+
+# Upload admission limits, checked before an upload is saved or decoded
+AIPOSE_MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+AIPOSE_MAX_IMAGE_PIXELS = 40_000_000
+AIPOSE_MAX_IMAGE_DIMENSION = 2048
+AIPOSE_DOWNSCALE_OVERSIZED = True
+AIPOSE_ALLOWED_IMAGE_FORMATS = ('JPEG', 'PNG')
+
+# Image rows are journaled per request and inserted in batches of
+# AIPOSE_WRITE_BEHIND_MAX_ROWS or every AIPOSE_WRITE_BEHIND_INTERVAL seconds (see aipose/writebehind.py)
+AIPOSE_WRITE_BEHIND = True
+AIPOSE_WRITE_BEHIND_MAX_ROWS = 50
+AIPOSE_WRITE_BEHIND_INTERVAL = 1.0
+AIPOSE_WRITE_BEHIND_FSYNC = True
+AIPOSE_WRITE_BEHIND_JOURNAL_DIR = os.path.join(BASE_DIR, 'var', 'write-behind')
+
+# Request profiling: staff users send X-Aipose-Profile: 1 or ?profile=1, or a
+# fraction of all requests is sampled. Artifacts are listed at /api/profiles/.
+AIPOSE_PROFILE_SAMPLE_RATE = 0.0
+AIPOSE_PROFILE_DIR = os.path.join(BASE_DIR, 'var', 'profiles')
+AIPOSE_PROFILE_MAX_ARTIFACTS = 200
+AIPOSE_PROFILE_TOP_FUNCTIONS = 40
+
+# Traffic capture for `manage.py replay_traffic`: a fraction of posture requests
+# is appended to AIPOSE_CAPTURE_FILE, with the images when AIPOSE_CAPTURE_STORE_IMAGES
+AIPOSE_CAPTURE_SAMPLE_RATE = 0.0
+AIPOSE_CAPTURE_FILE = os.path.join(BASE_DIR, 'var', 'capture', 'requests.jsonl')
+AIPOSE_CAPTURE_STORE_IMAGES = False
+
+# Media serving: annotated images under AIPOSE_MEDIA_SERVED_DIRS, and resized
+# JPEG derivatives for ?size=<name> (longest side in pixels) cached in MEDIA_ROOT/derivatives
+AIPOSE_SERVE_MEDIA = True
+AIPOSE_MEDIA_SERVED_DIRS = ('images',)
+AIPOSE_MEDIA_DERIVATIVES = {'thumb': 256, 'preview': 1024}
+AIPOSE_MEDIA_JPEG_QUALITY = 80
+AIPOSE_MEDIA_MAX_AGE = 86400
+
+# Load shedding for the posture endpoints. Each request gets a deadline of
+# AIPOSE_REQUEST_DEADLINE seconds (clients can shorten it with X-Request-Timeout-Ms),
+# at most AIPOSE_MAX_IN_FLIGHT requests per endpoint and process are worked on
+# at once (waiting up to AIPOSE_IN_FLIGHT_QUEUE_TIMEOUT for a slot), and
+# AIPOSE_RATE_LIMIT = (requests per second, burst) enables per-client quotas
+# (a rate of 0 disables them, the burst must be at least 1)
+AIPOSE_REQUEST_DEADLINE = 30.0
+AIPOSE_MAX_IN_FLIGHT = 4
+AIPOSE_IN_FLIGHT_QUEUE_TIMEOUT = 0.5
+AIPOSE_RATE_LIMIT = None
+AIPOSE_SHED_RETRY_AFTER = 1
+
+# MoveNet inference backend: 'savedmodel', 'tflite', 'onnx', or 'sidecar' to
+# forward to `manage.py runinference`
+AIPOSE_INFERENCE_BACKEND = os.environ.get('AIPOSE_INFERENCE_BACKEND', 'savedmodel')
+# Threads per inference call, None lets the runtime decide
+AIPOSE_INFERENCE_THREADS = None
+# Per-model overrides of backends.DEFAULT_MODELS, merged key by key, e.g.
+# {'lightning': {'tflite': '/srv/models/lightning.tflite'}}. A new model
+# name needs an input_size and a path for each backend it runs on.
+AIPOSE_MOVENET_MODELS = {}
+
+# Inference sidecar: one process owns the models and runs the requests of all
+# web workers, tensors are passed through shared memory. The published MoveNet
+# exports take one image per call, so requests run one after another. Only an
+# ONNX export with a dynamic batch dimension gets up to
+# AIPOSE_SIDECAR_MAX_COALESCED waiting requests in one call, waiting
+# AIPOSE_SIDECAR_COALESCE_WAIT seconds for more.
+AIPOSE_SIDECAR_SOCKET = os.environ.get('AIPOSE_SIDECAR_SOCKET', '/tmp/aipose-inference.sock')
+AIPOSE_SIDECAR_BACKEND = 'savedmodel'
+AIPOSE_SIDECAR_MODELS = ('lightning', 'thunder', 'multipose')
+AIPOSE_SIDECAR_TIMEOUT = 10.0
+AIPOSE_SIDECAR_MAX_COALESCED = 8
+AIPOSE_SIDECAR_COALESCE_WAIT = 0.002
+
+# Load ML dependencies at WSGI startup instead of on the first request:
+# None, 'imports' or 'models' (see aipose/preload.py)
+AIPOSE_PRELOAD = os.environ.get('AIPOSE_PRELOAD') or None
+
+# Run MoveNet first and landmark hands only in crops around the wrists
+AIPOSE_HAND_TWO_STAGE = False
+
+# Model cascade: run the tiers in order and escalate while more than
+# AIPOSE_CASCADE_MAX_LOW_FRACTION of the required keypoints score below AIPOSE_CASCADE_MIN_SCORE
+AIPOSE_POSE_CASCADE = False
+AIPOSE_CASCADE_TIERS = ('lightning', 'thunder')
+AIPOSE_CASCADE_MIN_SCORE = 0.2
+AIPOSE_CASCADE_MAX_LOW_FRACTION = 0.5
+
+# MoveNet input preprocessing: 'numpy' (no TensorFlow needed) or 'tensorflow'.
+# None picks 'numpy' when simplejpeg is installed, the NumPy path only matches
+# the TensorFlow input with it, and 'tensorflow' otherwise.
+AIPOSE_PREPROCESSING = None
+
+# Near-duplicate detection: reuse keypoints when a client sends an image within
+# AIPOSE_PHASH_MAX_DISTANCE bits (of 64) of one it sent in the last AIPOSE_PHASH_MAX_AGE seconds
+AIPOSE_PHASH_ENABLED = True
+AIPOSE_PHASH_MAX_DISTANCE = 4
+AIPOSE_PHASH_MAX_AGE = 600
+AIPOSE_PHASH_MAX_KEYS = 1000
+AIPOSE_PHASH_ENTRIES_PER_KEY = 8
@@ -0,0 +1,266 @@
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+# Local inference server. Web workers send a small JSON header over a Unix
+# socket, the image tensor itself goes through a shared memory segment the
+# worker owns, and the server writes the model output back into the same
+# segment. Only the server process loads TensorFlow and the MoveNet graphs.
+
+HEADER = struct.Struct('!I')
+# Largest MoveNet output, (1, 6, 56) float32 for multipose
+OUTPUT_BYTES = 6 * 56 * 4
+
+
+def send_message(sock, message):
+    data = json.dumps(message).encode()
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def recv_message(sock):
+    header = recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    (length,) = HEADER.unpack(header)
+    return json.loads(recv_exactly(sock, length))
+
+
+def recv_exactly(sock, length):
+    data = bytearray()
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            if data:
+                raise ConnectionError("Inference sidecar connection closed mid-message.")
+            return None
+        data.extend(chunk)
+    return bytes(data)
+
+
+def attach_segment(name):
+    segment = shared_memory.SharedMemory(name=name)
+    # The client created the segment and unlinks it. Without this the resource
+    # tracker of the server would unlink it too when the server exits.
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    return segment
+
+
+class SidecarClient:
+    # One connection and one shared memory segment per web worker process.
+    # Calls are serialized, so threaded servers share them safely.
+
+    def __init__(self, socket_path, timeout=10.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pid = None
+        self.sock = None
+        self.segment = None
+
+    def run(self, model, image):
+        image = np.ascontiguousarray(image)
+        with self.lock:
+            self.check_pid()
+            try:
+                return self.request(model, image)
+            except (OSError, ConnectionError, ValueError) as e:
+                self.close()
+                raise RuntimeError(f"Inference sidecar at {self.socket_path} failed: {e}") from e
+
+    def request(self, model, image):
+        if self.segment is None or self.segment.size < image.nbytes + OUTPUT_BYTES:
+            self.release_segment()
+            self.segment = shared_memory.SharedMemory(create=True, size=image.nbytes + OUTPUT_BYTES)
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(self.timeout)
+            self.sock.connect(self.socket_path)
+
+        np.ndarray(image.shape, dtype=image.dtype, buffer=self.segment.buf)[...] = image
+        send_message(self.sock, {
+            'model': model,
+            'segment': self.segment.name,
+            'shape': image.shape,
+            'dtype': image.dtype.str,
+        })
+        response = recv_message(self.sock)
+        if response is None:
+            raise ConnectionError("Inference sidecar closed the connection.")
+        if 'error' in response:
+            raise ValueError(response['error'])
+        output = np.ndarray(response['shape'], dtype=response['dtype'],
+                            buffer=self.segment.buf, offset=response['offset'])
+        return output.copy()
+
+    def release_segment(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.segment.unlink()
+            self.segment = None
+
+    def check_pid(self):
+        if self.pid != os.getpid():
+            # Forked after the client was used: the connection and the segment
+            # belong to the parent
+            self.sock = None
+            self.segment = None
+            self.pid = os.getpid()
+
+    def close(self):
+        self.check_pid()
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.release_segment()
+
+
+class PendingRequest:
+    def __init__(self, connection, message, segment):
+        self.connection = connection
+        self.message = message
+        self.segment = segment
+        # Copied out, so the model never holds a view on the segment
+        self.image = np.ndarray(message['shape'], dtype=message['dtype'], buffer=segment.buf).copy()
+        # Set once the reply was written, the handler keeps the segment open until then
+        self.done = threading.Event()
+
+    def reply(self, output=None, error=None):
+        if error is not None:
+            send_message(self.connection, {'error': error})
+            return
+        output = np.ascontiguousarray(output)
+        offset = int(np.prod(self.message['shape'])) * np.dtype(self.message['dtype']).itemsize
+        if offset + output.nbytes > self.segment.size:
+            send_message(self.connection, {'error': "Output does not fit the shared memory segment."})
+            return
+        np.ndarray(output.shape, dtype=output.dtype, buffer=self.segment.buf, offset=offset)[...] = output
+        send_message(self.connection, {'shape': output.shape, 'dtype': output.dtype.str, 'offset': offset})
+
+
+class ModelWorker(threading.Thread):
+    # Runs one model on one thread, so concurrent web workers share a single
+    # runtime thread pool instead of oversubscribing the CPU. Requests are
+    # served in arrival order, one model call each. Only a backend that
+    # accepts a batch (max_batch_size > 1, ONNX exports with a dynamic batch
+    # dimension) gets up to max_coalesced waiting requests in one call, and
+    # only then does the worker wait coalesce_wait for more to arrive.
+
+    def __init__(self, model, backend, max_coalesced=8, coalesce_wait=0.002):
+        super().__init__(name=f'inference-{model}', daemon=True)
+        self.model = model
+        self.backend = backend
+        self.max_coalesced = min(max_coalesced, backend.max_batch_size)
+        self.coalesce_wait = coalesce_wait
+        self.requests = queue.Queue()
+
+    def run(self):
+        from . import metrics
+
+        while True:
+            pending_requests = [self.requests.get()]
+            deadline = time.monotonic() + self.coalesce_wait
+            while len(pending_requests) < self.max_coalesced:
+                try:
+                    pending_requests.append(self.requests.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            metrics.increment(f'sidecar.{self.model}.requests', len(pending_requests))
+            start = time.perf_counter()
+            for pending, output, error in self.run_requests(pending_requests):
+                try:
+                    pending.reply(output, error)
+                except OSError:
+                    # The web worker went away, nothing to answer
+                    pass
+                finally:
+                    pending.done.set()
+            metrics.observe(f'sidecar.{self.model}', time.perf_counter() - start)
+
+    def run_requests(self, pending_requests):
+        from . import metrics
+
+        images = [pending.image for pending in pending_requests]
+        if len(images) > 1 and all(image.shape == images[0].shape for image in images):
+            metrics.increment(f'sidecar.{self.model}.calls')
+            try:
+                outputs = self.backend.run(np.concatenate(images))
+                return [(pending, outputs[i:i + 1], None) for i, pending in enumerate(pending_requests)]
+            except Exception as e:
+                return [(pending, None, str(e)) for pending in pending_requests]
+
+        results = []
+        for pending, image in zip(pending_requests, images):
+            metrics.increment(f'sidecar.{self.model}.calls')
+            try:
+                results.append((pending, self.backend.run(image), None))
+            except Exception as e:
+                results.append((pending, None, str(e)))
+        return results
+
+
+def close_segment(segment):
+    try:
+        segment.close()
+    except BufferError:
+        # A view on it is still alive, the mapping goes away with it
+        pass
+
+
+class SidecarHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # A web worker keeps its connection and reuses one segment, so the
+        # segment is attached once per connection
+        segments = {}
+        pending = None
+        try:
+            while True:
+                message = recv_message(self.request)
+                if message is None:
+                    return
+                worker = self.server.workers.get(message.get('model'))
+                if worker is None:
+                    send_message(self.request, {'error': f"Model '{message.get('model')}' is not served."})
+                    continue
+                name = message['segment']
+                if name not in segments:
+                    if pending is not None:
+                        pending.done.wait()
+                    for segment in segments.values():
+                        close_segment(segment)
+                    segments = {name: attach_segment(name)}
+                try:
+                    pending = PendingRequest(self.request, message, segments[name])
+                except (TypeError, ValueError) as e:
+                    send_message(self.request, {'error': f"Invalid image tensor: {e}"})
+                    continue
+                worker.requests.put(pending)
+        except (OSError, ConnectionError, ValueError):
+            pass
+        finally:
+            # A client that timed out may leave a request queued, its reply is
+            # still written into the segment
+            if pending is not None:
+                pending.done.wait()
+            for segment in segments.values():
+                close_segment(segment)
+
+
+class SidecarServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, workers):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, SidecarHandler)
+        self.workers = workers
+        for worker in workers.values():
+            worker.start()
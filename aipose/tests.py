@@ -0,0 +1,773 @@
+import hashlib
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from io import BytesIO, StringIO
+from types import SimpleNamespace
+from unittest import mock, skipUnless
+
+import numpy as np
+from django.contrib.auth.models import AnonymousUser
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from PIL import Image as PILImage
+from rest_framework.parsers import FormParser, MultiPartParser
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory
+from rest_framework.views import APIView
+
+from . import admission, capture, metrics, phash, preload, preprocessing, profiling, sidecar, writebehind
+from .admission import Deadline, DeadlineExceeded, TokenBucket, UploadRejected, admit_image, admit_upload, get_limits
+from .backends import DEFAULT_MODELS, InferenceBackend, get_model_config
+from .bodypose import PoseAnalyzer
+from .cascade import ModelCascade
+from .deskpose import DeskPoseAnalyzer
+from .geometry import padding_for
+from .handcrop import HandCropAnalyzer, crop_landmarks_to_image, hand_rois
+from .handpose import HandPoseAnalyzer
+from .models import Image
+from .multipose import MultiPoseAnalyzer
+
+HAS_TENSORFLOW = importlib.util.find_spec('tensorflow') is not None
+
+
+def encode_image(image_format, size=(64, 48), **params):
+    buffer = BytesIO()
+    img = PILImage.new('RGB', size, 'red')
+    img.save(buffer, format=image_format, **params)
+    return buffer.getvalue()
+
+
+class AdmissionTests(SimpleTestCase):
+    def admit(self, data, name='upload.jpg', **limits):
+        upload = SimpleUploadedFile(name, data, content_type='image/jpeg')
+        return admit_image(upload, dict(get_limits(), **limits))
+
+    def test_accepts_jpeg_and_png(self):
+        self.admit(encode_image('JPEG'))
+        self.admit(encode_image('PNG'), name='upload.png')
+
+    def test_accepts_jpeg_with_mpf_segment(self):
+        # Pillow reports these phone camera JPEGs as MPO
+        data = encode_image('MPO', save_all=True, append_images=[PILImage.new('RGB', (64, 48))])
+        self.assertEqual(PILImage.open(BytesIO(data)).format, 'MPO')
+        self.admit(data)
+
+    def test_downscales_oversized_mpo(self):
+        data = encode_image('MPO', size=(400, 300), save_all=True, append_images=[PILImage.new('RGB', (400, 300))])
+        admitted = self.admit(data, max_image_dimension=200)
+        self.assertEqual(PILImage.open(admitted).size, (200, 150))
+
+    def test_rejects_non_image(self):
+        with self.assertRaises(UploadRejected) as raised:
+            self.admit(b'not an image at all')
+        self.assertEqual(raised.exception.status_code, 415)
+
+
+class UploadView(APIView):
+    @capture.capture_request
+    @admit_upload
+    def post(self, request):
+        return Response({'size': PILImage.open(request.FILES['image_file']).size}, status=201)
+
+
+class CaptureTests(SimpleTestCase):
+    def test_records_upload_before_admission(self):
+        capture_dir = tempfile.mkdtemp()
+        capture_file = os.path.join(capture_dir, 'requests.jsonl')
+        data = encode_image('JPEG', size=(400, 300))
+        upload = SimpleUploadedFile('photo.jpg', data, content_type='image/jpeg')
+        request = APIRequestFactory().post('/api/upload/', {'image_file': upload}, format='multipart')
+
+        with override_settings(AIPOSE_CAPTURE_SAMPLE_RATE=1.0, AIPOSE_CAPTURE_FILE=capture_file,
+                               AIPOSE_CAPTURE_STORE_IMAGES=True, AIPOSE_MAX_IMAGE_DIMENSION=200), \
+                mock.patch.object(capture, '_log', None):
+            response = UploadView.as_view()(request)
+            capture._log.close()
+
+        self.assertEqual(response.data['size'], (200, 150))
+        with open(capture_file) as f:
+            record = json.loads(f.readline())
+        self.assertEqual((record['image']['width'], record['image']['height']), (400, 300))
+        self.assertEqual(record['image']['upload_bytes'], len(data))
+        self.assertNotEqual(record['client'], hashlib.sha256(b'addr:127.0.0.1').hexdigest()[:16])
+        with open(os.path.join(capture_dir, 'images', record['image']['stored']), 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+
+class QuotaTests(SimpleTestCase):
+    def test_bucket_refuses_after_burst(self):
+        bucket = TokenBucket(rate=2, burst=2)
+        self.assertEqual(bucket.take('a'), 0)
+        self.assertEqual(bucket.take('a'), 0)
+        self.assertAlmostEqual(bucket.take('a'), 0.5, places=2)
+        self.assertEqual(bucket.take('b'), 0)
+
+    def test_invalid_bucket(self):
+        with self.assertRaises(ValueError):
+            TokenBucket(rate=0, burst=5)
+        with self.assertRaises(ValueError):
+            TokenBucket(rate=1, burst=0)
+
+    def test_anonymous_quota_ignores_session_id(self):
+        factory = RequestFactory()
+        keys = set()
+        for session_id in ('a', 'b'):
+            request = factory.post('/api/', HTTP_X_SESSION_ID=session_id, REMOTE_ADDR='203.0.113.7')
+            request.user = AnonymousUser()
+            keys.add(admission.quota_key(request))
+        self.assertEqual(keys, {'addr:203.0.113.7'})
+
+    @override_settings(AIPOSE_RATE_LIMIT=(0, 5))
+    def test_zero_rate_disables_quota(self):
+        with mock.patch.object(admission, '_quota', None):
+            self.assertIsNone(admission.get_quota())
+
+
+class MediaTests(SimpleTestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.media_root, 'images'))
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def write(self, name, data):
+        with open(os.path.join(self.media_root, 'images', name), 'wb') as f:
+            f.write(data)
+
+    def test_thumbnail(self):
+        self.write('photo.png', encode_image('PNG', size=(800, 600)))
+        response = self.client.get('/media/images/photo.png', {'size': 'thumb'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(PILImage.open(BytesIO(b''.join(response.streaming_content))).size, (256, 192))
+
+    def test_conditional_and_range_requests(self):
+        data = bytes(range(256)) * 4
+        self.write('annotated.jpg', data)
+        url = '/media/images/annotated.jpg'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), data)
+        etag = response['ETag']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        response = self.client.get(url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(data)}')
+        self.assertEqual(b''.join(response.streaming_content), data[10:20])
+
+        response = self.client.get(url, HTTP_RANGE='bytes=-16')
+        self.assertEqual(b''.join(response.streaming_content), data[-16:])
+
+        response = self.client.get(url, HTTP_RANGE=f'bytes={len(data)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(data)}')
+
+        # Last byte before the first: invalid, so the whole file is served
+        response = self.client.get(url, HTTP_RANGE='bytes=5-2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), data)
+
+        response = self.client.get(url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        response = self.client.get(url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), data)
+
+    def test_size_of_non_image(self):
+        self.write('notes.txt', b'not an image')
+        self.assertEqual(self.client.get('/media/images/notes.txt', {'size': 'thumb'}).status_code, 400)
+        self.assertEqual(self.client.get('/media/images/notes.txt').status_code, 200)
+
+
+class PreprocessingTests(SimpleTestCase):
+    def test_default_follows_simplejpeg(self):
+        with mock.patch.object(preprocessing, 'simplejpeg', None):
+            self.assertEqual(preprocessing.default_preprocessing(), 'tensorflow')
+            self.assertEqual(preprocessing.default_decoder(), 'pillow')
+            with self.assertRaises(ImportError):
+                preprocessing.load_rgb(BytesIO(encode_image('JPEG')), decoder='simplejpeg')
+
+    @skipUnless(HAS_TENSORFLOW, "TensorFlow is not installed")
+    @skipUnless(preprocessing.simplejpeg is not None, "simplejpeg is not installed")
+    def test_simplejpeg_matches_tensorflow(self):
+        call_command('check_preprocessing_parity', decoders=['simplejpeg'], stdout=StringIO())
+
+    @skipUnless(HAS_TENSORFLOW, "TensorFlow is not installed")
+    def test_pillow_within_tolerance(self):
+        call_command('check_preprocessing_parity', decoders=['pillow'], stdout=StringIO())
+
+
+class NearDuplicateTests(SimpleTestCase):
+    def drf_request(self, data=None, **extra):
+        request = RequestFactory().post('/api/', data or {}, **extra)
+        request.user = AnonymousUser()
+        return Request(request, parsers=[MultiPartParser(), FormParser()])
+
+    def test_anonymous_requests_without_session_are_not_matched(self):
+        self.assertIsNone(phash.client_cache_key(self.drf_request(REMOTE_ADDR='203.0.113.7')))
+        self.assertEqual(phash.client_cache_key(self.drf_request(HTTP_X_SESSION_ID='abc')), 'session:abc')
+        self.assertEqual(phash.client_cache_key(self.drf_request({'session_id': 'abc'})), 'session:abc')
+
+    @override_settings(AIPOSE_PHASH_ENABLED=True)
+    def test_namespaces_are_separate(self):
+        data = encode_image('PNG')
+
+        def run(cache_key, namespace, result):
+            return phash.reuse_or_run(cache_key, namespace, BytesIO(data), lambda: result)
+
+        with mock.patch.object(phash, '_index', phash.PerceptualHashIndex()):
+            self.assertEqual(run('session:abc', 'PoseAnalyzer', 'pose'), 'pose')
+            self.assertEqual(run('session:abc', 'PoseAnalyzer', 'again'), 'pose')
+            self.assertEqual(run('session:abc', 'DeskPoseAnalyzer', 'desk'), 'desk')
+            self.assertEqual(run('session:xyz', 'PoseAnalyzer', 'other'), 'other')
+
+
+class ProfilingTests(SimpleTestCase):
+    def test_sidecar_inference_is_counted_once(self):
+        # SidecarBackend.run (backends.py) calls SidecarClient.run (sidecar.py)
+        stats = mock.Mock(stats={
+            ('/srv/aipose/backends.py', 159, 'run'): (1, 1, 0.0001, 0.050, {}),
+            ('/srv/aipose/sidecar.py', 68, 'run'): (1, 1, 0.0001, 0.049, {}),
+            ('/srv/aipose/preprocessing.py', 180, 'preprocess_image'): (1, 1, 0.001, 0.004, {}),
+        })
+        self.assertEqual(profiling.stage_times(stats), {'inference': 50.0, 'preprocess': 4.0})
+
+
+class BackendTests(SimpleTestCase):
+    @override_settings(AIPOSE_MOVENET_MODELS={'lightning': {'tflite': '/srv/lightning.tflite'},
+                                              'custom': {'input_size': 320, 'onnx': '/srv/custom.onnx'}})
+    def test_model_settings_override_defaults(self):
+        lightning = get_model_config('lightning')
+        self.assertEqual(lightning['tflite'], '/srv/lightning.tflite')
+        self.assertEqual(lightning['savedmodel'], DEFAULT_MODELS['lightning']['savedmodel'])
+        self.assertEqual(get_model_config('custom')['input_size'], 320)
+        with self.assertRaises(ValueError):
+            get_model_config('unknown')
+
+    def test_backend_must_implement_run(self):
+        class Incomplete(InferenceBackend):
+            name = 'incomplete'
+
+        with self.assertRaises(TypeError):
+            Incomplete('unused')
+
+
+class StubBackend(InferenceBackend):
+    # Returns the same singlepose keypoints for every image
+    name = 'stub'
+
+    def __init__(self, keypoints_with_scores, input_size=192):
+        super().__init__('unused', input_size)
+        self.output = np.asarray(keypoints_with_scores, np.float32).reshape(1, 1, 17, 3)
+        self.calls = 0
+
+    def run(self, image):
+        self.calls += 1
+        return self.output
+
+
+def pose_keypoints(score=0.9, low=()):
+    keypoints = np.zeros((17, 3), np.float32)
+    keypoints[:, :2] = np.linspace(0.1, 0.9, 34).reshape(17, 2)
+    keypoints[:, 2] = score
+    keypoints[list(low), 2] = 0.05
+    return keypoints
+
+
+class CascadeTests(SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def analyze(self, lightning_keypoints, deadline=None):
+        self.tiers = {'lightning': StubBackend(lightning_keypoints), 'thunder': StubBackend(pose_keypoints(), 256)}
+        analyzer = PoseAnalyzer(backend=self.tiers['lightning'], cascade=ModelCascade(('lightning', 'thunder'), 0.2, 0.5))
+        with mock.patch('aipose.cascade.get_backend', self.tiers.get), \
+                mock.patch.object(PoseAnalyzer, 'preprocess_image', staticmethod(lambda path, size: None)):
+            return analyzer.analyze_pose('unused.jpg', deadline=deadline)
+
+    def test_keypoints_the_rules_ignore_do_not_escalate(self):
+        # Eyes, elbows and wrists hidden behind a desk, and a few required
+        # keypoints low: over half of all 17, under half of the required ones
+        self.analyze(pose_keypoints(low=(1, 2, 7, 8, 9, 10, 13, 14, 15)))
+        self.assertEqual(self.tiers['thunder'].calls, 0)
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['cascade.lightning.answered'], 1)
+        self.assertNotIn('cascade.lightning.escalated', counters)
+
+    def test_escalates_when_required_keypoints_are_low(self):
+        results, keypoints_with_scores, scores = self.analyze(pose_keypoints(low=(0, 3, 4, 11, 12, 13, 14)))
+        self.assertEqual(self.tiers['thunder'].calls, 1)
+        np.testing.assert_array_equal(keypoints_with_scores, pose_keypoints())
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['cascade.lightning.runs'], 1)
+        self.assertEqual(counters['cascade.lightning.escalated'], 1)
+        self.assertEqual(counters['cascade.thunder.runs'], 1)
+        self.assertEqual(counters['cascade.thunder.answered'], 1)
+
+    def test_deadline_is_checked_before_escalating(self):
+        with self.assertRaises(DeadlineExceeded) as raised:
+            self.analyze(pose_keypoints(low=(0, 3, 4, 11, 12, 13, 14)), deadline=Deadline(0))
+        self.assertEqual(raised.exception.stage, 'escalation')
+        self.assertEqual(self.tiers['lightning'].calls, 1)
+        self.assertEqual(self.tiers['thunder'].calls, 0)
+
+
+class SlowBackend(InferenceBackend):
+    name = 'slow'
+    delay = 0.0
+
+    def run(self, image):
+        time.sleep(self.delay)
+        return np.full((len(image), 1, 17, 3), image[:, 0, 0, 0, np.newaxis, np.newaxis, np.newaxis], np.float32)
+
+
+class SidecarTests(SimpleTestCase):
+    def setUp(self):
+        # Client and server share this process, and so its resource tracker
+        patcher = mock.patch.object(sidecar, 'resource_tracker')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.socket_path = os.path.join(tempfile.mkdtemp(), 'inference.sock')
+        self.backend = SlowBackend('unused')
+        self.server = sidecar.SidecarServer(self.socket_path, {'lightning': sidecar.ModelWorker('lightning', self.backend)})
+        self.errors = []
+        self.server.handle_error = lambda request, address: self.errors.append(sys.exc_info()[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_round_trip(self):
+        client = sidecar.SidecarClient(self.socket_path)
+        image = np.full((1, 192, 192, 3), 7, np.int32)
+        self.assertEqual(client.run('lightning', image)[0, 0, 0, 2], 7)
+        client.close()
+
+    def test_client_timeout_leaves_server_working(self):
+        self.backend.delay = 0.3
+        client = sidecar.SidecarClient(self.socket_path, timeout=0.05)
+        with self.assertRaises(RuntimeError):
+            client.run('lightning', np.zeros((1, 192, 192, 3), np.int32))
+        # The handler waits for the queued request before it closes the segment
+        time.sleep(0.5)
+        self.assertEqual(self.errors, [])
+
+        self.backend.delay = 0.0
+        client.timeout = 5.0
+        self.assertEqual(client.run('lightning', np.full((1, 192, 192, 3), 3, np.int32))[0, 0, 0, 2], 3)
+        client.close()
+
+
+class PreloadTests(SimpleTestCase):
+    @override_settings(AIPOSE_INFERENCE_BACKEND='savedmodel')
+    def test_models_level_falls_back_to_imports_when_not_fork_safe(self):
+        # Patched before import_module, mock.patch itself imports its target
+        with mock.patch('aipose.backends.get_backend') as get_backend, \
+                mock.patch('builtins.print') as print_warning, \
+                mock.patch.object(preload.importlib, 'import_module') as import_module:
+            preload.preload('models')
+        import_module.assert_any_call('tensorflow')
+        get_backend.assert_not_called()
+        print_warning.assert_called_once()
+
+    @override_settings(AIPOSE_INFERENCE_BACKEND='onnx')
+    def test_models_level_loads_fork_safe_backend(self):
+        with mock.patch('aipose.backends.get_backend') as get_backend, \
+                mock.patch.object(preload.importlib, 'import_module'):
+            preload.preload('models')
+        get_backend.assert_called_once_with('lightning')
+
+
+class WriteBehindTests(TestCase):
+    def setUp(self):
+        self.journal_dir = tempfile.mkdtemp()
+
+    def make_buffer(self):
+        buffer = writebehind.WriteBehindBuffer(self.journal_dir, max_rows=100, interval=3600, fsync=False)
+        self.addCleanup(buffer.close)
+        return buffer
+
+    def journal_files(self):
+        return sorted(os.listdir(self.journal_dir))
+
+    def write_journal(self, name, titles):
+        records = [{'title': title, 'image_file': f'images/{title}.jpg', 'write_id': str(uuid.uuid4())}
+                   for title in titles]
+        with open(os.path.join(self.journal_dir, name), 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+            # Torn last line of a crash mid-write
+            f.write('{"title": "torn')
+        return records
+
+    def dead_pid(self):
+        process = subprocess.Popen(['true'])
+        process.wait()
+        return process.pid
+
+    def test_add_then_flush(self):
+        buffer = self.make_buffer()
+        buffer.add(title='a', image_file='images/a.jpg')
+        buffer.add(title='b', image_file='images/b.jpg')
+        self.assertEqual(Image.objects.count(), 0)
+        self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(sorted(Image.objects.values_list('title', flat=True)), ['a', 'b'])
+        self.assertEqual(buffer.flush(), 0)
+        # Only the fresh, empty journal is left
+        self.assertEqual(self.journal_files(), [os.path.basename(buffer.journal_path)])
+
+    def test_failed_flush_is_retried(self):
+        buffer = self.make_buffer()
+        buffer.add(title='a', image_file='images/a.jpg')
+        with mock.patch.object(writebehind, 'write_records', side_effect=RuntimeError("database is locked")):
+            with self.assertRaises(RuntimeError):
+                buffer.flush()
+        self.assertEqual(Image.objects.count(), 0)
+        self.assertEqual(len([name for name in self.journal_files() if name.endswith('.flushing')]), 1)
+
+        buffer.add(title='b', image_file='images/b.jpg')
+        self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(Image.objects.count(), 2)
+        self.assertFalse([name for name in self.journal_files() if name.endswith('.flushing')])
+
+    def test_replay_skips_rows_already_written(self):
+        records = self.write_journal(f'host-{self.dead_pid()}.jsonl', ['a', 'b'])
+        writebehind.write_records(records[:1])
+        with mock.patch.object(writebehind.socket, 'gethostname', return_value='host'):
+            self.assertEqual(writebehind.replay_journals(self.journal_dir), 2)
+        self.assertEqual(sorted(Image.objects.values_list('title', flat=True)), ['a', 'b'])
+
+    def test_replay_journals_of_dead_process(self):
+        host = 'web-1.example.com'
+        pid = self.dead_pid()
+        self.write_journal(f'{host}-{pid}.jsonl', ['a'])
+        self.write_journal(f'{host}-{pid}.{time.time_ns()}.flushing', ['b', 'c'])
+        # A live process keeps its journal, and other hosts are left alone
+        self.write_journal(f'{host}-1.jsonl', ['live'])
+        self.write_journal(f'web-{pid}.jsonl', ['other host'])
+
+        with mock.patch.object(writebehind.socket, 'gethostname', return_value=host):
+            self.assertEqual(writebehind.replay_journals(self.journal_dir), 3)
+        self.assertEqual(sorted(Image.objects.values_list('title', flat=True)), ['a', 'b', 'c'])
+        self.assertEqual(self.journal_files(), [f'{host}-1.jsonl', f'web-{pid}.jsonl'])
+
+    def test_journal_owner(self):
+        self.assertEqual(writebehind.journal_owner('db.local-42.jsonl', 'db.local'), 42)
+        self.assertEqual(writebehind.journal_owner('db.local-42.1700000000.flushing', 'db.local'), 42)
+        self.assertIsNone(writebehind.journal_owner('web-1.example.com-42.jsonl', 'web'))
+
+
+# The per-person rules as they were before analyze_keypoints was vectorized,
+# kept as the reference the vectorized rules must reproduce
+
+def scalar_angle(point1, point2, point3):
+    a = np.array([point1[0] - point2[0], point1[1] - point2[1]])
+    b = np.array([point3[0] - point2[0], point3[1] - point2[1]])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.degrees(np.arccos(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))))
+
+
+def scalar_horizontal_angle(point1, point2):
+    vector = np.array([point2[0] - point1[0], point2[1] - point1[1]])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.degrees(np.arccos(np.dot(vector, np.array([1, 0])) / np.linalg.norm(vector))) - 90
+
+
+def facing(keypoints):
+    nose, left_ear, right_ear = keypoints[0], keypoints[3], keypoints[4]
+    if abs(nose[0] - left_ear[0]) < abs(nose[0] - right_ear[0]):
+        return "left"
+    if abs(nose[0] - left_ear[0]) > abs(nose[0] - right_ear[0]):
+        return "right"
+    return "ambiguous"
+
+
+def balance(left_shoulder, right_shoulder):
+    results = ""
+    if scalar_angle(left_shoulder, (left_shoulder + right_shoulder) / 2, right_shoulder) < 160:
+        results += "Back is not straight.\n"
+    else:
+        results += "Back is straight.\n"
+    if abs(left_shoulder[1] - right_shoulder[1]) > 0.1:
+        if left_shoulder[1] > right_shoulder[1]:
+            results += "Leaning to the right.\n"
+        else:
+            results += "Leaning to the left.\n"
+    else:
+        results += "Body is well balanced.\n"
+    return results
+
+
+def scalar_seated_findings(keypoints_with_scores):
+    keypoints = keypoints_with_scores[:, :2]
+    scores = keypoints_with_scores[:, 2]
+    if np.sum(scores < 0.2) / len(scores) > 0.75:
+        return "Improper picture. Please provide a clearer image."
+
+    left_shoulder, right_shoulder = keypoints[5], keypoints[6]
+    left_knee, right_knee, left_ankle, right_ankle = keypoints[13], keypoints[14], keypoints[15], keypoints[16]
+    results = ""
+    facing_side = facing(keypoints)
+    if facing_side == "ambiguous":
+        results += "Facing direction is ambiguous or frontal.\n"
+    else:
+        side = (6, 12, 14, 16) if facing_side == "left" else (5, 11, 13, 15)
+        shoulder, hip, knee, ankle = (keypoints[i] for i in side)
+        results += f"The {facing_side} side of the person is facing the camera.\n"
+        shoulder_hip_knee_angle = scalar_angle(shoulder, hip, knee)
+        hip_knee_ankle_angle = scalar_angle(hip, knee, ankle)
+        if 85 <= shoulder_hip_knee_angle <= 115:
+            results += "Correct sitting posture.\n"
+        elif shoulder_hip_knee_angle < 85:
+            results += "Leaning forward.\n"
+        else:
+            results += "Leaning backward.\n"
+        if 90 <= hip_knee_ankle_angle <= 110:
+            results += "Hip in line with legs.\n"
+        elif hip_knee_ankle_angle < 90:
+            results += "Hip lower than knees.\n"
+        else:
+            results += "Hip higher than knees.\n"
+        results += balance(left_shoulder, right_shoulder)
+
+    if abs(left_ankle[0] - right_ankle[0]) < 0.05:
+        results += "Both feet are placed on the ground.\n"
+    else:
+        results += "Feet are not evenly placed on the ground or at least one foot is not on the ground.\n"
+    if abs(left_knee[1] - right_knee[1]) < 0.1 or abs(left_ankle[1] - right_ankle[1]) < 0.1:
+        results += "The legs are not crossed.\n"
+    else:
+        results += "The legs are crossed.\n"
+    return results
+
+
+def scalar_desk_findings(keypoints_with_scores):
+    keypoints = keypoints_with_scores[:, :2]
+    scores = keypoints_with_scores[:, 2]
+    of_interest = [0, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
+    if np.sum(scores[of_interest] < 0.2) / len(of_interest) > 0.75:
+        return "Improper picture. Please take a better picture."
+
+    nose, left_shoulder, right_shoulder = keypoints[0], keypoints[5], keypoints[6]
+    results = ""
+    facing_side = facing(keypoints)
+    if facing_side == "ambiguous":
+        return results + "Facing direction is ambiguous or frontal.\n"
+
+    shoulder, elbow, wrist = (keypoints[i] for i in ((6, 8, 10) if facing_side == "left" else (5, 7, 9)))
+    results += f"The {facing_side} side of the person is facing the camera.\n"
+    shoulder_elbow_wrist_angle = scalar_angle(shoulder, elbow, wrist)
+    neck_angle = scalar_horizontal_angle((left_shoulder + right_shoulder) / 2, nose)
+    if shoulder_elbow_wrist_angle < 90:
+        results += "The desk is too high.\n"
+    elif shoulder_elbow_wrist_angle > 120:
+        results += "Table too low.\n"
+    else:
+        results += "Correct table height.\n"
+
+    shoulder_wrist_distance = np.linalg.norm(np.array(shoulder) - np.array(wrist))
+    if shoulder_wrist_distance > 0.15:
+        results += "Table too far.\n"
+    elif shoulder_wrist_distance < 0.15 / 2:
+        results += "Table too close.\n"
+    else:
+        results += "Table at a good distance.\n"
+
+    if neck_angle > 5:
+        results += "Looking upwards.\n"
+    elif neck_angle < -5:
+        results += "Looking downwards.\n"
+    else:
+        results += "Good neck position.\n"
+
+    if abs(wrist[1] - elbow[1]) > 0.1:
+        if wrist[1] > elbow[1]:
+            results += "Wrist higher than elbow.\n"
+        else:
+            results += "Wrist lower than elbow.\n"
+    return results + balance(left_shoulder, right_shoulder)
+
+
+def random_people(count, seed=0):
+    rng = np.random.default_rng(seed)
+    people = rng.random((count, 17, 3)).astype(np.float32)
+    # Coarse coordinates for a quarter of them, so ties (frontal faces,
+    # coincident points) and rule boundaries come up too
+    coarse = people[:count // 4, :, :2]
+    people[:count // 4, :, :2] = np.round(coarse * 10) / 10
+    return people
+
+
+class PoseRulesTests(SimpleTestCase):
+    def assert_matches_scalar(self, rules_class, reference):
+        people = random_people(5000)
+        findings = rules_class.analyze_keypoints(people)
+        mismatches = [i for i, person in enumerate(people) if findings[i] != reference(person)]
+        self.assertEqual(mismatches, [])
+
+    def test_seated_rules_match_scalar_rules(self):
+        self.assert_matches_scalar(PoseAnalyzer, scalar_seated_findings)
+
+    def test_desk_rules_match_scalar_rules(self):
+        self.assert_matches_scalar(DeskPoseAnalyzer, scalar_desk_findings)
+
+
+class MultiPoseTests(SimpleTestCase):
+    def test_people_are_mapped_to_image_pixels(self):
+        detections = np.zeros((1, 6, 56), np.float32)
+        for person, (score, y, x) in enumerate([(0.9, 100, 50), (0.1, 0, 0), (0.6, 20, 200)]):
+            # 640x480 into 256: scale 2.5, 32 rows of padding above
+            detections[0, person, :51].reshape(17, 3)[:] = ((32 + y) / 256, x / 256, 0.8)
+            detections[0, person, 51:55] = (32 / 256, 0, 224 / 256, 1)
+            detections[0, person, 55] = score
+        backend = mock.Mock(input_size=256)
+        backend.run.return_value = detections
+
+        with mock.patch('aipose.multipose.preprocess_image'):
+            people = MultiPoseAnalyzer(PoseAnalyzer, backend=backend).analyze_pose('unused.jpg', 640, 480)
+
+        # The person under min_person_score is dropped
+        self.assertEqual([person['score'] for person in people], [0.9, 0.6])
+        self.assertEqual(people[0]['keypoints'][0], [250.0, 125.0, 0.8])
+        self.assertEqual(people[1]['keypoints'][16], [50.0, 500.0, 0.8])
+        self.assertEqual(people[0]['bbox'], [0.0, 0.0, 640.0, 480.0])
+        self.assertEqual(people[1]['findings'], PoseAnalyzer.analyze_keypoints(detections[0, 2:3, :51].reshape(1, 17, 3))[0])
+
+
+# The hand rules as they were before they ran on landmark arrays, on
+# mediapipe-style landmark objects
+
+def scalar_hand_findings(landmarks):
+    results = ""
+    wrist, middle_mcp, middle_tip = landmarks[0], landmarks[9], landmarks[12]
+    if middle_tip.y < middle_mcp.y and middle_tip.y < wrist.y:
+        results += "  Hand is bent inwards.\n"
+    elif middle_tip.y > middle_mcp.y and middle_tip.y > wrist.y:
+        results += "  Hand is bent outwards.\n"
+    else:
+        results += "  Hand is not bent inwards or outwards.\n"
+
+    index_mcp, pinky_mcp = landmarks[5], landmarks[17]
+    if index_mcp.y < wrist.y and pinky_mcp.y < wrist.y:
+        results += "  Wrist is flexed upwards.\n"
+    elif index_mcp.y > wrist.y and pinky_mcp.y > wrist.y:
+        results += "  Wrist is flexed downwards.\n"
+    else:
+        results += "  Wrist is not flexed upwards or downwards.\n"
+
+    bent_fingers = sum(
+        np.linalg.norm(np.array([landmarks[tip].x, landmarks[tip].y])
+                       - np.array([landmarks[tip - 2].x, landmarks[tip - 2].y])) < 0.1
+        for tip in [8, 12, 16, 20])
+    results += "  Claw grip detected.\n" if bent_fingers >= 3 else "  Claw grip not detected.\n"
+
+    extended_fingers = sum(landmarks[tip].y < landmarks[tip - 1].y < landmarks[tip - 2].y for tip in [8, 12, 16, 20])
+    results += "  Fingers are extended.\n" if extended_fingers >= 3 else "  Fingers are not extended.\n"
+    return results
+
+
+def scalar_landmarks_string(detection_result):
+    return "".join(scalar_hand_findings(detection_result.hand_landmarks[i])
+                   for i, handedness_list in enumerate(detection_result.handedness)
+                   for _ in handedness_list)
+
+
+def random_detection(rng, coarse=False):
+    hands = rng.integers(1, 3)
+    points = rng.random((hands, 21, 3))
+    if coarse:
+        # Ties between landmarks and claw distances right at the threshold
+        points = np.round(points * 10) / 10
+    return SimpleNamespace(
+        hand_landmarks=[[SimpleNamespace(x=x, y=y, z=z) for x, y, z in hand] for hand in points],
+        # Usually one handedness category per hand, sometimes none or two
+        handedness=[[SimpleNamespace(category_name='Left')] * int(rng.choice([0, 1, 1, 1, 2]))
+                    for _ in range(hands)],
+    )
+
+
+class HandRulesTests(SimpleTestCase):
+    def setUp(self):
+        # No detector, the detection results are stubs and mediapipe is not needed
+        self.analyzer = HandPoseAnalyzer.__new__(HandPoseAnalyzer)
+
+    def test_rules_match_per_landmark_rules(self):
+        rng = np.random.default_rng(0)
+        for i in range(5000):
+            detection_result = random_detection(rng, coarse=i % 4 == 0)
+            self.assertEqual(self.analyzer.get_landmarks_string(detection_result),
+                             scalar_landmarks_string(detection_result))
+
+    def test_analyze_hand_pose(self):
+        rng = np.random.default_rng(1)
+        detection_result = random_detection(rng)
+        detection_result.handedness = [[SimpleNamespace(category_name='Left')]] * len(detection_result.hand_landmarks)
+        self.analyzer.detect = lambda image: detection_result
+        self.assertEqual(self.analyzer.analyze_hand_pose('unused.jpg'), scalar_landmarks_string(detection_result))
+
+        self.analyzer.detect = lambda image: SimpleNamespace(hand_landmarks=[], handedness=[])
+        self.assertEqual(self.analyzer.analyze_hand_pose('unused.jpg'), "No hands detected. Please take another picture.")
+
+
+def movenet_keypoints(points, width, height, input_size=192):
+    # (index, y, x, score) in image pixels to normalized MoveNet output
+    scale, pad_y, pad_x = padding_for(width, height, input_size)
+    keypoints = np.zeros((17, 3))
+    for index, y, x, score in points:
+        keypoints[index] = ((y / scale + pad_y) / input_size, (x / scale + pad_x) / input_size, score)
+    return keypoints
+
+
+class HandCropTests(SimpleTestCase):
+    def test_box_follows_the_forearm(self):
+        # Left elbow at (300, 100), wrist at (300, 200): the hand extends to the right
+        keypoints = movenet_keypoints([(7, 300, 100, 0.9), (9, 300, 200, 0.9)], 640, 480)
+        self.assertEqual(hand_rois(keypoints, 640, 480), [(180, 240, 300, 360)])
+
+    def test_box_around_wrist_without_elbow(self):
+        keypoints = movenet_keypoints([(8, 300, 100, 0.1), (10, 200, 400, 0.9)], 640, 480)
+        # A quarter of the short side, centered on the wrist
+        self.assertEqual(hand_rois(keypoints, 640, 480), [(340, 140, 460, 260)])
+
+    def test_overlapping_hands_are_cropped_once(self):
+        keypoints = movenet_keypoints([(9, 200, 300, 0.9), (10, 200, 320, 0.9)], 640, 480)
+        self.assertEqual(hand_rois(keypoints, 640, 480), [(240, 140, 380, 260)])
+
+    def test_crop_landmarks_map_to_image(self):
+        landmarks = np.array([[[0.5, 0.5, 0.1], [0.0, 1.0, 0.0]]])
+        mapped = crop_landmarks_to_image(landmarks, (100, 50, 300, 250), 400, 300)
+        np.testing.assert_allclose(mapped, [[[0.5, 0.5, 0.05], [0.25, 250 / 300, 0.0]]])
+
+    def test_full_frame_fallback_matches_hand_analyzer(self):
+        image_path = os.path.join(tempfile.mkdtemp(), 'hands.png')
+        with open(image_path, 'wb') as f:
+            f.write(encode_image('PNG', size=(640, 480)))
+        hand = [SimpleNamespace(x=x, y=y, z=z) for x, y, z in np.random.default_rng(2).random((21, 3))]
+        # The second hand has no handedness category and is not reported
+        detection_result = SimpleNamespace(hand_landmarks=[hand, hand],
+                                           handedness=[[SimpleNamespace(category_name='Left')], []])
+        hand_analyzer = HandPoseAnalyzer.__new__(HandPoseAnalyzer)
+        hand_analyzer.detect = lambda image: detection_result
+        # No confident wrists, so no crops
+        backend = StubBackend(np.zeros((17, 3)))
+
+        with mock.patch('aipose.handcrop.preprocess_image'):
+            landmarks = HandCropAnalyzer(hand_analyzer, backend).detect_landmarks(image_path)
+        np.testing.assert_array_equal(landmarks, hand_analyzer.detect_landmarks(image_path))
+        self.assertEqual(len(landmarks), 1)
@@ -15,11 +15,12 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import include, path
-from .views import SeatedPosture,HandPosition,DeskPosition
+from django.urls import include, path, re_path
+from .views import SeatedPosture,HandPosition,DeskPosition,Metrics,Profiles,ProfileDetail
+from .media import serve_media
 from django.conf import settings
-from django.conf.urls.static import static
 from django.http import HttpResponse
+import re
 
 def home_view(request):
     return HttpResponse("Welcome to the homepage!")
@@ -29,8 +30,15 @@ urlpatterns = [
     path('api/images/seatedposture/', SeatedPosture.as_view(), name='image-list'),
     path('api/images/handposition/', HandPosition.as_view(), name='image-list'),
     path('api/images/deskposition/', DeskPosition.as_view(), name='image-list'),
+    path('api/metrics/', Metrics.as_view(), name='metrics'),
+    path('api/profiles/', Profiles.as_view(), name='profiles'),
+    re_path(r'^api/profiles/(?P<profile_id>\d{8}-\d{6}-[0-9a-f]{32})/$', ProfileDetail.as_view(), name='profile-detail'),
     path('', home_view, name='home'),
 ]
 
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+# Annotated images and their thumbnail/preview derivatives, with ETags and
+# cache headers. Turn off when a front web server serves MEDIA_ROOT.
+if getattr(settings, 'AIPOSE_SERVE_MEDIA', True):
+    urlpatterns += [
+        re_path(r'^%s(?P<path>.*)$' % re.escape(settings.MEDIA_URL.lstrip('/')), serve_media, name='media'),
+    ]
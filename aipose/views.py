@@ -2,18 +2,68 @@ from rest_framework.views import APIView
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.permissions import IsAdminUser
 from django.core.files.storage import default_storage
+from django.http import FileResponse, Http404
 from django.conf import settings
 from PIL import Image as PILImage, ImageDraw
 import os
-import tensorflow as tf
-import numpy as np
 
 from .models import Image
 from .serializers import ImageSerializer
 from .bodypose import PoseAnalyzer
 from .handpose import HandPoseAnalyzer
+from .handcrop import HandCropAnalyzer
 from .deskpose import DeskPoseAnalyzer
+from .multipose import MultiPoseAnalyzer
+from .admission import DeadlineExceeded, admit_upload, shed_load
+from .profiling import list_profiles, profile_path, profile_request
+from .capture import capture_request
+from .phash import client_cache_key, get_index
+from .writebehind import save_image
+from . import metrics
+
+
+# Example skeleton structure for connecting keypoints
+SKELETON = [
+    (3, 5), (5, 7), (7, 9), (2, 4),
+    (4, 6), (6, 8), (5, 6), (5, 11),
+    (6, 12), (11, 12), (11, 13), (13, 15),
+    (12, 14), (14, 16), (1, 3), (2, 4), (0, 1),
+    (0, 2), (0, 3), (0, 4), (8, 10)
+]
+
+
+def wants_multi_person(request):
+    value = request.data.get('multi_person', request.query_params.get('multi_person', ''))
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
+# Adjust keypoints to the original image dimensions
+def adjust_keypoints(keypoints, original_width, original_height, target_width=192, target_height=192):
+    width_ratio = original_width / target_width
+    height_ratio = original_height / target_height
+    adjusted_keypoints = []
+    for keypoint in keypoints:
+        x, y = keypoint[1] * target_width, keypoint[0] * target_height
+        adjusted_keypoints.append((y * height_ratio, x * width_ratio))
+    return adjusted_keypoints
+
+
+def draw_skeleton(draw, adjusted_keypoints, scores):
+    for i, keypoint in enumerate(adjusted_keypoints):
+        x, y = keypoint[1], keypoint[0]
+        color = 'green' if scores[i] > 0.3 else 'red'
+        draw.ellipse((x-7, y-7, x+7, y+7), fill=color, outline=color)
+
+    # Draw lines based on the skeleton structure
+    for start, end in SKELETON:
+        if start < len(adjusted_keypoints) and end < len(adjusted_keypoints):
+            start_x, start_y = adjusted_keypoints[start][1], adjusted_keypoints[start][0]
+            end_x, end_y = adjusted_keypoints[end][1], adjusted_keypoints[end][0]
+            line_color = 'green' if scores[start] > 0.3 and scores[end] > 0.3 else 'red'
+            draw.line((start_x, start_y, end_x, end_y), fill=line_color, width=3)
+
 
 class SeatedPosture(APIView):
     parser_classes = (MultiPartParser, FormParser)
@@ -23,6 +73,10 @@ class SeatedPosture(APIView):
         serializer = ImageSerializer(images, many=True)
         return Response(serializer.data)
 
+    @capture_request
+    @profile_request
+    @shed_load
+    @admit_upload
     def post(self, request, *args, **kwargs):
         print("Request data:", request.data)
         print("Request FILES:", request.FILES)
@@ -41,71 +95,28 @@ class SeatedPosture(APIView):
             with PILImage.open(temp_image_full_path) as img:
                 original_width, original_height = img.size
 
-            # Preprocess the image
-            def preprocess_image(image_path):
-                try:
-                    image = tf.io.read_file(image_path)
-                    image = tf.image.decode_jpeg(image)
-                    image = tf.image.convert_image_dtype(image, dtype=tf.float32)
-                except tf.errors.InvalidArgumentError:
-                    raise ValueError("Invalid image file. Please check the image path and format.")
-                
-                image = tf.image.resize_with_pad(image, target_height=192, target_width=192)
-                image = tf.image.adjust_contrast(image, 300.0)
-                image = tf.cast(image, dtype=tf.int32)
-                return tf.expand_dims(image, axis=0)
-
-            preprocessed_image = preprocess_image(temp_image_full_path)
-
-            # Save the preprocessed image temporarily for analysis
-            preprocessed_image_path = 'preprocessed_' + image_file.name
-            preprocessed_image_full_path = os.path.join(settings.MEDIA_ROOT, 'tmp', preprocessed_image_path)
-            preprocessed_image_np = tf.squeeze(preprocessed_image).numpy()
-            preprocessed_image_pil = PILImage.fromarray(preprocessed_image_np.astype(np.uint8))
-            preprocessed_image_pil.save(preprocessed_image_full_path)
-
-            # Analyze the pose using PoseAnalyzer
-            pose_analyzer = PoseAnalyzer()
-            pose_results, keypoints_with_scores, scores = pose_analyzer.analyze_pose(temp_image_full_path)
-
-
-            # Adjust keypoints to the original image dimensions
-            def adjust_keypoints(keypoints, original_width, original_height, target_width=192, target_height=192):
-                width_ratio = original_width / target_width
-                height_ratio = original_height / target_height
-                adjusted_keypoints = []
-                for keypoint in keypoints:
-                    x, y = keypoint[1] * target_width, keypoint[0] * target_height
-                    adjusted_keypoints.append((y * height_ratio, x * width_ratio))
-                return adjusted_keypoints
-
-            adjusted_keypoints = adjust_keypoints(keypoints_with_scores, original_width, original_height)
-
-            # Example skeleton structure for connecting keypoints
-            skeleton = [
-                (3, 5), (5, 7), (7, 9), (2, 4),
-                (4, 6), (6, 8), (5, 6), (5, 11),
-                (6, 12), (11, 12), (11, 13), (13, 15),
-                (12, 14), (14, 16), (1, 3), (2, 4), (0, 1),
-                (0, 2), (0, 3), (0, 4), (8, 10)
-            ]
+            # Near-duplicate uploads from the same client reuse earlier inference results
+            cache_key = client_cache_key(request)
+            request.deadline.check('inference')
+
+            # Analyze the pose using PoseAnalyzer, or every person in frame with MoveNet MultiPose
+            if wants_multi_person(request):
+                multi_pose_analyzer = MultiPoseAnalyzer(PoseAnalyzer)
+                pose_results = multi_pose_analyzer.analyze_pose(temp_image_full_path, original_width, original_height, cache_key)
+                people = [([(y, x) for y, x, _ in person['keypoints']], [score for _, _, score in person['keypoints']])
+                          for person in pose_results]
+            else:
+                pose_analyzer = PoseAnalyzer()
+                pose_results, keypoints_with_scores, scores = pose_analyzer.analyze_pose(temp_image_full_path, cache_key, request.deadline)
+                people = [(adjust_keypoints(keypoints_with_scores, original_width, original_height), scores)]
+            request.deadline.check('annotation')
 
             # Draw keypoints and lines on the original image
             with PILImage.open(temp_image_full_path) as img:
                 draw = ImageDraw.Draw(img)
-                for i, keypoint in enumerate(adjusted_keypoints):
-                    x, y = keypoint[1], keypoint[0]
-                    color = 'green' if scores[i] > 0.3 else 'red'
-                    draw.ellipse((x-7, y-7, x+7, y+7), fill=color, outline=color)
-                
-                # Draw lines based on the skeleton structure
-                for start, end in skeleton:
-                    if start < len(adjusted_keypoints) and end < len(adjusted_keypoints):
-                        start_x, start_y = adjusted_keypoints[start][1], adjusted_keypoints[start][0]
-                        end_x, end_y = adjusted_keypoints[end][1], adjusted_keypoints[end][0]
-                        line_color = 'green' if scores[start] > 0.3 and scores[end] > 0.3 else 'red'
-                        draw.line((start_x, start_y, end_x, end_y), fill=line_color, width=3)
-                
+                for adjusted_keypoints, scores in people:
+                    draw_skeleton(draw, adjusted_keypoints, scores)
+
                 # Save the annotated image
                 annotated_image_path = 'annotated_' + image_file.name
                 annotated_image_full_path = os.path.join(settings.MEDIA_ROOT, 'images', annotated_image_path)
@@ -117,24 +128,22 @@ class SeatedPosture(APIView):
 
             # Clean up temporary files
             os.remove(temp_image_full_path)
-            os.remove(preprocessed_image_full_path)
 
             # Combine analysis results
             analysis_results = {
                 'pose_analysis': pose_results
             }
 
-            # Save image instance with annotated image
-            serializer = ImageSerializer(data={'title': request.data.get('title', ''),
-                                               'image_file': annotated_image_file})
-            if serializer.is_valid():
-                serializer.save()
-                image_instance = serializer.instance
+            # Save image instance with annotated image, batched by the write-behind buffer
+            save_image(title=request.data.get('title', '')[:255], image_file=annotated_image_file,
+                       analysis=analysis_results)
 
-                # Include analysis results in the response
-                return Response(analysis_results, status=status.HTTP_201_CREATED)
-            else:
-                return Response(analysis_results, status=status.HTTP_201_CREATED)
+            # Include analysis results in the response
+            return Response(analysis_results, status=status.HTTP_201_CREATED)
+        except DeadlineExceeded:
+            # Nobody is waiting for the result anymore, shed_load answers with 503
+            default_storage.delete(temp_image_path)
+            raise
         except Exception as e:
             print("Error during file processing:", str(e))
             return Response({"error": "An error occurred while processing the file."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -148,6 +157,10 @@ class HandPosition(APIView):
         serializer = ImageSerializer(images, many=True)
         return Response(serializer.data)
 
+    @capture_request
+    @profile_request
+    @shed_load
+    @admit_upload
     def post(self, request, *args, **kwargs):
         print("Request data:", request.data)
         print("Request FILES:", request.FILES)
@@ -166,32 +179,17 @@ class HandPosition(APIView):
             with PILImage.open(temp_image_full_path) as img:
                 original_width, original_height = img.size
 
-            # Preprocess the image
-            def preprocess_image(image_path):
-                try:
-                    image = tf.io.read_file(image_path)
-                    image = tf.image.decode_jpeg(image)
-                    image = tf.image.convert_image_dtype(image, dtype=tf.float32)
-                except tf.errors.InvalidArgumentError:
-                    raise ValueError("Invalid image file. Please check the image path and format.")
-                
-                image = tf.image.resize_with_pad(image, target_height=192, target_width=192)
-                image = tf.image.adjust_contrast(image, 300.0)
-                image = tf.cast(image, dtype=tf.int32)
-                return tf.expand_dims(image, axis=0)
-
-            preprocessed_image = preprocess_image(temp_image_full_path)
-
-            # Save the preprocessed image temporarily for analysis
-            preprocessed_image_path = 'preprocessed_' + image_file.name
-            preprocessed_image_full_path = os.path.join(settings.MEDIA_ROOT, 'tmp', preprocessed_image_path)
-            preprocessed_image_np = tf.squeeze(preprocessed_image).numpy()
-            preprocessed_image_pil = PILImage.fromarray(preprocessed_image_np.astype(np.uint8))
-            preprocessed_image_pil.save(preprocessed_image_full_path)
+            # Near-duplicate uploads from the same client reuse earlier inference results
+            cache_key = client_cache_key(request)
+            request.deadline.check('inference')
 
-            # Analyze the hand pose using HandPoseAnalyzer
-            hand_pose_analyzer = HandPoseAnalyzer()
-            hand_results = hand_pose_analyzer.analyze_hand_pose(temp_image_full_path)
+            # Analyze the hand pose, optionally cropping around the MoveNet wrists first
+            if getattr(settings, 'AIPOSE_HAND_TWO_STAGE', False):
+                hand_pose_analyzer = HandCropAnalyzer()
+            else:
+                hand_pose_analyzer = HandPoseAnalyzer()
+            hand_results = hand_pose_analyzer.analyze_hand_pose(temp_image_full_path, cache_key)
+            request.deadline.check('annotation')
 
             # Draw keypoints and lines on the original image
             with PILImage.open(temp_image_full_path) as img:
@@ -207,23 +205,22 @@ class HandPosition(APIView):
 
             # Clean up temporary files
             os.remove(temp_image_full_path)
-            os.remove(preprocessed_image_full_path)
 
             # Combine analysis results
             analysis_results = {
                 'hand_pose_analysis': hand_results
             }
 
-            # Save image instance with annotated image
-            serializer = ImageSerializer(data={'title': request.data.get('title', ''),
-                                               'image_file': annotated_image_file})
-            if serializer.is_valid():
-                serializer.save()
+            # Save image instance with annotated image, batched by the write-behind buffer
+            save_image(title=request.data.get('title', '')[:255], image_file=annotated_image_file,
+                       analysis=analysis_results)
 
-                # Include analysis results in the response
-                return Response(analysis_results, status=status.HTTP_201_CREATED)
-            else:
-                return Response(analysis_results, status=status.HTTP_201_CREATED)
+            # Include analysis results in the response
+            return Response(analysis_results, status=status.HTTP_201_CREATED)
+        except DeadlineExceeded:
+            # Nobody is waiting for the result anymore, shed_load answers with 503
+            default_storage.delete(temp_image_path)
+            raise
         except Exception as e:
             print("Error during file processing:", str(e))
             return Response({"error": "An error occurred while processing the file."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -236,6 +233,10 @@ class DeskPosition(APIView):
         serializer = ImageSerializer(images, many=True)
         return Response(serializer.data)
 
+    @capture_request
+    @profile_request
+    @shed_load
+    @admit_upload
     def post(self, request, *args, **kwargs):
         print("Request data:", request.data)
         print("Request FILES:", request.FILES)
@@ -254,72 +255,28 @@ class DeskPosition(APIView):
             with PILImage.open(temp_image_full_path) as img:
                 original_width, original_height = img.size
 
-            # Preprocess the image
-            def preprocess_image(image_path):
-                try:
-                    image = tf.io.read_file(image_path)
-                    image = tf.image.decode_jpeg(image)
-                    image = tf.image.convert_image_dtype(image, dtype=tf.float32)
-                except tf.errors.InvalidArgumentError:
-                    raise ValueError("Invalid image file. Please check the image path and format.")
-                
-                image = tf.image.resize_with_pad(image, target_height=192, target_width=192)
-                image = tf.image.adjust_contrast(image, 300.0)
-                image = tf.cast(image, dtype=tf.int32)
-                return tf.expand_dims(image, axis=0)
-
-            preprocessed_image = preprocess_image(temp_image_full_path)
-
-            # Save the preprocessed image temporarily for analysis
-            preprocessed_image_path = 'preprocessed_' + image_file.name
-            preprocessed_image_full_path = os.path.join(settings.MEDIA_ROOT, 'tmp', preprocessed_image_path)
-            preprocessed_image_np = tf.squeeze(preprocessed_image).numpy()
-            preprocessed_image_pil = PILImage.fromarray(preprocessed_image_np.astype(np.uint8))
-            preprocessed_image_pil.save(preprocessed_image_full_path)
-
-            # Analyze the pose using PoseAnalyzer
-            pose_analyzer = DeskPoseAnalyzer()
-            pose_results, keypoints_with_scores, scores = pose_analyzer.analyze_pose(temp_image_full_path)
-
-           
-
-            # Adjust keypoints to the original image dimensions
-            def adjust_keypoints(keypoints, original_width, original_height, target_width=192, target_height=192):
-                width_ratio = original_width / target_width
-                height_ratio = original_height / target_height
-                adjusted_keypoints = []
-                for keypoint in keypoints:
-                    x, y = keypoint[1] * target_width, keypoint[0] * target_height
-                    adjusted_keypoints.append((y * height_ratio, x * width_ratio))
-                return adjusted_keypoints
-
-            adjusted_keypoints = adjust_keypoints(keypoints_with_scores, original_width, original_height)
-
-            # Example skeleton structure for connecting keypoints
-            skeleton = [
-                (3, 5), (5, 7), (7, 9), (2, 4),
-                (4, 6), (6, 8), (5, 6), (5, 11),
-                (6, 12), (11, 12), (11, 13), (13, 15),
-                (12, 14), (14, 16), (1, 3), (2, 4), (0, 1),
-                (0, 2), (0, 3), (0, 4), (8, 10)
-            ]
+            # Near-duplicate uploads from the same client reuse earlier inference results
+            cache_key = client_cache_key(request)
+            request.deadline.check('inference')
+
+            # Analyze the pose using DeskPoseAnalyzer, or every person in frame with MoveNet MultiPose
+            if wants_multi_person(request):
+                multi_pose_analyzer = MultiPoseAnalyzer(DeskPoseAnalyzer)
+                pose_results = multi_pose_analyzer.analyze_pose(temp_image_full_path, original_width, original_height, cache_key)
+                people = [([(y, x) for y, x, _ in person['keypoints']], [score for _, _, score in person['keypoints']])
+                          for person in pose_results]
+            else:
+                pose_analyzer = DeskPoseAnalyzer()
+                pose_results, keypoints_with_scores, scores = pose_analyzer.analyze_pose(temp_image_full_path, cache_key, request.deadline)
+                people = [(adjust_keypoints(keypoints_with_scores, original_width, original_height), scores)]
+            request.deadline.check('annotation')
 
             # Draw keypoints and lines on the original image
             with PILImage.open(temp_image_full_path) as img:
                 draw = ImageDraw.Draw(img)
-                for i, keypoint in enumerate(adjusted_keypoints):
-                    x, y = keypoint[1], keypoint[0]
-                    color = 'green' if scores[i] > 0.3 else 'red'
-                    draw.ellipse((x-7, y-7, x+7, y+7), fill=color, outline=color)
-                
-                # Draw lines based on the skeleton structure
-                for start, end in skeleton:
-                    if start < len(adjusted_keypoints) and end < len(adjusted_keypoints):
-                        start_x, start_y = adjusted_keypoints[start][1], adjusted_keypoints[start][0]
-                        end_x, end_y = adjusted_keypoints[end][1], adjusted_keypoints[end][0]
-                        line_color = 'green' if scores[start] > 0.3 and scores[end] > 0.3 else 'red'
-                        draw.line((start_x, start_y, end_x, end_y), fill=line_color, width=3)
-                
+                for adjusted_keypoints, scores in people:
+                    draw_skeleton(draw, adjusted_keypoints, scores)
+
                 # Save the annotated image
                 annotated_image_path = 'annotated_' + image_file.name
                 annotated_image_full_path = os.path.join(settings.MEDIA_ROOT, 'images', annotated_image_path)
@@ -331,25 +288,54 @@ class DeskPosition(APIView):
 
             # Clean up temporary files
             os.remove(temp_image_full_path)
-            os.remove(preprocessed_image_full_path)
 
             # Combine analysis results
             analysis_results = {
                 'pose_analysis': pose_results,
             }
 
-            # Save image instance with annotated image
-            serializer = ImageSerializer(data={'title': request.data.get('title', ''),
-                                               'image_file': annotated_image_file})
-            if serializer.is_valid():
-                serializer.save()
-                image_instance = serializer.instance
+            # Save image instance with annotated image, batched by the write-behind buffer
+            save_image(title=request.data.get('title', '')[:255], image_file=annotated_image_file,
+                       analysis=analysis_results)
 
-                # Include analysis results in the response
-                return Response(analysis_results, status=status.HTTP_201_CREATED)
-            else:
-                return Response(analysis_results, status=status.HTTP_201_CREATED)
+            # Include analysis results in the response
+            return Response(analysis_results, status=status.HTTP_201_CREATED)
+        except DeadlineExceeded:
+            # Nobody is waiting for the result anymore, shed_load answers with 503
+            default_storage.delete(temp_image_path)
+            raise
         except Exception as e:
             print("Error during file processing:", str(e))
             return Response({"error": "An error occurred while processing the file."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        
\ No newline at end of file
+
+
+class Metrics(APIView):
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request, format=None):
+        snapshot = metrics.snapshot()
+        snapshot['phash'] = get_index().stats()
+        return Response(snapshot)
+
+
+class Profiles(APIView):
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request, format=None):
+        return Response(list_profiles())
+
+
+class ProfileDetail(APIView):
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request, profile_id, format=None):
+        # The JSON summary, or the raw cProfile dump with ?download=prof (open with pstats or snakeviz)
+        if request.query_params.get('download') == 'prof':
+            path = profile_path(profile_id, '.prof')
+            if path is None:
+                raise Http404("Profile not found.")
+            return FileResponse(open(path, 'rb'), as_attachment=True, filename=f'{profile_id}.prof')
+        path = profile_path(profile_id, '.json')
+        if path is None:
+            raise Http404("Profile not found.")
+        return FileResponse(open(path, 'rb'), content_type='application/json')
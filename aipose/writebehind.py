@@ -0,0 +1,214 @@
+import atexit
+import glob
+import json
+import os
+import re
+import socket
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from . import metrics
+
+# Write-behind persistence for Image rows. A request appends its row to a
+# per-process journal file and returns; the rows are inserted with one
+# bulk_create when AIPOSE_WRITE_BEHIND_MAX_ROWS are buffered or every
+# AIPOSE_WRITE_BEHIND_INTERVAL seconds, and on shutdown. Journals left behind
+# by a crashed process are replayed by the next process that starts a buffer.
+# Every row carries a unique write_id, so a replay never inserts it twice.
+
+
+def write_records(records):
+    from .models import Image
+
+    start = time.perf_counter()
+    Image.objects.bulk_create([Image(**record) for record in records], ignore_conflicts=True)
+    metrics.observe('writebehind.flush', time.perf_counter() - start)
+    metrics.increment('writebehind.rows_written', len(records))
+
+
+def read_journal(path):
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # A torn last line from a crash mid-write, that request never got its 201
+                continue
+    return records
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# What follows '<host>-' in a journal name: the pid, then the live journal, a
+# rotated one being flushed, or one claimed for replay
+JOURNAL_NAME_RE = re.compile(r'^(\d+)\.(?:jsonl|\d+\.flushing|\d+\.replaying)$')
+
+
+def journal_owner(name, host):
+    # The pid that wrote the journal, None for files of other hosts. Host
+    # names may contain dots and dashes, so the known prefix is stripped first.
+    prefix = f'{host}-'
+    if not name.startswith(prefix):
+        return None
+    match = JOURNAL_NAME_RE.match(name[len(prefix):])
+    return int(match.group(1)) if match else None
+
+
+def replay_journals(journal_dir):
+    # Journal names start with '<host>-<pid>.', files of this host whose
+    # process is gone (or had this process's pid before) are replayed
+    host = socket.gethostname()
+    replayed = 0
+    for path in glob.glob(os.path.join(journal_dir, f'{glob.escape(host)}-*')):
+        pid = journal_owner(os.path.basename(path), host)
+        if pid is None:
+            continue
+        if pid != os.getpid() and pid_alive(pid):
+            continue
+        # Renamed first, so two starting workers never replay the same file
+        claimed = os.path.join(journal_dir, f'{host}-{os.getpid()}.{time.time_ns()}.replaying')
+        try:
+            os.replace(path, claimed)
+        except FileNotFoundError:
+            continue
+        records = read_journal(claimed)
+        if records:
+            write_records(records)
+        os.remove(claimed)
+        replayed += len(records)
+    if replayed:
+        metrics.increment('writebehind.replayed', replayed)
+    return replayed
+
+
+class WriteBehindBuffer:
+    def __init__(self, journal_dir, max_rows=50, interval=1.0, fsync=True):
+        os.makedirs(journal_dir, exist_ok=True)
+        self.journal_dir = journal_dir
+        self.journal_path = os.path.join(journal_dir, f'{socket.gethostname()}-{os.getpid()}.jsonl')
+        self.max_rows = max_rows
+        self.interval = interval
+        self.fsync = fsync
+        self.pid = os.getpid()
+        self.pending = []
+        # Rotated journals whose rows are in pending, removed once those rows are committed
+        self.rotated = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.journal = open(self.journal_path, 'a')
+        self.stopped = threading.Event()
+        self.timer = threading.Thread(target=self.run_timer, name='write-behind', daemon=True)
+        self.timer.start()
+
+    def add(self, **fields):
+        record = dict(fields, write_id=str(uuid.uuid4()))
+        line = json.dumps(record, cls=DjangoJSONEncoder)
+        with self.lock:
+            # The row is durable once this returns, before it reaches the database
+            self.journal.write(line + '\n')
+            self.journal.flush()
+            if self.fsync:
+                os.fsync(self.journal.fileno())
+            # Buffered as it was journaled, so a replay inserts exactly the same row
+            self.pending.append(json.loads(line))
+            full = len(self.pending) >= self.max_rows
+        metrics.increment('writebehind.rows_buffered')
+        if full:
+            self.try_flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending:
+                    return 0
+                records, self.pending = self.pending, []
+                # New rows go to a fresh journal while these are written
+                self.journal.close()
+                rotated = f'{self.journal_path[:-len(".jsonl")]}.{time.time_ns()}.flushing'
+                os.replace(self.journal_path, rotated)
+                self.rotated.append(rotated)
+                self.journal = open(self.journal_path, 'a')
+
+            try:
+                write_records(records)
+            except Exception:
+                # Retried with the next flush, the rotated journals stay on disk until then
+                with self.lock:
+                    self.pending = records + self.pending
+                metrics.increment('writebehind.errors')
+                raise
+
+            with self.lock:
+                rotated, self.rotated = self.rotated, []
+            for path in rotated:
+                os.remove(path)
+            return len(records)
+
+    def try_flush(self):
+        # The rows are journaled, a failed flush is retried by the next one
+        try:
+            self.flush()
+        except Exception as e:
+            print("Write-behind flush failed:", str(e))
+
+    def run_timer(self):
+        while not self.stopped.wait(self.interval):
+            self.try_flush()
+
+    def close(self):
+        if self.pid != os.getpid():
+            return
+        self.stopped.set()
+        try:
+            self.flush()
+        finally:
+            with self.lock:
+                self.journal.close()
+                if not self.pending and os.path.exists(self.journal_path) and not os.path.getsize(self.journal_path):
+                    os.remove(self.journal_path)
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    global _buffer
+    with _buffer_lock:
+        # A buffer created before a fork belongs to the parent
+        if _buffer is None or _buffer.pid != os.getpid():
+            journal_dir = getattr(settings, 'AIPOSE_WRITE_BEHIND_JOURNAL_DIR',
+                                  os.path.join(settings.BASE_DIR, 'var', 'write-behind'))
+            os.makedirs(journal_dir, exist_ok=True)
+            replay_journals(journal_dir)
+            _buffer = WriteBehindBuffer(
+                journal_dir,
+                max_rows=getattr(settings, 'AIPOSE_WRITE_BEHIND_MAX_ROWS', 50),
+                interval=getattr(settings, 'AIPOSE_WRITE_BEHIND_INTERVAL', 1.0),
+                fsync=getattr(settings, 'AIPOSE_WRITE_BEHIND_FSYNC', True),
+            )
+            atexit.register(_buffer.close)
+        return _buffer
+
+
+def save_image(**fields):
+    # uploaded_at (auto_now_add) is set when the row is inserted, at most
+    # AIPOSE_WRITE_BEHIND_INTERVAL after the request
+    if getattr(settings, 'AIPOSE_WRITE_BEHIND', True):
+        get_buffer().add(**fields)
+    else:
+        from .models import Image
+        Image.objects.create(**fields)
@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'aipose.settings')
 
 application = get_wsgi_application()
+
+# With AIPOSE_PRELOAD set and `gunicorn --preload`, this runs once in the master
+# before workers are forked
+from aipose.preload import preload  # noqa: E402
+
+preload()